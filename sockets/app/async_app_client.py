@@ -0,0 +1,22 @@
+import asyncio
+
+from libasync import Client
+from libcodec import compressions
+
+
+# asyncio version of socket_app_client.py
+# all of the requests share one connection and are in flight at the same time; gather() returns them in order even
+# though the slow_search one is answered last
+HOST = '192.168.86.29'
+PORT = 65000  # port to listen on
+
+
+async def main():
+    async with Client(HOST, PORT, accept_encoding=compressions()) as client:
+        queries = [('slow_search', 'morpheus'), ('search', 'ring'), ('search', '\U0001f436')]
+        results = await asyncio.gather(*(client.request(action, value) for action, value in queries))
+        for (action, value), content in zip(queries, results):
+            print(f"{action} {value}: {content.get('result')}")
+
+
+asyncio.run(main())
@@ -0,0 +1,22 @@
+import asyncio
+
+from libasync import Server, DEFAULT_HANDLERS
+
+
+# asyncio version of socket_app_host.py; speaks the same protocol so socket_app_client.py works against it too
+HOST = '192.168.86.29'
+PORT = 65000  # port to listen on
+
+
+async def slow_search(request):
+    # handlers are coroutines, so one that waits on something (a database, another service) doesn't block the others
+    await asyncio.sleep(1)
+    return await DEFAULT_HANDLERS["search"](request)
+
+
+handlers = dict(DEFAULT_HANDLERS, slow_search=slow_search)
+
+try:
+    asyncio.run(Server(handlers).serve(HOST, PORT))
+except KeyboardInterrupt:
+    print("caught keyboard interrupt, exiting")
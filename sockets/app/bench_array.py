@@ -0,0 +1,63 @@
+import sys
+import time
+import array
+import random
+
+from libcodec import ARRAY_CONTENT_TYPE, decode_content, encode_content
+
+# benchmark for sending a vector of floats as a json list vs as a typed array (binary/array, libcodec)
+#   encode: the list/array -> the content bytes
+#   decode: the content bytes -> something the receiver can index (a list, or a TypedArray view over the bytes);
+#           "swapped" is a typed array from a sender with the other byte order, the one case where decoding copies
+# runs in one process, so the numbers are per core
+# usage: python bench_array.py
+
+SIZES = (1_000, 100_000, 1_000_000)  # floats per vector
+DURATION = 1.0  # seconds per measurement
+OTHER_BYTEORDER = "big" if sys.byteorder == "little" else "little"
+
+
+def measure(func):
+    # seconds per call
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= DURATION:
+            return elapsed / count
+
+
+def main():
+    print(f"{'floats':>10} {'format':>7} {'bytes':>12} {'encode ms':>10} {'decode ms':>10} {'swapped ms':>11}")
+    for size in SIZES:
+        rng = random.Random(1)
+        values = [rng.uniform(-1000, 1000) for _ in range(size)]
+        vector = array.array("d", values)
+
+        content, encoding = encode_content({"value": values}, "text/json", "utf-8")
+        encode_seconds = measure(lambda: encode_content({"value": values}, "text/json", "utf-8"))
+        decode_seconds = measure(lambda: decode_content(memoryview(content), "text/json", encoding))
+        print(
+            f"{size:>10,} {'json':>7} {len(content):>12,} {encode_seconds * 1e3:>10.3f} {decode_seconds * 1e3:>10.3f}"
+        )
+
+        content, encoding = encode_content(vector, ARRAY_CONTENT_TYPE, "binary")
+        # the header and the items as they would go out, in one piece like they come in
+        content = bytes(content)
+        if decode_content(content, ARRAY_CONTENT_TYPE, encoding).view().tolist() != values:
+            raise RuntimeError("The array came back different.")
+        encode_seconds = measure(lambda: encode_content(vector, ARRAY_CONTENT_TYPE, "binary"))
+        decode_seconds = measure(lambda: decode_content(memoryview(content), ARRAY_CONTENT_TYPE, encoding).view())
+        swapped_seconds = measure(
+            lambda: decode_content(memoryview(content), ARRAY_CONTENT_TYPE, encoding, OTHER_BYTEORDER).view()
+        )
+        print(
+            f"{size:>10,} {'array':>7} {len(content):>12,} {encode_seconds * 1e3:>10.3f} {decode_seconds * 1e3:>10.3f}"
+            f" {swapped_seconds * 1e3:>11.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
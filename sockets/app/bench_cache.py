@@ -0,0 +1,82 @@
+import json
+import time
+import random
+import socket
+import selectors
+from collections import Counter
+
+from libcache import ResponseCache
+from libheader import create_message
+from libserver import Message, search_engine
+from libsearch import SearchIndex
+
+# benchmark for the response cache (libcache): requests per second through a Message with and without it
+# the requests are drawn from QUERIES distinct searches with zipf-like popularity (a few hot keys, a long tail), like
+# the traffic the cache is meant for. Each request goes through the whole server side: header and content decoding,
+# the handler, encoding and framing; only the socket is left out, the send buffer is dropped after every response.
+# usage: python bench_cache.py
+
+DURATION = 2.0  # seconds per measurement
+KEYS = 100_000
+QUERIES = 10_000
+SKEW = 1.1  # zipf exponent; higher is more skewed
+
+
+def make_requests(rng):
+    keys = [f"key{i:06d}" for i in range(KEYS)]
+    search_engine.index = SearchIndex({key: (f"value of {key}", float(rng.random())) for key in keys})
+    searches = []
+    for key in rng.sample(keys, QUERIES):
+        mode = rng.choice(["exact", "prefix", "fuzzy"])
+        value = key[:6] if mode == "prefix" else key
+        searches.append({"action": "search", "value": value, "mode": mode})
+    weights = [1 / rank ** SKEW for rank in range(1, QUERIES + 1)]
+    return [
+        create_message(
+            content_bytes=json.dumps(request).encode("utf-8"),
+            content_type="text/json",
+            content_encoding="utf-8",
+            request_id=i,
+            binary_header=True,
+        )
+        for i, request in enumerate(rng.choices(searches, weights, k=50_000))
+    ]
+
+
+def measure(messages, cache):
+    sel = selectors.DefaultSelector()
+    sock, peer = socket.socketpair()
+    message = Message(sel, sock, None, keep_alive=True, cache=cache)
+    sel.register(sock, selectors.EVENT_READ, data=message)
+    message.pipelined = True
+    count = 0
+    start = time.perf_counter()
+    end = start + DURATION
+    try:
+        while True:
+            for data in messages:
+                message._recv_buffer.extend(data)
+                message._process_recv_buffer()
+                message._send_buffer.close()
+            count += len(messages)
+            now = time.perf_counter()
+            if now >= end:
+                return count / (now - start)
+    finally:
+        sel.close()
+        sock.close()
+        peer.close()
+
+
+def main():
+    messages = make_requests(random.Random(1))
+    print(f"{'cache':>8} {'requests/s':>12} {'hit rate':>9}")
+    print(f"{'off':>8} {measure(messages, None):>12,.0f} {'':>9}")
+    stats = Counter()
+    cache = ResponseCache({"search"}, stats=stats)
+    rate = measure(messages, cache)
+    print(f"{'on':>8} {rate:>12,.0f} {stats['cache-hits'] / (stats['cache-hits'] + stats['cache-misses']):>9.1%}")
+
+
+if __name__ == "__main__":
+    main()
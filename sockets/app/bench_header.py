@@ -0,0 +1,72 @@
+import time
+
+from libserver import Message
+
+# microbenchmark of the json header vs the binary header (libheader) for a small search request
+# runs in one process/thread so the numbers are messages per second per core
+# usage: python bench_header.py
+
+DURATION = 2.0  # seconds per measurement
+CONTENT = b'{"action": "search", "value": "morpheus"}'
+
+
+def make_message():
+    message = Message(None, None, None, keep_alive=True)
+    # pipelined stops process_request() from touching the selector (there isn't one here)
+    message.pipelined = True
+    return message
+
+
+def encode(binary_header):
+    message = make_message()
+    # joined like the bytes the peer receives; the encode numbers include that join
+    return lambda: b"".join(
+        message._create_message(
+            content_bytes=CONTENT,
+            content_type="text/json",
+            content_encoding="utf-8",
+            request_id=1,
+            binary_header=binary_header,
+        )
+    )
+
+
+def decode(binary_header):
+    message = make_message()
+    data = encode(binary_header)()
+
+    def run():
+        message._recv_buffer.extend(data)
+        message.process_protoheader()
+        message.process_jsonheader()
+        message.process_request()
+        message._next_request()
+
+    return run
+
+
+def measure(func):
+    count = 0
+    start = time.perf_counter()
+    end = start + DURATION
+    while True:
+        for _ in range(1000):
+            func()
+        count += 1000
+        now = time.perf_counter()
+        if now >= end:
+            return count / (now - start)
+
+
+def main():
+    print(f"{'header':>8} {'encode msg/s':>14} {'decode msg/s':>14} {'size':>6}")
+    for name, binary_header in (("json", False), ("binary", True)):
+        size = len(encode(binary_header)()) - len(CONTENT)
+        print(
+            f"{name:>8} {measure(encode(binary_header)):>14,.0f} "
+            f"{measure(decode(binary_header)):>14,.0f} {size:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
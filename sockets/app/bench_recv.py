@@ -0,0 +1,103 @@
+import sys
+import json
+import time
+import socket
+import selectors
+import threading
+import subprocess
+import resource
+
+from libserver import Message
+
+# benchmark for the receive path of libserver.Message
+# every payload size runs in its own child process so the peak RSS (ru_maxrss) reported is for that size only
+# usage: python bench_recv.py [--legacy]
+#   --legacy runs the old bytes += data receive loop for comparison (quadratic, so it stops at 10 MB)
+
+SIZES = [1 << 10, 16 << 10, 256 << 10, 1 << 20, 10 << 20, 100 << 20]
+LEGACY_MAX_SIZE = 10 << 20
+
+
+def frame(payload):
+    # build the message exactly the way a client would, so the server sees a real proto header + json header
+    message = Message(None, None, None)
+    return b"".join(
+        message._create_message(
+            content_bytes=payload,
+            content_type="binary/custom-client-binary-type",
+            content_encoding="binary",
+        )
+    )
+
+
+def sender(sock, data):
+    sock.sendall(data)
+    sock.close()
+
+
+def receive(sock):
+    # drive a server side Message until the request has been received
+    sel = selectors.DefaultSelector()
+    sock.setblocking(False)
+    message = Message(sel, sock, "bench")
+    sel.register(sock, selectors.EVENT_READ, data=message)
+    while message.request is None:
+        for key, mask in sel.select(timeout=1):
+            message.read()
+    sel.close()
+    return len(message.request)
+
+
+def receive_legacy(sock, total):
+    # the receive loop the Message classes used to have: bytes += data then re-slice per header
+    buffer = b""
+    while len(buffer) < total:
+        data = sock.recv(4096)
+        if not data:
+            break
+        buffer += data
+    return len(buffer[2:])
+
+
+def run_child(size, legacy):
+    data = frame(b"x" * size)
+    rsock, wsock = socket.socketpair()
+    thread = threading.Thread(target=sender, args=(wsock, data))
+    start = time.perf_counter()
+    thread.start()
+    if legacy:
+        receive_legacy(rsock, len(data))
+    else:
+        receive(rsock)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    rsock.close()
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        # linux reports kilobytes, macos reports bytes
+        maxrss *= 1024
+    print(json.dumps({"size": size, "seconds": elapsed, "maxrss": maxrss}))
+
+
+def main(legacy):
+    print(f"{'payload':>10} {'seconds':>10} {'MB/s':>10} {'peak RSS MB':>12}")
+    for size in SIZES:
+        if legacy and size > LEGACY_MAX_SIZE:
+            break
+        args = [sys.executable, __file__, "--child", str(size)]
+        if legacy:
+            args.append("--legacy")
+        out = subprocess.run(args, capture_output=True, text=True, check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        mb_per_s = size / result["seconds"] / (1 << 20)
+        print(
+            f"{size:>10} {result['seconds']:>10.4f} {mb_per_s:>10.1f} "
+            f"{result['maxrss'] / (1 << 20):>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        run_child(int(sys.argv[sys.argv.index("--child") + 1]), "--legacy" in sys.argv)
+    else:
+        main("--legacy" in sys.argv)
@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import random
+import tempfile
+import resource
+
+import libsearch
+from libsearch import SearchEngine
+
+# benchmark for the search index (libsearch) at 1M keys
+# builds a synthetic corpus (made up words of 5-12 letters drawn with english letter frequencies, zipf-ish weights),
+# writes it to a file, loads it and times exact, prefix and fuzzy queries one at a time; then times searches while the
+# corpus is reloaded a slice at a time in between, like the server loop does
+# usage: python bench_search.py [number of keys]
+
+KEYS = 1_000_000
+QUERIES = 2000
+LETTERS = "etaoinshrdlcumwfgypbvkjxqz"
+FREQUENCIES = [12.7, 9.1, 8.2, 7.5, 7.0, 6.7, 6.3, 6.1, 6.0, 4.3, 4.0, 2.8, 2.8, 2.4, 2.4, 2.2, 2.0, 2.0, 1.9, 1.5, 1.0,
+               0.8, 0.15, 0.15, 0.1, 0.07]
+
+
+def make_corpus(path, count, rng):
+    keys = set()
+    while len(keys) < count:
+        keys.add("".join(rng.choices(LETTERS, FREQUENCIES, k=rng.randint(5, 12))))
+    keys = sorted(keys)
+    rng.shuffle(keys)
+    with open(path, "w", encoding="utf-8") as f:
+        for rank, key in enumerate(keys, 1):
+            f.write(f"{key}\tvalue of {key}\t{1e6 / rank:.3f}\n")
+    return keys
+
+
+def typo(key, edits, rng):
+    for _ in range(edits):
+        i = rng.randrange(len(key))
+        kind = rng.choice("sid")
+        char = rng.choice("abcdefghijklmnopqrstuvwxyz")
+        if kind == "s":
+            key = key[:i] + char + key[i + 1:]
+        elif kind == "i":
+            key = key[:i] + char + key[i:]
+        else:
+            key = key[:i] + key[i + 1:]
+    return key
+
+
+def timings(func, queries):
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        func(query)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times
+
+
+def report(name, times):
+    us = 1e6
+    print(
+        f"{name:>22} {sum(times) / len(times) * us:>9.1f} {times[len(times) // 2] * us:>9.1f} "
+        f"{times[int(len(times) * 0.99)] * us:>9.1f} {times[-1] * us:>9.1f}"
+    )
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "corpus.tsv")
+        keys = make_corpus(path, count, rng)
+        print(f"corpus: {count:,} keys, {os.path.getsize(path) / 1e6:.1f} MB")
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        engine = SearchEngine()
+        engine.load(path)
+        index = engine.index
+        print(f"load: {time.perf_counter() - start:.2f} s")
+        # ru_maxrss is in KB on linux; includes the corpus being read, so it is an upper bound on the index itself
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+        print(f"peak memory growth: {rss / 1024:.0f} MB, {len(index._grams):,} trigrams")
+
+        sample = rng.sample(keys, QUERIES)
+        # 2 edits are only tried for queries of 7 characters or more
+        long_keys = [key for key in keys[:200_000] if len(key) >= 9][:QUERIES]
+        print(f"{'query':>22} {'mean us':>9} {'p50 us':>9} {'p99 us':>9} {'max us':>9}")
+        report("exact hit", timings(index.exact, sample))
+        report("exact miss", timings(index.exact, [key + "q" for key in sample]))
+        report("prefix 2 chars top10", timings(index.prefix, [key[:2] for key in sample]))
+        report("prefix 4 chars top10", timings(index.prefix, [key[:4] for key in sample]))
+        report("fuzzy 1 edit top10", timings(lambda q: index.fuzzy(q, 1), [typo(k, 1, rng) for k in sample]))
+        # MAX_DISTANCE caps what the server allows; the index itself does 2 edits when asked
+        libsearch.MAX_DISTANCE = 2
+        report("fuzzy 2 edits top10", timings(lambda q: index.fuzzy(q, 2), [typo(k, 2, rng) for k in long_keys]))
+
+        # hot reload: searches keep being answered from the old index while the new one is built, RELOAD_SLICE seconds
+        # at a time; "step" is how long one of those slices actually takes, i.e. how long the loop stops for
+        # (without our reference to the old index, so that it is freed a slice at a time too)
+        del index
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 1_000_000_000))
+        engine.check_for_update()
+        during = []
+        steps = []
+        start = time.perf_counter()
+        while engine.reloading:
+            during.extend(timings(lambda q: engine.index.exact(q), sample[:10]))
+            step_start = time.perf_counter()
+            engine.step()
+            steps.append(time.perf_counter() - step_start)
+        print(f"reload: {time.perf_counter() - start:.2f} s in {len(steps):,} steps")
+        during.sort()
+        steps.sort()
+        report("exact during reload", during)
+        report("reload step", steps)
+
+
+if __name__ == "__main__":
+    main()
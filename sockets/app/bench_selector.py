@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import select
+import socket
+import selectors
+from collections import Counter
+
+from libheader import create_message
+from libselector import make_selector
+from libserver import Message
+
+# benchmark for the event backends (libselector) with CONNECTIONS keep-alive connections open
+# a forked server runs the Message loop on each backend; this process is the client: every busy connection has one
+# request in flight (pipelined, with a request-id) and sends the next one as soon as the response is in. With all of
+# them busy every select returns lots of ready connections; with 1% busy most of the connections are idle, which is
+# where poll() has to look at all of them on every call and epoll doesn't.
+# system calls are counted in the server: the selector's (wait: epoll_wait/poll, ctl: epoll_ctl/poll register/modify)
+# and recv/send on the connections. Client and server share the machine, so requests/s is for the pair of them.
+# usage: python bench_selector.py (needs twice CONNECTIONS file descriptors, the server and the client take half each)
+
+CONNECTIONS = 10_000
+BUSY = (1.0, 0.01)  # fraction of the connections with a request in flight
+BACKENDS = ("epoll", "epoll-et", "poll")
+WARMUP = 1.0  # seconds
+DURATION = 3.0
+HOST = "127.0.0.1"
+
+
+class CountingSocket(socket.socket):
+    calls = Counter()
+
+    def recv_into(self, *args):
+        CountingSocket.calls["recv"] += 1
+        return super().recv_into(*args)
+
+    def send(self, *args):
+        CountingSocket.calls["send"] += 1
+        return super().send(*args)
+
+    def sendmsg(self, *args):
+        CountingSocket.calls["send"] += 1
+        return super().sendmsg(*args)
+
+
+def server(backend, lsock, result_fd):
+    sel = make_selector(backend)
+    sel.register(lsock, selectors.EVENT_READ, data=None)
+    stats = Counter(requests=0)
+    accepted = 0
+    start = end = None
+    base = None
+    while True:
+        for key, mask in sel.select(timeout=0.1):
+            if key.data is None:
+                while True:
+                    try:
+                        conn, addr = lsock.accept()
+                    except BlockingIOError:
+                        break
+                    conn = CountingSocket(fileno=conn.detach())
+                    conn.setblocking(False)
+                    message = Message(sel, conn, addr, keep_alive=True, stats=stats)
+                    sel.register(conn, selectors.EVENT_READ, data=message)
+                    accepted += 1
+            else:
+                try:
+                    key.data.process_events(mask)
+                except Exception:
+                    key.data.close()
+        now = time.perf_counter()
+        if start is None and accepted == CONNECTIONS:
+            start = now + WARMUP
+        elif start is not None and base is None and now >= start:
+            base = stats["requests"], Counter(sel.calls), Counter(CountingSocket.calls)
+            start, end = now, now + DURATION
+        elif end is not None and now >= end:
+            requests = stats["requests"] - base[0]
+            calls = Counter(sel.calls)
+            calls.subtract(base[1])
+            calls.update(CountingSocket.calls)
+            calls.subtract(base[2])
+            os.write(result_fd, json.dumps({"requests": requests, "seconds": now - start, "calls": calls}).encode())
+            os._exit(0)
+
+
+def client(port, busy, result_fd):
+    request = create_message(
+        content_bytes=json.dumps({"action": "search", "value": "morpheus"}).encode("utf-8"),
+        content_type="text/json",
+        content_encoding="utf-8",
+        request_id=1,
+        binary_header=True,
+    )
+    socks = [socket.create_connection((HOST, port)) for _ in range(CONNECTIONS)]
+    # the size of a response, they are all the same
+    socks[0].sendall(request)
+    socks[0].settimeout(5)
+    size = len(socks[0].recv(65536))
+    poller = select.epoll()
+    poller.register(result_fd, select.EPOLLIN)
+    received = {}
+    by_fd = {}
+    for sock in socks[: max(int(CONNECTIONS * busy), 1)]:
+        sock.setblocking(False)
+        by_fd[sock.fileno()] = sock
+        received[sock.fileno()] = 0
+        poller.register(sock.fileno(), select.EPOLLIN)
+        sock.send(request)
+    try:
+        while True:
+            for fd, event in poller.poll(1):
+                if fd == result_fd:
+                    return json.loads(os.read(result_fd, 65536))
+                data = by_fd[fd].recv(65536)
+                received[fd] += len(data)
+                answered, received[fd] = divmod(received[fd], size)
+                if answered:
+                    by_fd[fd].send(request * answered)
+    finally:
+        poller.close()
+        for sock in socks:
+            sock.close()
+
+
+def measure(backend, busy):
+    lsock = socket.create_server((HOST, 0), backlog=CONNECTIONS)
+    lsock.setblocking(False)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        server(backend, lsock, write_fd)
+    os.close(write_fd)
+    try:
+        return client(lsock.getsockname()[1], busy, read_fd)
+    finally:
+        os.waitpid(pid, 0)
+        os.close(read_fd)
+        lsock.close()
+
+
+def main():
+    print(f"{CONNECTIONS:,} connections")
+    print(
+        f"{'busy':>5} {'backend':>9} {'requests/s':>11} {'syscalls/request':>17} "
+        f"{'wait':>6} {'ctl':>6} {'recv':>6} {'send':>6}"
+    )
+    for busy in BUSY:
+        for backend in BACKENDS:
+            result = measure(backend, busy)
+            requests, calls = result["requests"], result["calls"]
+            per = {name: calls.get(name, 0) / requests for name in ("wait", "ctl", "recv", "send")}
+            print(
+                f"{busy:>5.0%} {backend:>9} {requests / result['seconds']:>11,.0f} {sum(per.values()):>17.2f}"
+                f" {per['wait']:>6.3f} {per['ctl']:>6.2f} {per['recv']:>6.2f} {per['send']:>6.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
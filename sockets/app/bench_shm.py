@@ -0,0 +1,104 @@
+import os
+import time
+import signal
+import socket
+import tempfile
+
+import socket_app_host as host
+from libbuffer import RecvBuffer
+from libshm import ShmClient
+
+# benchmark for the shared memory transport (libshm) against tcp and unix domain sockets
+# a forked socket_app_host serves all three; this process is the client and sends binary/echo requests of each SIZE one
+# at a time, reading each echo back before sending the next. Throughput is the content moved, both ways, per second.
+# the socket client is ShmClient's request/response code on a blocking socket, so the only difference is the transport
+# (the server has to copy the content out of and into the transport either way, and so does the client)
+# client and server share the machine, so it is the throughput of the pair of them
+# usage: python bench_shm.py
+
+SIZES = (64 * 1024, 1024 * 1024, 8 * 1024 * 1024)
+TRANSPORTS = ("tcp", "unix", "shm")
+DURATION = 2.0  # seconds per size and transport
+HOST = "127.0.0.1"
+
+
+class SocketClient(ShmClient):
+    # the same client on a plain blocking socket; recv_into/sendmsg block instead of raising BlockingIOError, so it
+    # never waits for a doorbell
+    def __init__(self, family, address):
+        self.timeout = None
+        self.channel = socket.socket(family, socket.SOCK_STREAM)
+        self.channel.connect(address)
+        self._recv_buffer = RecvBuffer()
+
+
+def start_server(directory):
+    lsock = host.create_listening_socket(HOST, 0)
+    host.UNIX_PATH = os.path.join(directory, "unix.sock")
+    host.SHM_PATH = os.path.join(directory, "shm.sock")
+    # bodies this big would otherwise be spooled to disk; the rest keeps the loop to just the messages
+    host.SPOOL_THRESHOLD = None
+    host.MAX_REQUESTS = None
+    host.EXECUTOR = None
+    host.CACHE_ACTIONS = None
+    host.IDLE_TIMEOUT = None
+    unix_lsocks = [host.create_unix_listening_socket(path) for path in (host.UNIX_PATH, host.SHM_PATH)]
+    pid = os.fork()
+    if pid == 0:
+        try:
+            host.serve([lsock] + unix_lsocks)
+        finally:
+            os._exit(0)
+    addresses = {
+        "tcp": (socket.AF_INET, lsock.getsockname()),
+        "unix": (socket.AF_UNIX, host.UNIX_PATH),
+    }
+    lsock.close()
+    for unix_lsock in unix_lsocks:
+        unix_lsock.close()
+    return pid, addresses
+
+
+def measure(client, content):
+    # rounds trips for DURATION seconds; returns bytes of content per second, both ways
+    header, response = client.request(content, "binary/echo", "binary")
+    if bytes(response) != content:
+        raise RuntimeError("The echo came back different.")
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        client.request(content, "binary/echo", "binary")
+        count += 1
+    return 2 * len(content) * count / (time.perf_counter() - start)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        pid, addresses = start_server(directory)
+        try:
+            # the server may not be accepting yet
+            time.sleep(0.5)
+            print(f"{'size':>10} " + " ".join(f"{transport + ' MB/s':>10}" for transport in TRANSPORTS))
+            for size in SIZES:
+                content = os.urandom(size)
+                results = []
+                for transport in TRANSPORTS:
+                    if transport == "shm":
+                        client = ShmClient(host.SHM_PATH)
+                    else:
+                        client = SocketClient(*addresses[transport])
+                    try:
+                        results.append(measure(client, content))
+                    finally:
+                        client.close()
+                print(f"{size:>10,} " + " ".join(f"{result / 1e6:>10,.0f}" for result in results))
+        finally:
+            # let the server close the last connection first, an interrupt in the middle of that leaves its rings
+            # to the resource tracker
+            time.sleep(0.2)
+            os.kill(pid, signal.SIGINT)
+            os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import time
+import random
+from types import SimpleNamespace
+
+from libtimer import TimerWheel
+
+# benchmark for the connection deadlines (libtimer): what the selector loop pays to find the connections that timed out
+#   sweep: the old way, every connection's last activity checked once a second
+#   wheel: a timer per connection on a TimerWheel; scheduling and cancelling one (a connection going from reading a
+#          request to idle and back), and a second's worth of ticks with none of them due
+# usage: python bench_timer.py
+
+CONNECTIONS = (1_000, 10_000, 100_000)
+IDLE_TIMEOUT = 30
+TICK = 0.5
+
+
+def sweep(connections, now):
+    # what the host did every second
+    return [c for c in connections if now - c.last_active > IDLE_TIMEOUT]
+
+
+def measure(count):
+    rng = random.Random(1)
+    now = time.monotonic()
+    connections = [SimpleNamespace(last_active=now - rng.random() * 10) for _ in range(count)]
+    start = time.perf_counter()
+    sweep(connections, now)
+    sweep_seconds = time.perf_counter() - start
+
+    wheel = TimerWheel(TICK)
+    timers = [wheel.schedule(IDLE_TIMEOUT, lambda: None) for _ in range(count)]
+    start = time.perf_counter()
+    for i in range(count):
+        timers[i].cancel()
+        timers[i] = wheel.schedule(IDLE_TIMEOUT, lambda: None)
+    reschedule_seconds = (time.perf_counter() - start) / count
+    # a second of ticks
+    wheel.clock = lambda: now + 1
+    start = time.perf_counter()
+    wheel.advance()
+    tick_seconds = time.perf_counter() - start
+    return sweep_seconds, reschedule_seconds, tick_seconds
+
+
+def main():
+    print(f"{'connections':>12} {'sweep ms/s':>11} {'wheel ms/s':>11} {'reschedule us':>14}")
+    for count in CONNECTIONS:
+        sweep_seconds, reschedule_seconds, tick_seconds = measure(count)
+        print(
+            f"{count:>12,} {sweep_seconds * 1e3:>11.2f} {tick_seconds * 1e3:>11.3f} "
+            f"{reschedule_seconds * 1e6:>14.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
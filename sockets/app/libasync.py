@@ -0,0 +1,276 @@
+import asyncio
+import socket
+from types import SimpleNamespace
+
+from libclient import socket_address
+from libcodec import (
+    ARRAY_CONTENT_TYPE,
+    COMPRESS_THRESHOLD,
+    ContentTooLarge,
+    choose_compression,
+    compressions,
+    decode_content,
+    encode_content,
+    has_codec,
+)
+from libheader import PROTO_HEADER, create_message_parts, decode_header, split_proto_header
+from libserver import handle_array, handlers as server_handlers
+
+# asyncio version of libserver/libclient
+# same wire format (2-byte proto header, json or binary header, content) so asyncio clients can talk to
+# socket_app_host.py and the selector based clients can talk to an asyncio server
+# instead of a Message object with a state machine driven by select(), every connection is a coroutine that reads
+# exactly as many bytes as each part of the message needs with StreamReader.readexactly()
+
+
+async def read_message(reader, accepted=()):
+    # returns (header, content) or None when the peer closed the connection between messages
+    # accepted: the compressions we offered the peer (see libcodec.decode_content)
+    message = await read_raw_message(reader)
+    if message is None:
+        return None
+    header, data = message
+    return header, decode_content(
+        data, header["content-type"], header["content-encoding"], header["byteorder"], accepted=accepted
+    )
+
+
+async def read_raw_message(reader):
+    # returns (header, content as it came, still compressed) or None like read_message()
+    try:
+        proto_header = await reader.readexactly(PROTO_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+    hdrlen, binary_header = split_proto_header(PROTO_HEADER.unpack(proto_header)[0])
+    header = decode_header(await reader.readexactly(hdrlen), binary_header)
+    return header, await reader.readexactly(header["content-length"])
+
+
+def async_handler(handler):
+    # one of libserver's handlers as a coroutine; it runs on the event loop, like it does on the selector loop
+    async def run(request):
+        return handler(request)
+
+    return run
+
+
+# the same actions as the selector server (search, search_many, ...)
+DEFAULT_HANDLERS = {action: async_handler(handler) for action, handler in server_handlers.items()}
+
+
+class Server:
+    def __init__(self, handlers=None, compress_threshold=COMPRESS_THRESHOLD):
+        # handlers: action -> async def handler(request) returning the response content
+        self.handlers = DEFAULT_HANDLERS if handlers is None else handlers
+        self.compress_threshold = compress_threshold
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print("listening on", (host, port))
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        print("accepted connection from", addr)
+        # per connection negotiation state, the same things libserver.Message keeps
+        conn = SimpleNamespace(
+            addr=addr, writer=writer, compression=None, send_accept_encoding=False, accepted_compressions=()
+        )
+        tasks = set()
+        try:
+            while True:
+                message = await read_raw_message(reader)
+                if message is None:
+                    break
+                header, data = message
+                try:
+                    request = decode_content(
+                        data,
+                        header["content-type"],
+                        header["content-encoding"],
+                        header["byteorder"],
+                        accepted=conn.accepted_compressions,
+                    )
+                except ContentTooLarge as e:
+                    # like libserver: the body was read, so the client gets an error rather than a closed connection
+                    request = e
+                if "accept-encoding" in header:
+                    conn.compression = choose_compression(header["accept-encoding"])
+                    conn.send_accept_encoding = True
+                if "request-id" in header:
+                    # pipelined: every request gets its own task so a slow handler doesn't hold up the others and
+                    # responses go out in whatever order the handlers finish
+                    task = asyncio.create_task(self._respond(conn, header, request))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    await self._respond(conn, header, request)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            print("error: connection to", f"{addr}: {repr(e)}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            print("closing connection to", addr)
+            writer.close()
+
+    async def _dispatch(self, request):
+        action = request.get("action")
+        handler = self.handlers.get(action)
+        if handler is None:
+            return {"result": f'Error: invalid action "{action}".'}
+        try:
+            return await handler(request)
+        except Exception as e:
+            # the client is waiting on this request-id, so it gets an error result rather than no answer at all
+            return {"result": f"Error: {repr(e)}"}
+
+    async def _respond(self, conn, header, request):
+        content_type = header["content-type"]
+        if isinstance(request, ContentTooLarge):
+            content = {"result": f"Error: {request}"}
+            content_type = "text/json"
+            encoding = "utf-8"
+        elif content_type == ARRAY_CONTENT_TYPE:
+            # numeric arrays go to the same handler as in libserver
+            content = handle_array(request)
+            encoding = "binary"
+        elif has_codec(content_type):
+            content = await self._dispatch(request)
+            encoding = header["content-encoding"].partition("+")[0]
+        else:
+            # Binary or unknown content-type, same answer as libserver
+            content = b"First 10 bytes of request: " + request[:10]
+            content_type = "binary/custom-server-binary-type"
+            encoding = "binary"
+        content_bytes, content_encoding = encode_content(
+            content, content_type, encoding, compression=conn.compression, threshold=self.compress_threshold
+        )
+        extra_headers = None
+        if conn.send_accept_encoding:
+            extra_headers = {"accept-encoding": compressions()}
+            conn.send_accept_encoding = False
+            conn.accepted_compressions = extra_headers["accept-encoding"]
+        # the parts go to the transport as they are; newer asyncio versions send them with sendmsg like libserver
+        conn.writer.writelines(
+            create_message_parts(
+                content_bytes=content_bytes,
+                content_type=content_type,
+                content_encoding=content_encoding,
+                request_id=header.get("request-id"),
+                binary_header=header.get("header-format") == "binary",
+                extra_headers=extra_headers,
+            )
+        )
+        await conn.writer.drain()
+
+
+class Client:
+    def __init__(
+        self, host, port, header_format="binary", accept_encoding=None, compress_threshold=COMPRESS_THRESHOLD
+    ):
+        # one connection; every request() is pipelined over it with a request-id, so any number of coroutines can
+        # have calls in flight at the same time
+        self.addr = (host, port)
+        self.header_format = header_format
+        self.accept_encoding = accept_encoding
+        self.compress_threshold = compress_threshold
+        self.compression = None
+        self._binary_header_accepted = False
+        self._accept_encoding_acked = False
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._in_flight = {}
+        self._next_request_id = 1
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def connect(self):
+        # host can be "unix:/path" for a local server's unix domain socket, like for libclient
+        family, address = socket_address(*self.addr)
+        if family == socket.AF_UNIX:
+            self._reader, self._writer = await asyncio.open_unix_connection(address)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(*address)
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    async def close(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        await self._writer.wait_closed()
+        await self._reader_task
+        self._writer = None
+
+    async def request(self, action, value):
+        # a search style request; returns the decoded response content (e.g. {"result": ...})
+        return await self.send(dict(action=action, value=value))
+
+    async def send(self, content, content_type="text/json", encoding="utf-8"):
+        if self._writer is None:
+            raise ConnectionError("Client is not connected.")
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[request_id] = future
+        content_bytes, content_encoding = encode_content(
+            content, content_type, encoding, compression=self.compression, threshold=self.compress_threshold
+        )
+        self._writer.writelines(
+            create_message_parts(
+                content_bytes=content_bytes,
+                content_type=content_type,
+                content_encoding=content_encoding,
+                request_id=request_id,
+                binary_header=self._binary_header_accepted,
+                extra_headers=self._negotiation_headers(),
+            )
+        )
+        try:
+            await self._writer.drain()
+            return await future
+        finally:
+            self._in_flight.pop(request_id, None)
+
+    def _negotiation_headers(self):
+        # same as libclient.Message: offer what the server hasn't answered yet
+        headers = {}
+        if self.header_format != "json" and not self._binary_header_accepted:
+            headers["header-format"] = self.header_format
+        if self.accept_encoding and not self._accept_encoding_acked:
+            headers["accept-encoding"] = list(self.accept_encoding)
+        return headers
+
+    async def _read_responses(self):
+        # the one reader for the connection; hands every response to the request() waiting on its request-id
+        error = ConnectionError("Connection closed.")
+        try:
+            while True:
+                message = await read_message(self._reader, accepted=self.accept_encoding or ())
+                if message is None:
+                    break
+                header, response = message
+                if header.get("header-format") == "binary":
+                    self._binary_header_accepted = True
+                if "accept-encoding" in header:
+                    self.compression = choose_compression(header["accept-encoding"])
+                    self._accept_encoding_acked = True
+                future = self._in_flight.get(header.get("request-id"))
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            error = e
+        finally:
+            for future in self._in_flight.values():
+                if not future.done():
+                    future.set_exception(error)
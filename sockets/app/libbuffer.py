@@ -0,0 +1,240 @@
+import os
+import mmap
+import socket
+import tempfile
+from collections import deque
+from itertools import islice, takewhile
+
+# buffer helpers shared by libserver and libclient
+# the original versions kept the received data in a bytes object and did self._recv_buffer += data on every recv()
+# call; bytes are immutable so every += (and every re-slice in the process_* methods) copies the whole buffer, which
+# turns into quadratic copying once the payloads get large (a 50 MB payload read in 4096 byte chunks copies gigabytes)
+#
+# RecvBuffer instead keeps one preallocated bytearray and receives straight into it with socket.recv_into(). The
+# process_* methods take memoryview slices out of it (consume) so nothing is copied on the way to the handler.
+#
+# SendBuffer is the same idea for the way out: the old self._send_buffer += message; self._send_buffer[sent:] copied
+# every response (twice, counting the header + content concatenation in _create_message) before it was even sent.
+# SendBuffer keeps the parts of each message as they are and hands several of them to the kernel at once with
+# socket.sendmsg() (scatter-gather, one iovec per part), remembering how far into the first part we got.
+#
+# a part can also be a FileBody, (a range of) a file on disk. Those are never read into memory; the kernel copies them
+# from the page cache straight to the socket with os.sendfile(). (socket.sendfile() would do the same but refuses
+# non-blocking sockets, and everything on the selector loop is non-blocking.)
+#
+# Spool is for bodies too big to hold in memory at all: instead of reserve()ing room for the whole content-length, the
+# Message writes each chunk to a temporary file as it arrives and hands the handler a read only mmap of that file (or
+# the file object itself). Memory use stays at one RecvBuffer chunk however big the body is while it is received.
+# (pages of the mmap that get read count towards RSS, but they are page cache the kernel can drop again.)
+
+try:
+    # max number of buffers one sendmsg() call takes
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+# the most linux sends in one sendfile() call
+SENDFILE_MAX = 0x7FFFF000
+FILE_CHUNK = 65536  # read size where there is no os.sendfile (windows, libshm)
+
+
+class RecvBuffer:
+    def __init__(self, size=65536):
+        # size is the default chunk we allocate; the buffer grows to fit a whole payload once we know content-length
+        self._size = size
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        # unread data lives in self._buf[self._start:self._end]
+        self._start = 0
+        self._end = 0
+        # true when the last recv_into() got less than there was room for; on a stream socket that means it had
+        # nothing more for us right now (what an edge triggered reader needs to know, see epoll(7))
+        self.short_read = False
+
+    def __len__(self):
+        # number of bytes received but not consumed yet
+        return self._end - self._start
+
+    def reserve(self, nbytes):
+        # make sure nbytes of unread data can sit in one contiguous block starting at self._start
+        # this is called with content-length once the json header is parsed, so the whole payload is received in
+        # place and can be handed out as a single view
+        if self._start + nbytes <= len(self._buf):
+            return
+        pending = len(self)
+        # note we never move data around inside the current bytearray; views handed out by consume() may still be
+        # in use, so we allocate a new one and only copy the (small) unread tail over
+        buf = bytearray(max(nbytes, pending, self._size))
+        buf[:pending] = self._view[self._start:self._end]
+        self._buf = buf
+        self._view = memoryview(buf)
+        self._start = 0
+        self._end = pending
+
+    def recv_into(self, sock):
+        # receive as much as the socket has for us, straight into the free space at the end of the buffer
+        if self._end == len(self._buf):
+            self.reserve(len(self) + self._size)
+        room = len(self._buf) - self._end
+        nbytes = sock.recv_into(self._view[self._end:])
+        self._end += nbytes
+        self.short_read = nbytes < room
+        return nbytes
+
+    def extend(self, data):
+        # copy in data that didn't come from a socket (benchmarks, other transports)
+        self.reserve(len(self) + len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def peek(self, nbytes):
+        # view of the next nbytes without consuming them
+        return self._view[self._start:self._start + nbytes]
+
+    def consume(self, nbytes):
+        # view of the next nbytes; the bytes are now owned by the caller and the buffer moves past them
+        view = self._view[self._start:self._start + nbytes]
+        self._start += nbytes
+        return view
+
+
+class FileBody:
+    def __init__(self, file, offset=0, length=None, content_type="binary/file"):
+        # file: a path, or a file object opened in binary mode; either way the FileBody owns it from now on and closes
+        #   it once it has been sent
+        # offset/length: the byte range to send, by default from offset to the end of the file
+        if isinstance(file, (str, os.PathLike)):
+            file = open(file, "rb")
+        self._file = file
+        try:
+            size = os.fstat(file.fileno()).st_size
+            if length is None:
+                length = size - offset
+            if offset < 0 or length < 0 or offset + length > size:
+                raise ValueError(f"Invalid range {offset}+{length} for a file of {size} bytes.")
+        except BaseException:
+            file.close()
+            raise
+        self.content_type = content_type
+        self._offset = offset
+        self._remaining = length
+
+    def __len__(self):
+        # bytes still to be sent
+        return self._remaining
+
+    def send(self, sock):
+        count = min(self._remaining, SENDFILE_MAX)
+        if hasattr(os, "sendfile") and isinstance(sock, socket.socket):
+            # raises BlockingIOError when the socket buffer is full, like socket.send
+            # (only for real sockets; the shared memory transport (libshm) gets the file read into its ring below)
+            sent = os.sendfile(sock.fileno(), self._file.fileno(), self._offset, count)
+        else:
+            self._file.seek(self._offset)
+            sent = sock.send(self._file.read(min(count, FILE_CHUNK)))
+        if count and not sent:
+            # end of file before the end of the range
+            raise RuntimeError("File was truncated while it was being sent.")
+        self._offset += sent
+        self._remaining -= sent
+        return sent
+
+    def close(self):
+        self._file.close()
+
+
+class SendBuffer:
+    def __init__(self):
+        self._parts = deque()
+        # bytes of self._parts[0] that have already been sent (not used for a FileBody, it keeps its own offset)
+        self._offset = 0
+        self._len = 0
+        # the part of _len that is in memory, i.e. not in a FileBody
+        self.memory = 0
+
+    def __len__(self):
+        # number of bytes still to be sent
+        return self._len
+
+    def append(self, data):
+        # data (bytes, bytearray or memoryview) is not copied, so it must not be changed until it has been sent
+        # or a FileBody, which is sent with sendfile
+        if len(data):
+            self._parts.append(data)
+            self._len += len(data)
+            if not isinstance(data, FileBody):
+                self.memory += len(data)
+        elif isinstance(data, FileBody):
+            data.close()
+
+    def extend(self, parts):
+        for data in parts:
+            self.append(data)
+
+    def send(self, sock):
+        # one send()/sendmsg()/sendfile() call; returns the number of bytes sent (raises BlockingIOError like
+        # socket.send does)
+        first = self._parts[0]
+        if isinstance(first, FileBody):
+            sent = first.send(sock)
+            self._len -= sent
+            if not len(first):
+                first.close()
+                self._parts.popleft()
+            return sent
+        first = memoryview(first)[self._offset:]
+        # the in memory parts up to the next file
+        more = list(takewhile(lambda part: not isinstance(part, FileBody), islice(self._parts, 1, IOV_MAX)))
+        if more and hasattr(sock, "sendmsg"):
+            # windows sockets have no sendmsg, they send one part at a time below
+            sent = sock.sendmsg([first, *more])
+        else:
+            sent = sock.send(first)
+        self._advance(sent)
+        self.memory -= sent
+        return sent
+
+    def _advance(self, nbytes):
+        # drop the parts that have been sent completely and move the offset into the next one
+        self._len -= nbytes
+        nbytes += self._offset
+        while self._parts and nbytes >= len(self._parts[0]):
+            nbytes -= len(self._parts.popleft())
+        self._offset = nbytes
+
+    def close(self):
+        # closes the files that were never (completely) sent
+        for part in self._parts:
+            if isinstance(part, FileBody):
+                part.close()
+        self._parts.clear()
+        self._offset = self._len = self.memory = 0
+
+
+class Spool:
+    def __init__(self, length, dir=None):
+        # an anonymous temporary file (already deleted on posix), it goes away once the body is no longer used
+        self.file = tempfile.TemporaryFile(dir=dir)
+        self.remaining = length
+
+    def feed(self, recv_buffer):
+        # moves whatever part of the body has arrived from the receive buffer to the file; true once all of it is in
+        nbytes = min(len(recv_buffer), self.remaining)
+        if nbytes:
+            self.file.write(recv_buffer.consume(nbytes))
+            self.remaining -= nbytes
+        return not self.remaining
+
+    def body(self, as_file=False):
+        # the complete body: a read only mmap, which works anywhere bytes do (slicing, memoryview, json, zlib), or the
+        # file object rewound to the start
+        self.file.flush()
+        if as_file:
+            self.file.seek(0)
+            return self.file
+        view = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        # the mapping stays valid without the file
+        self.file.close()
+        return view
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,135 @@
+import json
+import time
+from collections import Counter, OrderedDict
+from types import SimpleNamespace
+
+from libheader import create_message_parts
+
+# response cache for the selector server
+# most of the search traffic asks for the same few keys over and over, and every one of those requests runs the
+# handler, json encodes the result (and compresses it) and frames it again. ResponseCache keeps the framed response of
+# a request so the next identical one is answered with the bytes we already have.
+#
+# the key is the action and the decoded request (json with sorted keys, so the order of the fields doesn't matter)
+# plus everything that changes the bytes on the wire: content-type, text encoding, the compression negotiated for the
+# connection and json vs binary header. Only requests for the actions listed in `actions` are cached, and only dict
+# requests that fit in json; file responses (libbuffer.FileBody) never are.
+#
+# the request-id is different for every request, so what is kept is the message framed without one. A request without
+# a request-id gets exactly those bytes; one with a request-id gets a new header (one struct.pack for a binary header)
+# in front of the cached content, which is still no handler, encoding or compression.
+#
+# entries go away when:
+#   - they are older than ttl seconds (checked when they are looked up)
+#   - there are more than max_entries of them or they add up to more than max_bytes; the least recently used go first
+#   - invalidate() is called, for one action or for everything (e.g. when the search corpus is reloaded)
+#
+# like libflow, the counters go in the host's stats Counter so the supervisor adds them up over the workers:
+#   cache-hits / cache-misses: lookups of cacheable requests
+#   cache-evictions / cache-expired: entries dropped for room / for their age
+#   cache-entries / cache-bytes: what is in the cache right now
+
+CACHE_ENTRIES = 10000
+CACHE_BYTES = 64 * 1024 * 1024
+CACHE_TTL = 60  # seconds
+# bigger responses aren't worth a slot; they would push out lots of small hot ones
+CACHE_ENTRY_BYTES = 1024 * 1024
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        actions,
+        max_entries=CACHE_ENTRIES,
+        max_bytes=CACHE_BYTES,
+        ttl=CACHE_TTL,
+        max_entry_bytes=CACHE_ENTRY_BYTES,
+        stats=None,
+    ):
+        # actions: the actions whose responses only depend on the request (not on time, the connection, ...)
+        # ttl: None to keep entries until they are evicted or invalidated
+        self.actions = set(actions)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.stats = Counter() if stats is None else stats
+        for name in ("cache-hits", "cache-misses", "cache-evictions", "cache-expired", "cache-entries", "cache-bytes"):
+            self.stats.setdefault(name, 0)
+        # key -> entry, least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, header, request, compression, binary_header):
+        # the cache key for a request, or None if it can't be cached
+        action = request.get("action") if isinstance(request, dict) else None
+        if action not in self.actions:
+            return None
+        try:
+            canonical = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        except (TypeError, ValueError):
+            # bytes from a binary/record request and such
+            return None
+        encoding = header["content-encoding"].partition("+")[0]
+        return action, header["content-type"], encoding, compression, binary_header, canonical
+
+    def get(self, key):
+        # the entry for key (response: the arguments for create_message_parts, message: the framed bytes without a
+        # request-id), or None
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry.created > self.ttl:
+            self._remove(key)
+            self.stats["cache-expired"] += 1
+            entry = None
+        if entry is None:
+            self.stats["cache-misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["cache-hits"] += 1
+        return entry
+
+    def put(self, key, response):
+        # response: content_bytes/content_type/content_encoding as the Message builds them; returns the entry, or None
+        # if the response is not cached
+        content_bytes = response["content_bytes"]
+        if not isinstance(content_bytes, (bytes, bytearray)) or len(content_bytes) > self.max_entry_bytes:
+            return None
+        binary_header = key[4]
+        message = b"".join(create_message_parts(**response, binary_header=binary_header))
+        # the content is kept as a view into the framed message rather than a second copy
+        content = memoryview(message)[len(message) - len(content_bytes):] if content_bytes else b""
+        entry = SimpleNamespace(
+            response=dict(response, content_bytes=content),
+            message=message,
+            created=time.monotonic(),
+        )
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._bytes += len(message)
+        self._update_sizes()
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.stats["cache-evictions"] += 1
+        return entry
+
+    def invalidate(self, action=None):
+        # drops the entries of one action, or all of them
+        if action is None:
+            self._entries.clear()
+            self._bytes = 0
+        else:
+            for key in [key for key in self._entries if key[0] == action]:
+                self._remove(key)
+        self._update_sizes()
+
+    def _remove(self, key):
+        self._bytes -= len(self._entries.pop(key).message)
+        self._update_sizes()
+
+    def _update_sizes(self):
+        self.stats["cache-entries"] = len(self._entries)
+        self.stats["cache-bytes"] = self._bytes
@@ -1,26 +1,121 @@
-import sys
 import selectors
 import json
-import io
+import socket
 import struct
 
+from libbuffer import Spool, RecvBuffer, SendBuffer
+from libcodec import (
+    ARRAY_CONTENT_TYPE,
+    COMPRESS_THRESHOLD,
+    choose_compression,
+    decode_content,
+    encode_content,
+    has_codec,
+)
+from libheader import BINARY_HEADER_FLAG, check_content_length, create_message_parts, unpack_binary_header
+from libtrace import hooks
+
 # message class for the client
 # very similar to the host version
 # a major difference is that the client waits for a response from the server and the final process methods process a
 # response rather than create one
 
+# addresses: a host name or ip and a port for tcp, or "unix:/path/to/socket" for the unix domain socket of a server on
+# the same machine (socket_app_host.UNIX_PATH; the port is ignored). Local clients skip the tcp/ip stack that way,
+# everything on top of the socket is the same
+UNIX_PREFIX = "unix:"
+
+
+def socket_address(host, port=None):
+    # (socket family, address to connect to)
+    if isinstance(host, str) and host.startswith(UNIX_PREFIX):
+        return socket.AF_UNIX, host[len(UNIX_PREFIX):]
+    return socket.AF_INET, (host, port)
+
+
+def start_connect(host, port=None, nodelay=False):
+    # a non-blocking socket that is connecting to host/port; the selector says it is writable once it is connected
+    # nodelay: turn off nagle (tcp only), for small pipelined requests
+    family, address = socket_address(host, port)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    if nodelay and family != socket.AF_UNIX:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect_ex(address)
+    return sock
+
+
+def connect(host, port=None, timeout=None):
+    # a connected blocking socket (with timeout) to host/port
+    family, address = socket_address(host, port)
+    if family != socket.AF_UNIX:
+        return socket.create_connection(address, timeout=timeout)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
 class Message:
-    def __init__(self, selector, sock, addr, request):
+    def __init__(
+        self,
+        selector,
+        sock,
+        addr,
+        request,
+        keep_alive=False,
+        pipeline=False,
+        header_format="json",
+        accept_encoding=None,
+        compress_threshold=COMPRESS_THRESHOLD,
+        spool_threshold=None,
+        spool_dir=None,
+        spool_as_file=False,
+    ):
         self.selector = selector
         self.sock = sock
         self.addr = addr
         self.request = request
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        # with keep-alive the connection is reused for every request added with add_request() before it is closed;
+        # the server has to be running with keep-alive as well
+        self.keep_alive = keep_alive or pipeline
+        self.pending_requests = []
+        # with pipelining every request is sent straight away with a "request-id" header instead of waiting for the
+        # previous response; the server echoes the id back so responses can be matched up in any order
+        self.pipeline = pipeline
+        self.in_flight = {}
+        self._next_request_id = 1
+        # header_format="binary" offers the server the compact binary header (see libheader); we only start sending
+        # binary headers ourselves once the server has answered with one
+        self.header_format = header_format
+        self._binary_header_accepted = False
+        self._binary_header = False
+        # accept_encoding lists the compressions (libcodec) we can read; the server answers with the ones it can read
+        # and from then on we compress requests of at least compress_threshold bytes too
+        self.accept_encoding = accept_encoding
+        self.compression = None
+        self.compress_threshold = compress_threshold
+        self._accept_encoding_acked = False
+        self._recv_buffer = RecvBuffer()
+        # responses of spool_threshold bytes or more go to a temporary file in spool_dir as they arrive, so large
+        # downloads don't need the memory (libbuffer.Spool); the response is then a read only mmap of it, or with
+        # spool_as_file the file object (only for content-types without a codec that aren't compressed)
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.spool_as_file = spool_as_file
+        self._spool = None
+        # the parts of the messages waiting to be sent (see libbuffer)
+        self._send_buffer = SendBuffer()
         self._request_queued = False
         self._jsonheader_len = None
         self.jsonheader = None
         self.response = None
+        if hooks.connection_opened is not None:
+            hooks.connection_opened(self)
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -37,63 +132,69 @@ class Message:
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            # recv_into writes straight into the preallocated buffer (see libbuffer)
+            nbytes = self._recv_buffer.recv_into(self.sock)
             # this is important that they catch a temporary error (BlockingIOError) but pass
             # by skpping it, select() will eventually call us again and give us another change to read/write the data
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not nbytes:
                 raise RuntimeError("Peer closed.")
 
     def _write(self):
         if self._send_buffer:
-            print("sending", repr(self._send_buffer), "to", self.addr)
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                # SendBuffer remembers how much of it went out, the count is only for the hooks (libtrace)
+                sent = self._send_buffer.send(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
+                if hooks.bytes_sent is not None:
+                    hooks.bytes_sent(self, sent)
 
     def _json_encode(self, obj, encoding):
         return json.dumps(obj, ensure_ascii=False).encode(encoding)
 
     def _json_decode(self, json_bytes, encoding):
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
+        return json.loads(str(json_bytes, encoding))
 
-    def _create_message(
-        self, *, content_bytes, content_type, content_encoding
-    ):
-        jsonheader = {
-            "byteorder": sys.byteorder,
-            "content-type": content_type,
-            "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
-        }
-        jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
-        message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
+    def _create_message(self, **kwargs):
+        # the framing lives in libheader so the asyncio version in libasync builds the same bytes
+        # returns the parts of the message (proto header, header, content) for the send buffer
+        return create_message_parts(**kwargs)
+
+    def _negotiation_headers(self):
+        # what we still need to offer the server; both go away once the server has answered them
+        headers = {}
+        if self.header_format != "json" and not self._binary_header_accepted:
+            headers["header-format"] = self.header_format
+        if self.accept_encoding and not self._accept_encoding_acked:
+            headers["accept-encoding"] = list(self.accept_encoding)
+        return headers
 
     def _process_response_json_content(self):
         content = self.response
         result = content.get("result")
         print(f"got result: {result}")
 
+    def _process_response_array_content(self):
+        # a libcodec.TypedArray; its first few items say enough
+        typed = self.response
+        print(f"got array: {typed.dtype} {typed.shape} {typed.data.cast(typed.typecode)[:5].tolist()}...")
+
     def _process_response_binary_content(self):
         content = self.response
-        print(f"got response: {repr(content)}")
+        if hasattr(content, "read"):
+            # spooled to disk (mmap or file); just show the start of it rather than pulling it all into memory
+            head = content.read(10)
+            content.seek(0)
+            print(f"got response: {repr(head)}... (spooled to disk)")
+        else:
+            print(f"got response: {repr(bytes(content))}")
 
     def process_events(self, mask):
         if mask & selectors.EVENT_READ:
@@ -104,22 +205,35 @@ class Message:
     def read(self):
         self._read()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
+        # when pipelining, one recv can hold several responses so keep going until there isn't a whole one left
+        while True:
+            if self._jsonheader_len is None:
+                self.process_protoheader()
+
+            if self._jsonheader_len is not None:
+                if self.jsonheader is None:
+                    self.process_jsonheader()
 
-        if self._jsonheader_len is not None:
-            if self.jsonheader is None:
-                self.process_jsonheader()
+            if self.jsonheader:
+                if self.response is None:
+                    self.process_response()
 
-        if self.jsonheader:
-            if self.response is None:
-                self.process_response()
+            if self.response is None or self.sock is None or not self.pipeline:
+                break
+            self._jsonheader_len = None
+            self.jsonheader = None
+            self.response = None
 
     def write(self):
         # very similar to the server version but checks to see if the created request is queued up
         # if not queued then we call queue_request()
         if not self._request_queued:
             self.queue_request()
+        if self.pipeline:
+            # put every waiting request on the wire without waiting for the responses
+            while self.pending_requests:
+                self.request = self.pending_requests.pop(0)
+                self.queue_request()
         # this will again call socket.send() if there is data in the buffer
         self._write()
 
@@ -129,7 +243,12 @@ class Message:
                 self._set_selector_events_mask("r")
 
     def close(self):
-        print("closing connection to", self.addr)
+        if hooks.connection_closed is not None:
+            hooks.connection_closed(self)
+        if self._spool is not None:
+            # the body never arrived completely
+            self._spool.close()
+            self._spool = None
         try:
             self.selector.unregister(self.sock)
         except Exception as e:
@@ -149,44 +268,83 @@ class Message:
             # Delete reference to socket object for garbage collection
             self.sock = None
 
+    def add_request(self, request):
+        # queue another request to be sent over this connection once the current response has been processed
+        # (or as soon as the socket is writable when pipelining)
+        self.pending_requests.append(request)
+        if self.pipeline and self._request_queued and self.sock is not None:
+            self._set_selector_events_mask("rw")
+
+    def _reset(self, request):
+        # clear the per response state and start sending the next request on the same socket
+        self.request = request
+        self._request_queued = False
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self.response = None
+        self._set_selector_events_mask("w")
+
     def queue_request(self):
         # formats the request in a test/json format or the original format and adds it ot the send buffer
 
         content = self.request["content"]
         content_type = self.request["type"]
-        content_encoding = self.request["encoding"]
-        if content_type == "text/json":
-            req = {
-                "content_bytes": self._json_encode(content, content_encoding),
-                "content_type": content_type,
-                "content_encoding": content_encoding,
-            }
-        else:
-            req = {
-                "content_bytes": content,
-                "content_type": content_type,
-                "content_encoding": content_encoding,
-            }
-        message = self._create_message(**req)
-        self._send_buffer += message
+        # the codec for the content-type (libcodec) turns it into bytes, raw content-types are sent as they are
+        content_bytes, content_encoding = encode_content(
+            content,
+            content_type,
+            self.request["encoding"],
+            compression=self.compression,
+            threshold=self.compress_threshold,
+        )
+        req = {
+            "content_bytes": content_bytes,
+            "content_type": content_type,
+            "content_encoding": content_encoding,
+        }
+        request_id = None
+        if self.pipeline:
+            request_id = self._next_request_id
+            self._next_request_id += 1
+            self.in_flight[request_id] = self.request
+        message = self._create_message(
+            **req,
+            request_id=request_id,
+            binary_header=self._binary_header_accepted,
+            extra_headers=self._negotiation_headers(),
+        )
+        self._send_buffer.extend(message)
         # onces the send buffer is filled the client will wait for the response from the server
         self._request_queued = True
 
+    def _should_spool(self, content_length):
+        return self.spool_threshold is not None and content_length >= max(self.spool_threshold, 1)
+
+    def _spooled_body(self, content_type, content_encoding):
+        # the codecs and the decompressors need the body as something bytes-like, so only raw bodies can be a file
+        as_file = self.spool_as_file and not has_codec(content_type) and "+" not in content_encoding
+        data = self._spool.body(as_file)
+        self._spool = None
+        return data
+
     def process_protoheader(self):
         hdrlen = 2
         if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
-            )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            value = struct.unpack(">H", self._recv_buffer.consume(hdrlen))[0]
+            self._binary_header = bool(value & BINARY_HEADER_FLAG)
+            self._jsonheader_len = value & ~BINARY_HEADER_FLAG
 
     def process_jsonheader(self):
         hdrlen = self._jsonheader_len
         if len(self._recv_buffer) >= hdrlen:
-            self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
-            )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            if self._binary_header:
+                self.jsonheader = unpack_binary_header(self._recv_buffer.consume(hdrlen))
+                # the server understands binary headers, use them from now on
+                self._binary_header_accepted = True
+            else:
+                self.jsonheader = self._json_decode(
+                    self._recv_buffer.consume(hdrlen), "utf-8"
+                )
             for reqhdr in (
                 "byteorder",
                 "content-length",
@@ -195,26 +353,55 @@ class Message:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f'Missing required header "{reqhdr}".')
+            # before anything is allocated for the content
+            check_content_length(self.jsonheader["content-length"])
+            if "accept-encoding" in self.jsonheader:
+                self.compression = choose_compression(self.jsonheader["accept-encoding"])
+                self._accept_encoding_acked = True
+            if self._should_spool(self.jsonheader["content-length"]):
+                self._spool = Spool(self.jsonheader["content-length"], self.spool_dir)
+            else:
+                self._recv_buffer.reserve(self.jsonheader["content-length"])
 
     def process_response(self):
         # this is where the two classes differ in that this processes a response rather than create one
         content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
+        content_type = self.jsonheader["content-type"]
+        if self._spool is not None:
+            if not self._spool.feed(self._recv_buffer):
+                return
+            data = self._spooled_body(content_type, self.jsonheader["content-encoding"])
+        elif not len(self._recv_buffer) >= content_len:
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
-        if self.jsonheader["content-type"] == "text/json":
-            encoding = self.jsonheader["content-encoding"]
-            self.response = self._json_decode(data, encoding)
-            print("received response", repr(self.response), "from", self.addr)
+        else:
+            # a memoryview into the receive buffer, no copy of the payload is made
+            data = self._recv_buffer.consume(content_len)
+        # decompress it and run it through the codec for the content-type (libcodec); only in a compression we offered
+        self.response = decode_content(
+            data,
+            content_type,
+            self.jsonheader["content-encoding"],
+            self.jsonheader["byteorder"],
+            accepted=self.accept_encoding or (),
+        )
+        if hooks.response_decoded is not None:
+            hooks.response_decoded(self, self.jsonheader, self.response)
+        if content_type == ARRAY_CONTENT_TYPE:
+            self._process_response_array_content()
+        elif has_codec(content_type):
             self._process_response_json_content()
         else:
             # Binary or unknown content-type
-            self.response = data
-            print(
-                f'received {self.jsonheader["content-type"]} response from',
-                self.addr,
-            )
             self._process_response_binary_content()
-        # Close when response has been processed
-        self.close()
\ No newline at end of file
+        # Close when response has been processed, unless there is another request for this connection
+        if self.pipeline:
+            # responses can come back in any order; match them up by request-id and close once all are answered
+            request_id = self.jsonheader.get("request-id")
+            if self.in_flight.pop(request_id, None) is None:
+                raise ValueError(f"Response for unknown request-id {repr(request_id)}.")
+            if not self.in_flight and not self.pending_requests:
+                self.close()
+        elif self.keep_alive and self.pending_requests:
+            self._reset(self.pending_requests.pop(0))
+        else:
+            self.close()
\ No newline at end of file
@@ -0,0 +1,361 @@
+import bz2
+import sys
+import gzip
+import json
+import lzma
+import math
+import zlib
+import array
+import struct
+
+# payload codecs and compression shared by libserver and libclient
+# before this the Message classes had an if/else on content-type == "text/json" everywhere; now a content-type maps to
+# an encode/decode pair in _codecs, and anything without a codec is passed through as raw bytes like before
+#
+# content-encoding keeps meaning what it did ("utf-8" for json, "binary" for raw bytes) but can have a compression
+# appended to it, e.g. "utf-8+zlib". Compression is negotiated:
+#   - a peer lists the compressions it can read in an "accept-encoding" header
+#   - the other side only compresses content that is at least COMPRESS_THRESHOLD bytes, with one from that list
+# and a receiver only decompresses what it offered (the accepted argument of decode_content), never more than
+# MAX_DECOMPRESSED_LENGTH bytes of it: a few hundred KB of zeros inflate to hundreds of MB, and everything that limits
+# how big a body can be (content-length checks, spooling, libflow) only sees the compressed size
+
+COMPRESS_THRESHOLD = 4096
+MAX_DECOMPRESSED_LENGTH = 64 * 1024 * 1024  # bytes; more than that is refused with ContentTooLarge
+
+_codecs = {}
+_compressions = {}
+
+
+def register_codec(content_type, encode, decode):
+    # encode(obj, encoding) -> bytes (or ContentParts) and decode(data, encoding, byteorder) -> obj; data may be a
+    # memoryview, byteorder is the sender's (the "byteorder" header), for codecs that send numbers in the sender's
+    # byte order
+    _codecs[content_type] = (encode, decode)
+
+
+class ContentParts:
+    # content that is several buffers one after the other, for an encoder whose output is mostly memory that already
+    # exists (the items of an array): libheader.create_message_parts puts the parts in the message as they are, so
+    # they go out with sendmsg (libbuffer.SendBuffer) without being copied into one bytes object first
+    # len() is the number of bytes, like for bytes; bytes() joins them, for whatever needs them in one piece
+    def __init__(self, *parts):
+        self.parts = parts
+        self._len = sum(len(part) for part in parts)
+
+    def __len__(self):
+        return self._len
+
+    def __bytes__(self):
+        return b"".join(self.parts)
+
+
+class ContentTooLarge(ValueError):
+    # the content would decompress to more than the limit; the body itself was read completely, so the connection is
+    # still in step and the request can be answered with an error
+    pass
+
+
+def register_compression(name, compress, decompressor):
+    # registration order is our order of preference when picking one the peer accepts
+    # compress(data) -> bytes; decompressor() -> a new object with decompress(data, max_length) and eof, like
+    # zlib.decompressobj(), bz2.BZ2Decompressor() and lzma.LZMADecompressor(), so the output can be capped
+    _compressions[name] = (compress, decompressor)
+
+
+def has_codec(content_type):
+    # content types with a codec decode to python objects (requests with an action), the rest stay raw bytes
+    return content_type in _codecs
+
+
+def compressions():
+    return list(_compressions)
+
+
+def choose_compression(accepted):
+    # first compression we support that the peer said it can read, or None
+    for name in _compressions:
+        if name in accepted:
+            return name
+    return None
+
+
+def encode_content(obj, content_type, encoding, compression=None, threshold=COMPRESS_THRESHOLD):
+    # returns (content_bytes, content_encoding); content_bytes can be ContentParts
+    codec = _codecs.get(content_type)
+    content_bytes = codec[0](obj, encoding) if codec else obj
+    if compression is not None and len(content_bytes) >= threshold:
+        # compressing copies it anyway
+        data = bytes(content_bytes) if isinstance(content_bytes, ContentParts) else content_bytes
+        compressed = _compressions[compression][0](data)
+        # not everything compresses (already compressed data), only use it if it is actually smaller
+        if len(compressed) < len(content_bytes):
+            return compressed, f"{encoding}+{compression}"
+    return content_bytes, encoding
+
+
+def decode_content(
+    data, content_type, content_encoding, byteorder=sys.byteorder, accepted=(), max_length=MAX_DECOMPRESSED_LENGTH
+):
+    # byteorder: the header's; accepted: the compressions we told the peer we can read (none unless we did)
+    encoding, _, compression = content_encoding.partition("+")
+    if compression:
+        if compression not in _compressions:
+            raise ValueError(f'Unsupported content-encoding "{content_encoding}".')
+        if compression not in accepted:
+            raise ValueError(f'Content-encoding "{content_encoding}" was never offered.')
+        data = _decompress(compression, data, max_length)
+    codec = _codecs.get(content_type)
+    return codec[1](data, encoding, byteorder) if codec else data
+
+
+def _decompress(compression, data, max_length):
+    # one byte more than allowed says it is too much, without inflating any further
+    decompressor = _compressions[compression][1]()
+    data = decompressor.decompress(data, max_length + 1)
+    if len(data) > max_length:
+        raise ContentTooLarge(f"Content decompresses to more than {max_length} bytes.")
+    if not decompressor.eof:
+        raise ValueError("Compressed content is truncated.")
+    return data
+
+
+def _json_encode(obj, encoding):
+    return json.dumps(obj, ensure_ascii=False).encode(encoding)
+
+
+def _json_decode(data, encoding, byteorder):
+    return json.loads(str(data, encoding))
+
+
+# compact binary record codec ("binary/record")
+# a tagged encoding of the same values json can hold plus bytes; every value is a 1 byte tag followed by its data,
+# numbers are fixed size and big-endian (network order), strings/bytes/lists/dicts are prefixed with a 4 byte length
+_INT = struct.Struct(">q")
+_FLOAT = struct.Struct(">d")
+_LEN = struct.Struct(">I")
+
+
+def _record_pack(obj, out):
+    if obj is None:
+        out += b"N"
+    elif obj is True:
+        out += b"T"
+    elif obj is False:
+        out += b"F"
+    elif isinstance(obj, int):
+        out += b"i"
+        out += _INT.pack(obj)
+    elif isinstance(obj, float):
+        out += b"d"
+        out += _FLOAT.pack(obj)
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        out += b"s"
+        out += _LEN.pack(len(data))
+        out += data
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        out += b"b"
+        out += _LEN.pack(len(obj))
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        out += b"l"
+        out += _LEN.pack(len(obj))
+        for item in obj:
+            _record_pack(item, out)
+    elif isinstance(obj, dict):
+        out += b"m"
+        out += _LEN.pack(len(obj))
+        for key, value in obj.items():
+            _record_pack(key, out)
+            _record_pack(value, out)
+    else:
+        raise ValueError(f"Can't encode {type(obj).__name__} as a binary record.")
+
+
+def _record_unpack(view, offset):
+    # returns (obj, offset of the next value)
+    tag = view[offset:offset + 1].tobytes()
+    offset += 1
+    if tag == b"N":
+        return None, offset
+    if tag == b"T":
+        return True, offset
+    if tag == b"F":
+        return False, offset
+    if tag == b"i":
+        return _INT.unpack_from(view, offset)[0], offset + _INT.size
+    if tag == b"d":
+        return _FLOAT.unpack_from(view, offset)[0], offset + _FLOAT.size
+    length = _LEN.unpack_from(view, offset)[0]
+    offset += _LEN.size
+    if tag == b"s":
+        return str(view[offset:offset + length], "utf-8"), offset + length
+    if tag == b"b":
+        return view[offset:offset + length].tobytes(), offset + length
+    if tag == b"l":
+        items = []
+        for _ in range(length):
+            item, offset = _record_unpack(view, offset)
+            items.append(item)
+        return items, offset
+    if tag == b"m":
+        obj = {}
+        for _ in range(length):
+            key, offset = _record_unpack(view, offset)
+            obj[key], offset = _record_unpack(view, offset)
+        return obj, offset
+    raise ValueError(f"Invalid binary record tag {repr(tag)}.")
+
+
+def _record_encode(obj, encoding):
+    out = bytearray()
+    _record_pack(obj, out)
+    return bytes(out)
+
+
+def _record_decode(data, encoding, byteorder):
+    view = memoryview(data)
+    obj, offset = _record_unpack(view, 0)
+    if offset != len(view):
+        raise ValueError("Trailing data after binary record.")
+    return obj
+
+
+# typed numeric arrays ("binary/array")
+# sensor vectors and the like used to be sent as json lists of floats, a float -> text -> float round trip per item.
+# This sends the items as they are in memory instead: a short header (dtype, number of dimensions, the shape, all
+# big-endian like binary/record) and then the raw items in the sender's byte order, which the message header's
+# "byteorder" says. Decoding makes a TypedArray over the receive buffer without copying the items; only when the
+# sender's byte order isn't ours are they copied once, to swap their bytes.
+ARRAY_CONTENT_TYPE = "binary/array"
+# numpy style dtypes: kind (i: signed, u: unsigned, f: float) and item size in bytes
+DTYPES = ("i1", "u1", "i2", "u2", "i4", "u4", "i8", "u8", "f4", "f8")
+# dtype, number of dimensions; a _DIM per dimension follows
+_ARRAY_HEADER = struct.Struct(">2sB")
+_DIM = struct.Struct(">Q")
+# the items start at a multiple of this into the content, so they are aligned whenever the content is
+ARRAY_ALIGN = 8
+
+
+def _array_typecodes():
+    # dtype -> the array/struct typecode with that item size on this machine, and every typecode -> its dtype
+    typecodes, dtypes = {}, {}
+    for typecode in "bBhHiIlLqQfd":
+        kind = "f" if typecode in "fd" else "i" if typecode.islower() else "u"
+        dtype = f"{kind}{array.array(typecode).itemsize}"
+        typecodes.setdefault(dtype, typecode)
+        dtypes[typecode] = dtype
+    return typecodes, dtypes
+
+
+_typecodes, _dtypes = _array_typecodes()
+
+
+class TypedArray:
+    # what binary/array content decodes to, and one way to send an array (encode_content also takes an array.array, a
+    # typed memoryview or a numpy array as they are)
+    # data: the items, flat, in this machine's byte order; dtype: one of DTYPES; shape: a tuple, by default 1-D
+    def __init__(self, data, dtype, shape=None):
+        if dtype not in _typecodes:
+            raise ValueError(f'Unsupported array dtype "{dtype}".')
+        self.dtype = dtype
+        self.data = memoryview(data).cast("B")
+        if shape is None:
+            shape = (len(self.data) // self.itemsize,)
+        self.shape = tuple(shape)
+        if math.prod(self.shape) * self.itemsize != len(self.data):
+            raise ValueError(f"{len(self.data)} bytes is not a {dtype} array of shape {self.shape}.")
+
+    @property
+    def itemsize(self):
+        return int(self.dtype[1:])
+
+    @property
+    def typecode(self):
+        # for array.array and memoryview.cast
+        return _typecodes[self.dtype]
+
+    def __len__(self):
+        return self.shape[0] if self.shape else 1
+
+    def __repr__(self):
+        return f"TypedArray({self.dtype}, shape={self.shape})"
+
+    def view(self):
+        # the items as a memoryview with the dtype and shape (view[i][j], .tolist()); no copy
+        if 0 in self.shape:
+            # memoryview can't have a zero in its shape, an empty flat view will have to do
+            return self.data.cast(self.typecode)
+        return self.data.cast(self.typecode, self.shape)
+
+    def numpy(self):
+        # the items as a numpy array (read only, like the buffer it is on); no copy
+        import numpy
+
+        return numpy.frombuffer(self.data, dtype=self.dtype).reshape(self.shape)
+
+    def array(self):
+        # the items, flat, as an array.array; an array.array always owns its items, so this one is a copy
+        items = array.array(self.typecode)
+        items.frombytes(self.data)
+        return items
+
+    @classmethod
+    def of(cls, obj):
+        # a TypedArray for a numpy array, an array.array or any typed buffer (memoryview.cast), sharing its memory
+        # where that's possible
+        if isinstance(obj, cls):
+            return obj
+        if hasattr(obj, "dtype") and hasattr(obj, "shape"):
+            # numpy, without importing it
+            dtype = f"{obj.dtype.kind}{obj.dtype.itemsize}"
+            if obj.dtype.byteorder not in "=|" and obj.dtype.byteorder != ("<" if sys.byteorder == "little" else ">"):
+                # stored in the other byte order, the items are sent in ours
+                obj = obj.byteswap().view(obj.dtype.newbyteorder())
+            if not obj.flags.c_contiguous:
+                return cls(obj.tobytes(), dtype, obj.shape)
+            return cls(obj, dtype, obj.shape)
+        view = memoryview(obj)
+        dtype = _dtypes.get(view.format.lstrip("@"))
+        if dtype is None:
+            raise ValueError(f'Can\'t send a buffer of format "{view.format}" as an array.')
+        if not view.c_contiguous:
+            return cls(view.tobytes(), dtype, view.shape)
+        return cls(view, dtype, view.shape)
+
+
+def _array_encode(obj, encoding):
+    typed = TypedArray.of(obj)
+    header = _ARRAY_HEADER.pack(typed.dtype.encode("ascii"), len(typed.shape))
+    header += b"".join(_DIM.pack(n) for n in typed.shape)
+    header += bytes(-len(header) % ARRAY_ALIGN)
+    # the items are sent from the array's own memory
+    return ContentParts(header, typed.data)
+
+
+def _array_decode(data, encoding, byteorder):
+    view = memoryview(data)
+    dtype, ndim = _ARRAY_HEADER.unpack_from(view, 0)
+    dtype = dtype.decode("ascii", "replace")
+    offset = _ARRAY_HEADER.size + ndim * _DIM.size
+    shape = struct.unpack_from(f">{ndim}Q", view, _ARRAY_HEADER.size)
+    offset += -offset % ARRAY_ALIGN
+    typed = TypedArray(view[offset:], dtype, shape)
+    if byteorder != sys.byteorder and typed.itemsize > 1:
+        # the one case where the items are copied
+        swapped = typed.array()
+        swapped.byteswap()
+        typed.data = memoryview(swapped).cast("B")
+    return typed
+
+
+register_codec("text/json", _json_encode, _json_decode)
+register_codec("binary/record", _record_encode, _record_decode)
+register_codec(ARRAY_CONTENT_TYPE, _array_encode, _array_decode)
+
+register_compression("zlib", zlib.compress, zlib.decompressobj)
+# wbits 16 + MAX_WBITS: a gzip header and trailer around the deflate data
+register_compression("gzip", gzip.compress, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+register_compression("bz2", bz2.compress, bz2.BZ2Decompressor)
+register_compression("lzma", lzma.compress, lzma.LZMADecompressor)
@@ -0,0 +1,121 @@
+import time
+import socket
+import selectors
+import traceback
+from functools import partial
+from collections import Counter, defaultdict, deque
+
+from libserver import handle_request, search_engine
+
+# runs slow request handlers on a thread or process pool so they don't stall the selector loop
+# libserver.Message handles requests inline inside process_events(), so one slow handler holds up every other
+# connection on the selector. For the actions listed in limits, Message.create_response() calls submit() instead and
+# the handler runs on the pool.
+#
+# getting the result back to the loop: the pool's done callback runs on another thread, and the Message/selector are
+# not thread safe, so the callback only appends the result to a deque and writes a byte to a socketpair (the "self-pipe"
+# trick; a socketpair rather than os.pipe/eventfd so it works with select() on windows too). The read end is registered
+# with the selector, so the loop wakes up and process_events() hands the results to Message.complete_job().
+
+
+class HandlerExecutor:
+    def __init__(self, selector, executor, limits, metrics=None):
+        # executor: a concurrent.futures ThreadPoolExecutor or ProcessPoolExecutor (handlers and requests need to be
+        #   picklable for a process pool)
+        # limits: action -> max number of its handlers running at once, None for no limit; only these actions are
+        #   offloaded, everything else is still handled inline
+        self.selector = selector
+        self.executor = executor
+        self.limits = dict(limits)
+        # optional libmetrics.Metrics; gets the time each handler took (from when it was handed to the pool)
+        self.metrics = metrics
+        self.addr = "executor"
+        self._running = Counter()
+        self._waiting = defaultdict(deque)
+        # (action, message, header, request, generation, seconds it took, future) appended by the pool threads, popped
+        # by the loop
+        self._done = deque()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        selector.register(self._wakeup_recv, selectors.EVENT_READ, data=self)
+
+    def offloads(self, action):
+        return action in self.limits
+
+    def submit(self, message, header, request):
+        action = request.get("action")
+        limit = self.limits[action]
+        # the search index the request was made against; if a reload swaps in a new one before the result is back,
+        # complete_job() must not cache it (the reload has already invalidated the cache)
+        generation = search_engine.generation
+        if limit is not None and self._running[action] >= limit:
+            # over the per action limit; wait for one of the running ones to finish
+            self._waiting[action].append((message, header, request, generation))
+        else:
+            self._start(action, message, header, request, generation)
+
+    def _start(self, action, message, header, request, generation):
+        self._running[action] += 1
+        future = self.executor.submit(handle_request, request)
+        future.add_done_callback(
+            partial(self._on_done, action, message, header, request, generation, time.perf_counter())
+        )
+
+    def _on_done(self, action, message, header, request, generation, started, future):
+        # runs on a pool thread (or the process pool's management thread), so don't touch the message here
+        self._done.append((action, message, header, request, generation, time.perf_counter() - started, future))
+        try:
+            self._wakeup_send.send(b"\0")
+        except BlockingIOError:
+            # the socket buffer is full of wakeups the loop hasn't read yet, one more wouldn't change anything
+            pass
+
+    def process_events(self, mask):
+        # drain the wakeups first: anything finishing after this sends a new one, so no result is left behind
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._done:
+            action, message, header, request, generation, seconds, future = self._done.popleft()
+            self._running[action] -= 1
+            if self.metrics is not None:
+                self.metrics.handler_time(action, seconds)
+            self._start_waiting(action)
+            try:
+                content = future.result()
+            except Exception as e:
+                # the client is still waiting for an answer, give it an error result like the asyncio server does
+                content = {"result": f"Error: {repr(e)}"}
+                # and don't let the Message cache it (it caches by request)
+                request = None
+            try:
+                message.complete_job(header, content, request, generation)
+            except Exception:
+                print(
+                    "main: error: exception for",
+                    f"{message.addr}:\n{traceback.format_exc()}",
+                )
+                message.close()
+
+    def _start_waiting(self, action):
+        waiting = self._waiting[action]
+        while waiting:
+            message, header, request, generation = waiting.popleft()
+            if message.sock is None:
+                # the client went away while this was waiting, don't bother running it
+                message.complete_job(header, None)
+                continue
+            self._start(action, message, header, request, generation)
+            return
+
+    def close(self):
+        try:
+            self.selector.unregister(self._wakeup_recv)
+        except (KeyError, ValueError):
+            pass
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
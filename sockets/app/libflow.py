@@ -0,0 +1,59 @@
+from collections import Counter
+
+# backpressure for the selector server
+# a pipelining client can keep sending requests without reading the responses; the server keeps answering them and the
+# responses pile up in the connection's send buffer. With a few clients like that the server runs out of memory.
+#
+# every Message of a host shares one FlowControl:
+#   - high_water/low_water (bytes, per connection): a connection stops reading requests once its send buffer reaches
+#     high_water and starts again when it has drained to low_water
+#   - budget (bytes, all connections together): while the send buffers add up to more than this, any connection that
+#     queues a response stops reading as well; it starts again once its own send buffer is empty (or the total is back
+#     under budget and it is below low_water). So a stalled client only ever holds on to its own bytes and everyone
+#     else gets to go one response at a time until there is room again.
+#
+# the counters go in the host's stats Counter, so socket_app_host.py's supervisor adds them up over the workers:
+#   buffered-bytes: bytes in all send buffers right now (in memory; files sent with sendfile don't count)
+#   paused: connections not reading right now
+#   pauses / budget-pauses: how often a connection was paused (budget-pauses: because of the budget)
+
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+BUDGET = 64 * 1024 * 1024
+
+
+class FlowControl:
+    def __init__(self, high_water=HIGH_WATER, low_water=LOW_WATER, budget=BUDGET, stats=None):
+        if not 0 <= low_water < high_water:
+            raise ValueError("low_water must be below high_water.")
+        self.high_water = high_water
+        self.low_water = low_water
+        self.budget = budget
+        self.stats = Counter() if stats is None else stats
+        for name in ("buffered-bytes", "paused", "pauses", "budget-pauses"):
+            self.stats.setdefault(name, 0)
+
+    def over_budget(self):
+        return self.budget is not None and self.stats["buffered-bytes"] > self.budget
+
+    def queued(self, nbytes):
+        self.stats["buffered-bytes"] += nbytes
+
+    def sent(self, nbytes):
+        self.stats["buffered-bytes"] -= nbytes
+
+    def should_pause(self, buffered):
+        # buffered: bytes in the connection's own send buffer
+        return buffered >= self.high_water or self.over_budget()
+
+    def can_resume(self, buffered):
+        return not buffered or (buffered <= self.low_water and not self.over_budget())
+
+    def paused(self, buffered):
+        self.stats["paused"] += 1
+        self.stats["pauses"] += 1
+        if buffered < self.high_water:
+            self.stats["budget-pauses"] += 1
+
+    def resumed(self):
+        self.stats["paused"] -= 1
@@ -0,0 +1,168 @@
+import sys
+import json
+import struct
+
+# compact binary header, the alternative to the json header
+# for small requests like search the json header (json.dumps on the way out, json decode on the way in) costs more than
+# the content itself, so a client can ask for a fixed layout header packed with struct instead
+#
+# the 2-byte proto header still comes first; when its top bit (BINARY_HEADER_FLAG) is set the rest of the value is the
+# length of a binary header rather than a json header. json headers are therefore limited to 32767 bytes.
+#
+# negotiation (so old clients and old servers keep working):
+#   - a client that can read binary headers adds "header-format": "binary" to its json header
+#   - a server that understands that answers with a binary header; an old server ignores it and answers with json
+#   - once the client has seen a binary header back it sends binary headers itself for the rest of the connection
+#
+# content-type, content-encoding and byteorder are sent as 1 byte codes (indexes into the tables below). Only add to the
+# end of the tables, the codes are part of the wire format. Anything not in a table is sent with a json header instead.
+
+BINARY_HEADER_FLAG = 0x8000
+MAX_JSON_HEADER_LEN = BINARY_HEADER_FLAG - 1
+# the 2-byte proto header
+PROTO_HEADER = struct.Struct(">H")
+REQUIRED_HEADERS = ("byteorder", "content-length", "content-type", "content-encoding")
+# the biggest content-length we take from a peer; the receive buffer (or spool file) is sized from it before any of the
+# content has arrived, so without a limit one header could make us allocate whatever it likes
+MAX_CONTENT_LENGTH = 256 * 1024 * 1024
+
+# byteorder, content-type, content-encoding, flags, content-length, request-id
+BINARY_HEADER = struct.Struct(">BBBBQQ")
+# flags
+HAS_REQUEST_ID = 0x01
+
+BYTEORDERS = ("little", "big")
+CONTENT_TYPES = (
+    "text/json",
+    "binary/custom-client-binary-type",
+    "binary/custom-server-binary-type",
+    "binary/record",
+    # file responses (libbuffer.FileBody)
+    "binary/file",
+    # typed numeric arrays (libcodec)
+    "binary/array",
+)
+CONTENT_ENCODINGS = (
+    "utf-8",
+    "binary",
+    # compressed content (libcodec)
+    "utf-8+zlib",
+    "utf-8+gzip",
+    "utf-8+bz2",
+    "utf-8+lzma",
+    "binary+zlib",
+    "binary+gzip",
+    "binary+bz2",
+    "binary+lzma",
+)
+
+_byteorder_codes = {name: code for code, name in enumerate(BYTEORDERS)}
+_content_type_codes = {name: code for code, name in enumerate(CONTENT_TYPES)}
+_content_encoding_codes = {name: code for code, name in enumerate(CONTENT_ENCODINGS)}
+
+
+def pack_binary_header(content_type, content_encoding, content_length, request_id=None):
+    # returns None when something can't be expressed in the binary layout; the caller then uses a json header
+    content_type_code = _content_type_codes.get(content_type)
+    content_encoding_code = _content_encoding_codes.get(content_encoding)
+    if content_type_code is None or content_encoding_code is None:
+        return None
+    flags = 0
+    if request_id is not None:
+        if not isinstance(request_id, int) or not 0 <= request_id < 1 << 64:
+            return None
+        flags |= HAS_REQUEST_ID
+    return BINARY_HEADER.pack(
+        _byteorder_codes[sys.byteorder],
+        content_type_code,
+        content_encoding_code,
+        flags,
+        content_length,
+        request_id or 0,
+    )
+
+
+def unpack_binary_header(header_bytes):
+    # turns a binary header back into the same dict a json header would have given us
+    if len(header_bytes) != BINARY_HEADER.size:
+        raise ValueError(f"Invalid binary header length {len(header_bytes)}.")
+    byteorder, content_type, content_encoding, flags, content_length, request_id = BINARY_HEADER.unpack(
+        header_bytes
+    )
+    try:
+        header = {
+            "byteorder": BYTEORDERS[byteorder],
+            "content-type": CONTENT_TYPES[content_type],
+            "content-encoding": CONTENT_ENCODINGS[content_encoding],
+            "content-length": content_length,
+            # whoever sent a binary header can obviously read one back
+            "header-format": "binary",
+        }
+    except IndexError:
+        raise ValueError("Unknown code in binary header.") from None
+    if flags & HAS_REQUEST_ID:
+        header["request-id"] = request_id
+    return header
+
+
+def create_message(**kwargs):
+    # proto header + header + content as one bytes object, for blocking sockets and asyncio streams
+    return b"".join(create_message_parts(**kwargs))
+
+
+def create_message_parts(
+    *, content_bytes, content_type, content_encoding, request_id=None, binary_header=False, extra_headers=None
+):
+    # (proto header, header, content) without joining them, so a large content isn't copied just to put a few header
+    # bytes in front of it; the Message classes send the parts with sendmsg (libbuffer.SendBuffer)
+    # used by the Message classes, libasync and libpool so they all frame the same way
+    # binary_header: use the compact struct header if the content-type/encoding allow it
+    # extra_headers only fit in a json header, so they force one
+    # content_bytes made of several parts (libcodec.ContentParts) adds them all, in place of the one content part
+    content_parts = getattr(content_bytes, "parts", (content_bytes,))
+    if binary_header and not extra_headers:
+        header_bytes = pack_binary_header(content_type, content_encoding, len(content_bytes), request_id)
+        if header_bytes is not None:
+            return PROTO_HEADER.pack(BINARY_HEADER_FLAG | len(header_bytes)), header_bytes, *content_parts
+    jsonheader = {
+        "byteorder": sys.byteorder,
+        "content-type": content_type,
+        "content-encoding": content_encoding,
+        "content-length": len(content_bytes),
+    }
+    # optional; only there when the client is pipelining requests
+    if request_id is not None:
+        jsonheader["request-id"] = request_id
+    if extra_headers:
+        jsonheader.update(extra_headers)
+    jsonheader_bytes = json.dumps(jsonheader, ensure_ascii=False).encode("utf-8")
+    if len(jsonheader_bytes) > MAX_JSON_HEADER_LEN:
+        raise ValueError("Json header too long.")
+    return PROTO_HEADER.pack(len(jsonheader_bytes)), jsonheader_bytes, *content_parts
+
+
+def split_proto_header(value):
+    # returns (header length, is it a binary header)
+    return value & ~BINARY_HEADER_FLAG, bool(value & BINARY_HEADER_FLAG)
+
+
+def decode_header(header_bytes, binary_header):
+    # json or binary header -> dict, checked for the headers every message needs
+    if binary_header:
+        header = unpack_binary_header(header_bytes)
+    else:
+        header = json.loads(str(header_bytes, "utf-8"))
+    for reqhdr in REQUIRED_HEADERS:
+        if reqhdr not in header:
+            raise ValueError(f'Missing required header "{reqhdr}".')
+    check_content_length(header["content-length"])
+    return header
+
+
+def check_content_length(content_length, max_length=MAX_CONTENT_LENGTH):
+    # raises ValueError unless content_length (from a peer's header) is a whole number of bytes we are willing to take
+    # a negative one would make RecvBuffer.consume() hand out bytes it already handed out
+    if not isinstance(content_length, int) or isinstance(content_length, bool):
+        raise ValueError(f"Invalid content-length {content_length!r}.")
+    if not 0 <= content_length <= max_length:
+        raise ValueError(f"Content-length {content_length} is out of range (0 to {max_length}).")
@@ -0,0 +1,263 @@
+import os
+import time
+import errno
+import socket
+import selectors
+from bisect import bisect_left
+from collections import Counter
+
+# runtime metrics for the selector server
+# the host already keeps a stats Counter (connections, requests, and the libflow/libcache counters) that the workers
+# send to the supervisor; Metrics adds what a Counter can't hold and puts it all in one snapshot:
+#   - counters: the stats Counter as is. Message adds active-connections, bytes-in and bytes-out to it, and
+#     action-requests:<action> for every request (the action is "other" for actions there is no handler for, so a
+#     client can't make up new series)
+#   - rates: connections (accepts), requests, bytes-in and bytes-out per second, over the last RATE_INTERVAL
+#   - histograms: handler-seconds per action (the handler run inline, or on the executor's pool for offloaded actions;
+#     cache hits don't run it) and loop-seconds, the time one selector loop iteration spent working (not waiting in
+#     select), which is how long every other connection had to wait; accept-seconds, how long new connections sat in
+#     the listening socket's backlog before we accepted them (where the kernel tells us, see socket_app_host)
+#
+# snapshots of several workers add up with merge(); prometheus_text() turns one into the prometheus text format, which
+# the host writes to a file (for node_exporter's textfile collector and the like) and/or serves over http with
+# MetricsEndpoint. The "stats" action returns the snapshot of the worker that answers it.
+
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+RATE_INTERVAL = 1.0  # seconds
+PREFIX = "socket_app"
+# counters that go up and down; the rest only go up. Gauges of a worker that has exited no longer count.
+GAUGES = {"active-connections", "paused", "buffered-bytes", "cache-entries", "cache-bytes"}
+_RATES = ("connections", "requests", "bytes-in", "bytes-out")
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # counts[i]: observations in (buckets[i - 1], buckets[i]]; the extra last one is everything above the top
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {"counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+
+class Metrics:
+    def __init__(self, stats=None, buckets=LATENCY_BUCKETS):
+        self.stats = Counter() if stats is None else stats
+        for name in ("active-connections", "bytes-in", "bytes-out"):
+            self.stats.setdefault(name, 0)
+        self.buckets = buckets
+        self.handler_seconds = {}
+        self.loop_seconds = Histogram(buckets)
+        self.accept_seconds = Histogram(buckets)
+        self.rates = {name: 0.0 for name in _RATES}
+        self._rate_time = time.monotonic()
+        self._rate_base = [self.stats[name] for name in _RATES]
+
+    def request(self, action):
+        self.stats[f"action-requests:{action}"] += 1
+
+    def handler_time(self, action, seconds):
+        histogram = self.handler_seconds.get(action)
+        if histogram is None:
+            histogram = self.handler_seconds[action] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    def accept_time(self, seconds):
+        self.accept_seconds.observe(seconds)
+
+    def loop_time(self, seconds):
+        # once per loop iteration; also where the rates are brought up to date
+        self.loop_seconds.observe(seconds)
+        now = time.monotonic()
+        if now - self._rate_time >= RATE_INTERVAL:
+            counts = [self.stats[name] for name in _RATES]
+            for name, count, base in zip(_RATES, counts, self._rate_base):
+                self.rates[name] = (count - base) / (now - self._rate_time)
+            self._rate_time, self._rate_base = now, counts
+
+    def snapshot(self):
+        # plain json-able data
+        return {
+            "counters": dict(self.stats),
+            "rates": dict(self.rates),
+            "histograms": {
+                "handler-seconds": {
+                    "label": "action",
+                    "buckets": list(self.buckets),
+                    "series": {action: h.snapshot() for action, h in self.handler_seconds.items()},
+                },
+                "loop-seconds": {
+                    "label": None,
+                    "buckets": list(self.buckets),
+                    "series": {"": self.loop_seconds.snapshot()},
+                },
+                "accept-seconds": {
+                    "label": None,
+                    "buckets": list(self.buckets),
+                    "series": {"": self.accept_seconds.snapshot()},
+                },
+            },
+        }
+
+
+def merge(snapshots):
+    # adds up the snapshots of several workers
+    counters = Counter()
+    rates = Counter()
+    histograms = {}
+    for snapshot in snapshots:
+        counters.update(snapshot.get("counters", {}))
+        rates.update(snapshot.get("rates", {}))
+        for name, histogram in snapshot.get("histograms", {}).items():
+            merged = histograms.setdefault(
+                name, {"label": histogram["label"], "buckets": histogram["buckets"], "series": {}}
+            )
+            for label, series in histogram["series"].items():
+                total = merged["series"].setdefault(
+                    label, {"counts": [0] * len(series["counts"]), "sum": 0.0, "count": 0}
+                )
+                total["counts"] = [a + b for a, b in zip(total["counts"], series["counts"])]
+                total["sum"] += series["sum"]
+                total["count"] += series["count"]
+    return {"counters": dict(counters), "rates": dict(rates), "histograms": histograms}
+
+
+def drop_gauges(snapshot):
+    # what is left of a worker that has exited: its counters and histograms still count, its gauges and rates don't
+    counters = {name: value for name, value in snapshot.get("counters", {}).items() if name not in GAUGES}
+    return {"counters": counters, "rates": {}, "histograms": snapshot.get("histograms", {})}
+
+
+def _metric_name(name):
+    return f"{PREFIX}_{name.replace('-', '_')}"
+
+
+def _label(name, value):
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{name}="{value}"'
+
+
+def prometheus_text(snapshot):
+    lines = []
+    families = {}
+    for key, value in sorted(snapshot["counters"].items()):
+        # action-requests:search -> socket_app_action_requests_total{action="search"}
+        name, _, label = key.partition(":")
+        families.setdefault(name, []).append((label, value))
+    for name, samples in families.items():
+        gauge = name in GAUGES
+        metric = _metric_name(name) + ("" if gauge else "_total")
+        lines.append(f"# TYPE {metric} {'gauge' if gauge else 'counter'}")
+        for label, value in samples:
+            labels = "{" + _label("action", label) + "}" if label else ""
+            lines.append(f"{metric}{labels} {value}")
+    for name, histogram in sorted(snapshot["histograms"].items()):
+        metric = _metric_name(name)
+        lines.append(f"# TYPE {metric} histogram")
+        bounds = [repr(float(bound)) for bound in histogram["buckets"]] + ["+Inf"]
+        for label, series in sorted(histogram["series"].items()):
+            labels = [_label(histogram["label"], label)] if histogram["label"] else []
+            cumulative = 0
+            for bound, count in zip(bounds, series["counts"]):
+                cumulative += count
+                lines.append(f"{metric}_bucket{{{','.join(labels + [_label('le', bound)])}}} {cumulative}")
+            suffix = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{metric}_sum{suffix} {series['sum']}")
+            lines.append(f"{metric}_count{suffix} {series['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, snapshot):
+    # written to a temporary file and renamed over the old one, so a reader never sees half a file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(prometheus_text(snapshot))
+    os.replace(tmp_path, path)
+
+
+class MetricsEndpoint:
+    # a minimal http server on the selector loop for prometheus to scrape: every request, whatever the path, gets the
+    # current prometheus text back and the connection is closed
+    def __init__(self, selector, host, port, snapshot):
+        # snapshot: called for the snapshot to serve
+        self.selector = selector
+        self.snapshot = snapshot
+        self.addr = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.addr)
+        self.sock.listen()
+        self.sock.setblocking(False)
+        selector.register(self.sock, selectors.EVENT_READ, data=self)
+        print("serving metrics on", self.addr)
+
+    def process_events(self, mask):
+        # the same accept() errors as socket_app_host.accept_wrapper; none of them is a reason to stop serving metrics
+        try:
+            conn, addr = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            # a spurious wakeup, the backlog is empty
+            return
+        except ConnectionAbortedError:
+            # the scraper gave up while it was waiting in the backlog
+            return
+        except OSError as e:
+            if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                # out of file descriptors (or memory); the scrape stays in the backlog until some are freed up
+                print("error: metrics accept() failed:", repr(e))
+                return
+            raise
+        conn.setblocking(False)
+        self.selector.register(conn, selectors.EVENT_READ, data=_MetricsConnection(self, conn, addr))
+
+    def close(self):
+        try:
+            self.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
+
+
+class _MetricsConnection:
+    def __init__(self, endpoint, sock, addr):
+        self.endpoint = endpoint
+        self.sock = sock
+        self.addr = addr
+        self._request = b""
+        self._response = None
+
+    def process_events(self, mask):
+        if mask & selectors.EVENT_READ:
+            data = self.sock.recv(4096)
+            self._request += data
+            if not data or b"\r\n\r\n" in self._request or len(self._request) > 65536:
+                # the request (headers) is in, or the client gave up; answer whatever it asked
+                body = prometheus_text(self.endpoint.snapshot()).encode("utf-8")
+                self._response = (
+                    b"HTTP/1.0 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
+                    + body
+                )
+                self.endpoint.selector.modify(self.sock, selectors.EVENT_WRITE, data=self)
+        elif mask & selectors.EVENT_WRITE:
+            sent = self.sock.send(self._response)
+            self._response = self._response[sent:]
+            if not self._response:
+                self.close()
+
+    def close(self):
+        try:
+            self.endpoint.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
@@ -0,0 +1,317 @@
+import time
+import select
+import threading
+from types import SimpleNamespace
+
+from libbuffer import RecvBuffer
+from libclient import connect
+from libcodec import COMPRESS_THRESHOLD, choose_compression, decode_content, encode_content
+from libheader import PROTO_HEADER, create_message, decode_header, split_proto_header
+
+# synchronous client with a pool of persistent connections
+# socket_app_client.py opens a new socket and runs its own select() loop for every batch of requests; scripts doing
+# thousands of lookups pay the connection setup every time. ConnectionPool keeps up to max_connections keep-alive
+# connections per (host, port) around and hands them out to callers one at a time, so any number of threads can use
+# call()/call_many() at once. The sockets are blocking with timeouts, there is no selector loop here.
+
+_UNANSWERED = object()
+# values per search_many request; the server takes at most libsearch.MAX_BATCH
+BATCH_SIZE = 1000
+# requests per connection before we stop using it; socket_app_host closes a connection after MAX_REQUESTS
+MAX_REQUESTS = 100
+
+
+class Connection:
+    def __init__(self, addr, connect_timeout, read_timeout, header_format, accept_encoding, compress_threshold):
+        self.addr = addr
+        # addr: (host, port), where host can be "unix:/path" (see libclient.socket_address)
+        self.sock = connect(*addr, timeout=connect_timeout)
+        self.sock.settimeout(read_timeout)
+        self.last_used = time.monotonic()
+        self._recv_buffer = RecvBuffer()
+        self._next_request_id = 1
+        self.requests_sent = 0
+        # the same negotiation as libclient.Message
+        self.header_format = header_format
+        self.accept_encoding = accept_encoding
+        self.compress_threshold = compress_threshold
+        self.compression = None
+        self._binary_header_accepted = False
+        self._accept_encoding_acked = False
+        # for is_healthy(); made the first time it is needed
+        self._poller = None
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def is_healthy(self):
+        # an idle connection should have nothing to read; if select says it is readable the server either closed it
+        # (idle timeout, request cap) or sent something we didn't ask for, and it can't be used either way
+        # poll rather than select(), which can't take file descriptors of 1024 and up (windows has no poll, and no
+        # such limit on select())
+        try:
+            if not hasattr(select, "poll"):
+                readable, _, _ = select.select([self.sock], [], [], 0)
+                return not readable
+            if self._poller is None:
+                self._poller = select.poll()
+                self._poller.register(self.sock, select.POLLIN)
+            return not self._poller.poll(0)
+        except (OSError, ValueError):
+            return False
+
+    def exchange(self, items, results, window):
+        # items: (index, content) pairs; sends them pipelined with request-ids and stores each response in
+        # results[index]. At most window requests are in flight so we never block sending while the server is blocked
+        # sending us responses we aren't reading.
+        in_flight = {}
+        items = iter(items)
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < window:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                index, content = item
+                in_flight[self._send(content)] = index
+            if not in_flight:
+                break
+            header, response = self._receive()
+            index = in_flight.pop(header.get("request-id"), None)
+            if index is None:
+                raise ValueError(f"Response for unknown request-id {repr(header.get('request-id'))}.")
+            results[index] = response
+        self.last_used = time.monotonic()
+
+    def _send(self, content, content_type="text/json", encoding="utf-8"):
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        self.requests_sent += 1
+        content_bytes, content_encoding = encode_content(
+            content, content_type, encoding, compression=self.compression, threshold=self.compress_threshold
+        )
+        headers = {}
+        if self.header_format != "json" and not self._binary_header_accepted:
+            headers["header-format"] = self.header_format
+        if self.accept_encoding and not self._accept_encoding_acked:
+            headers["accept-encoding"] = list(self.accept_encoding)
+        self.sock.sendall(
+            create_message(
+                content_bytes=content_bytes,
+                content_type=content_type,
+                content_encoding=content_encoding,
+                request_id=request_id,
+                binary_header=self._binary_header_accepted,
+                extra_headers=headers,
+            )
+        )
+        return request_id
+
+    def _recv_exactly(self, nbytes):
+        while len(self._recv_buffer) < nbytes:
+            if not self._recv_buffer.recv_into(self.sock):
+                raise ConnectionError("Peer closed.")
+        return self._recv_buffer.consume(nbytes)
+
+    def _receive(self):
+        hdrlen, binary_header = split_proto_header(PROTO_HEADER.unpack(self._recv_exactly(PROTO_HEADER.size))[0])
+        header = decode_header(self._recv_exactly(hdrlen), binary_header)
+        if binary_header:
+            self._binary_header_accepted = True
+        if "accept-encoding" in header:
+            self.compression = choose_compression(header["accept-encoding"])
+            self._accept_encoding_acked = True
+        self._recv_buffer.reserve(header["content-length"])
+        data = self._recv_exactly(header["content-length"])
+        return header, decode_content(
+            data,
+            header["content-type"],
+            header["content-encoding"],
+            header["byteorder"],
+            accepted=self.accept_encoding or (),
+        )
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        max_connections=8,
+        connect_timeout=5.0,
+        read_timeout=10.0,
+        health_check_interval=1.0,
+        window=64,
+        header_format="binary",
+        accept_encoding=None,
+        compress_threshold=COMPRESS_THRESHOLD,
+        max_requests=MAX_REQUESTS,
+    ):
+        # max_connections: per (host, port); callers block in acquire() while they are all in use
+        # health_check_interval: connections idle for longer than this are checked before they are handed out
+        # window: max pipelined requests in flight on one connection during call_many()
+        # max_requests: the server's per-connection request cap (None for none); a connection is never sent more than
+        # that, a big call_many() goes out on as many connections one after the other as it takes
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.health_check_interval = health_check_interval
+        self.window = window
+        self.header_format = header_format
+        self.accept_encoding = accept_encoding
+        self.compress_threshold = compress_threshold
+        self.max_requests = max_requests
+        self._cond = threading.Condition()
+        # (host, port) -> idle connections and how many connections exist (idle + in use)
+        self._hosts = {}
+        self._closed = False
+
+    def call(self, host, port, action, value):
+        return self.call_many(host, port, [(action, value)])[0]
+
+    def call_many(self, host, port, calls):
+        # calls: (action, value) pairs; returns the response contents in the same order
+        # the server closes keep-alive connections (idle timeout, request cap) and we may only find out when we use
+        # one, so requests it didn't answer are sent again on another connection. That assumes the actions are safe
+        # to repeat, like search.
+        return self._exchange((host, port), [dict(action=action, value=value) for action, value in calls])
+
+    def search_many(self, host, port, values, mode="exact", limit=None, max_distance=None, batch_size=BATCH_SIZE):
+        # looks up any number of values with search_many requests of at most batch_size values each (pipelined on one
+        # connection); returns one {"value", "result"} or {"value", "error"} item per value, in order
+        options = {"mode": mode}
+        if limit is not None:
+            options["limit"] = limit
+        if max_distance is not None:
+            options["max-distance"] = max_distance
+        values = list(values)
+        contents = [
+            dict(action="search_many", value=values[i:i + batch_size], **options)
+            for i in range(0, len(values), batch_size)
+        ]
+        items = []
+        for response in self._exchange((host, port), contents):
+            result = response.get("result")
+            if not isinstance(result, list):
+                # the whole batch was refused (bad options, too many values)
+                raise ValueError(result)
+            items.extend(result)
+        return items
+
+    def _exchange(self, addr, contents):
+        if not contents:
+            return []
+        results = [_UNANSWERED] * len(contents)
+        todo = list(enumerate(contents))
+        while todo:
+            conn = self.acquire(addr)
+            # no more than the server answers before it closes the connection
+            count = len(todo) if self.max_requests is None else self.max_requests - conn.requests_sent
+            chunk, todo = todo[:count], todo[count:]
+            reused = conn.requests_sent > 0
+            try:
+                conn.exchange(chunk, results, self.window)
+            except ConnectionError:
+                self.release(conn, reuse=False)
+                unanswered = [item for item in chunk if results[item[0]] is _UNANSWERED]
+                # a connection closed on us answers some of the requests first, or was idle in the pool and closed in
+                # the meantime; a new one that answers none of them is a server we can't talk to
+                if len(unanswered) == len(chunk) and not reused:
+                    raise
+                todo = unanswered + todo
+            except BaseException:
+                # timeouts or bad responses leave the connection in an unknown state, don't reuse it
+                self.release(conn, reuse=False)
+                raise
+            else:
+                # one that has used up its requests is about to be closed by the server
+                self.release(conn, reuse=self.max_requests is None or conn.requests_sent < self.max_requests)
+        return results
+
+    def acquire(self, addr):
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("Pool is closed.")
+                host = self._hosts.setdefault(addr, SimpleNamespace(idle=[], count=0))
+                while not host.idle and host.count >= self.max_connections:
+                    self._cond.wait()
+                if host.idle:
+                    # most recently used first, it is the least likely to have been closed by the server
+                    conn = host.idle.pop()
+                else:
+                    host.count += 1
+                    conn = None
+            if conn is None:
+                try:
+                    return Connection(
+                        addr,
+                        self.connect_timeout,
+                        self.read_timeout,
+                        self.header_format,
+                        self.accept_encoding,
+                        self.compress_threshold,
+                    )
+                except BaseException:
+                    self._discard(addr)
+                    raise
+            if time.monotonic() - conn.last_used < self.health_check_interval or conn.is_healthy():
+                return conn
+            # dead connection, drop it and try again
+            conn.close()
+            self._discard(addr)
+
+    def release(self, conn, reuse=True):
+        if not reuse or self._closed:
+            conn.close()
+            self._discard(conn.addr)
+            return
+        with self._cond:
+            self._hosts[conn.addr].idle.append(conn)
+            self._cond.notify()
+
+    def _discard(self, addr):
+        with self._cond:
+            self._hosts[addr].count -= 1
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for host in self._hosts.values():
+                for conn in host.idle:
+                    conn.close()
+                host.count -= len(host.idle)
+                host.idle.clear()
+            self._cond.notify_all()
+
+
+class Client:
+    # ConnectionPool bound to one (host, port)
+    def __init__(self, host, port, pool=None, **pool_options):
+        self.host = host
+        self.port = port
+        # a pool passed in may be shared with other clients, only close the one we made
+        self._owns_pool = pool is None
+        self.pool = ConnectionPool(**pool_options) if pool is None else pool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def call(self, action, value):
+        return self.pool.call(self.host, self.port, action, value)
+
+    def call_many(self, calls):
+        return self.pool.call_many(self.host, self.port, calls)
+
+    def search_many(self, values, **options):
+        return self.pool.search_many(self.host, self.port, values, **options)
+
+    def close(self):
+        if self._owns_pool:
+            self.pool.close()
@@ -0,0 +1,538 @@
+import gc
+import os
+import sys
+import json
+import time
+import heapq
+import itertools
+import traceback
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+# the search backend behind the "search" action
+# libserver started out with a dict of three entries and exact lookups only. SearchIndex loads a corpus of any size
+# (a file of key<TAB>value[<TAB>weight] lines, or a json object of key -> value) into a few compact structures:
+#
+#   - keys/values: sorted by key, so a key's position is its id. Exact lookups and prefix ranges are a bisect away.
+#   - weights: array of floats (the optional third column, 0 without it); results are ranked by it, best first
+#   - _tree: a segment tree over the weights holding the id of the best key of every node, so the top-k keys of a prefix
+#     range come out in O(k log n) however many keys share the prefix. Not built when there are no weights: the
+#     ranking is then just key order, which the sorted keys already are.
+#   - _reversed/_reversed_ids: the keys spelled backwards, sorted, and the id of each; a suffix range is a bisect away
+#   - _grams: trigram -> array of the ids of the keys that contain it (keys padded with a start and end marker first)
+#
+# fuzzy search (levenshtein distance, at most MAX_DISTANCE edits):
+#   - 1 edit: split the query in two halves; the edit is in one of them, so the key starts with the first half or ends
+#     with the second. The keys in those two ranges are the only candidates and checking one is a couple of string
+#     compares. For short queries the halves are short and the ranges big, then it is cheaper to try every string one
+#     edit away from the query (over the characters the corpus uses) with exact lookups; we do whichever is less work.
+#   - 2 edits: one edit destroys at most the 3 trigrams that overlap it, so a key within 2 edits still has all but 6 of
+#     the query's trigrams. Counting ids in the query's trigram lists leaves a few candidates for the edit distance
+#     check. This is the slow one (milliseconds at 1M keys, see bench_search.py), so it is off unless MAX_DISTANCE is
+#     raised to 2; queries then ask for it with max-distance.
+#
+# SearchEngine holds the current index and swaps in a new one when the corpus file changes. The new index is built a
+# slice at a time on the selector loop itself: building is a generator (SearchIndex.build) that yields every BUILD_STEP
+# items of work, and the server calls SearchEngine.step() between batches of events, which runs it for RELOAD_SLICE
+# seconds. A thread wouldn't help, it holds the GIL for as long as any single pass over the keys takes, and neither
+# would a process, unpickling its index holds it just as long. Meanwhile searches are answered from the old index.
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 1000
+# most values in one search_many request; clients split bigger batches (libpool.ConnectionPool.search_many)
+MAX_BATCH = 1000
+# most edits a fuzzy query may ask for: 1 edit takes tens of microseconds at 1M keys, 2 take milliseconds
+MAX_DISTANCE = 1
+# below this many keys a prefix range is ranked by looking at all of them instead of walking the segment tree
+SCAN_RANGE = 256
+# a reload yields to the loop every BUILD_STEP items (and every SORT_CHUNK keys sorted), and the loop gives it
+# RELOAD_SLICE seconds at a time
+BUILD_STEP = 2048
+SORT_CHUNK = 4096
+RELOAD_SLICE = 0.005
+
+_START = "\x02"
+_END = "\x03"
+_HIGHEST = "\U0010ffff"
+
+
+def trigrams(key):
+    padded = _START + key + _END
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    # levenshtein distance between a and b if it is at most limit, else None
+    if abs(len(a) - len(b)) > limit:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            # every path through this row already costs too much
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+def within_one_edit(a, b):
+    # 0 or 1 if that is the edit distance between a and b, else None; a lot cheaper than edit_distance(a, b, 1)
+    if len(a) > len(b):
+        a, b = b, a
+    if len(b) - len(a) > 1:
+        return None
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if i == len(a):
+        return len(b) - len(a)
+    if len(a) == len(b):
+        return 1 if a[i + 1:] == b[i + 1:] else None
+    return 1 if a[i:] == b[i + 1:] else None
+
+
+def one_edit_away(word, alphabet):
+    # every string within one edit of word using the characters in alphabet
+    variants = {word}
+    for i in range(len(word) + 1):
+        head, tail = word[:i], word[i:]
+        if tail:
+            variants.add(head + tail[1:])
+        for char in alphabet:
+            variants.add(head + char + tail)
+            if tail:
+                variants.add(head + char + tail[1:])
+    return variants
+
+
+def run(steps):
+    # runs one of the step generators below (they yield now and then and return their result) in one go
+    try:
+        while True:
+            next(steps)
+    except StopIteration as stop:
+        return stop.value
+
+
+def sorted_in_steps(items, key=None):
+    # sorted(), but as chunks merged by heapq.merge, yielding between the chunks and every BUILD_STEP merged items
+    chunks = []
+    for i in range(0, len(items), SORT_CHUNK):
+        chunks.append(sorted(items[i:i + SORT_CHUNK], key=key))
+        yield
+    result = []
+    for i, item in enumerate(heapq.merge(*chunks, key=key)):
+        result.append(item)
+        if i % BUILD_STEP == 0:
+            yield
+    return result
+
+
+def clear_in_steps(items):
+    # empties a list a slice at a time; freeing a million objects in one go takes tens of ms
+    while items:
+        del items[-BUILD_STEP:]
+        yield
+
+
+def read_corpus_in_steps(path):
+    # (keys, values, weights) in the order of the lines; a key may be repeated, the index keeps the last one
+    # lists rather than a dict of key -> (value, weight): growing a dict to a million entries rehashes all of them at
+    # once (tens of ms), and the garbage collector has to look at every one of a million tuples
+    # (a json corpus is parsed in one go, which stops the loop for as long as that takes; use the tab separated format
+    # for big ones)
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            corpus = json.load(f)
+        return list(corpus), list(corpus.values()), array("d", bytes(8 * len(corpus)))
+    keys = []
+    values = []
+    weights = array("d")
+    with open(path, encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            line = line.rstrip("\r\n")
+            if i % BUILD_STEP == 0:
+                yield
+            if not line:
+                continue
+            key, _, rest = line.partition("\t")
+            value, _, weight = rest.partition("\t")
+            keys.append(key)
+            values.append(value)
+            weights.append(float(weight) if weight else 0.0)
+    return keys, values, weights
+
+
+class SearchIndex:
+    def __init__(self, corpus):
+        # corpus: key -> value or key -> (value, weight)
+        keys = list(corpus)
+        entries = [corpus[key] if isinstance(corpus[key], tuple) else (corpus[key], 0.0) for key in keys]
+        run(self._build(keys, [value for value, _ in entries], array("d", (weight for _, weight in entries))))
+
+    @classmethod
+    def from_file(cls, path):
+        return run(cls.build(path))
+
+    @classmethod
+    def build(cls, path):
+        # SearchIndex.from_file(path) a slice at a time: yields every BUILD_STEP items of work, returns the index
+        keys, values, weights = yield from read_corpus_in_steps(path)
+        index = cls.__new__(cls)
+        yield from index._build(keys, values, weights)
+        return index
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _build(self, keys, values, weights):
+        # keys, values, weights: the corpus as parallel sequences, keys in any order and maybe repeated
+        # the sort is stable, so a repeated key's entries come out in the order they were given and the last one wins
+        ids = yield from sorted_in_steps(range(len(keys)), key=keys.__getitem__)
+        self.keys = []
+        self.values = []
+        self.weights = array("d")
+        for n, i in enumerate(ids):
+            if self.keys and self.keys[-1] == keys[i]:
+                self.values[-1] = values[i]
+                self.weights[-1] = weights[i]
+            else:
+                self.keys.append(keys[i])
+                self.values.append(values[i])
+                self.weights.append(weights[i])
+            if n % BUILD_STEP == 0:
+                yield
+        yield from clear_in_steps(ids)
+        self.weighted = False
+        for i in range(0, len(self.weights), BUILD_STEP):
+            if any(self.weights[i:i + BUILD_STEP]):
+                self.weighted = True
+                break
+            yield
+        self._tree = (yield from self._build_tree()) if self.weighted else None
+        reversed_keys = []
+        for i, key in enumerate(self.keys):
+            reversed_keys.append(key[::-1])
+            if i % BUILD_STEP == 0:
+                yield
+        ids = yield from sorted_in_steps(range(len(reversed_keys)), key=reversed_keys.__getitem__)
+        self._reversed = []
+        self._reversed_ids = array("I")
+        for i in range(0, len(ids), BUILD_STEP):
+            self._reversed.extend(reversed_keys[j] for j in ids[i:i + BUILD_STEP])
+            self._reversed_ids.extend(ids[i:i + BUILD_STEP])
+            yield
+        yield from clear_in_steps(reversed_keys)
+        yield from clear_in_steps(ids)
+        alphabet = set()
+        self._grams = {}
+        for i, key in enumerate(self.keys):
+            alphabet.update(key)
+            for gram in trigrams(key):
+                ids = self._grams.get(gram)
+                if ids is None:
+                    ids = self._grams[gram] = array("I")
+                ids.append(i)
+            if i % BUILD_STEP == 0:
+                yield
+        self._alphabet = "".join(sorted(alphabet))
+
+    def _dismantle(self):
+        # empties the index a slice at a time (freeing a million keys in one go takes ~150 ms)
+        for items in (self.keys, self.values, self._reversed):
+            yield from clear_in_steps(items)
+        while self._grams:
+            for _ in range(min(BUILD_STEP, len(self._grams))):
+                self._grams.popitem()
+            yield
+
+    def _build_tree(self):
+        # bottom up segment tree; node p covers nodes 2p and 2p+1, the leaves start at _size; -1 is an empty leaf
+        weights = self.weights
+        self._size = size = 1 << max(len(weights) - 1, 1).bit_length()
+        tree = array("i", [-1]) * (2 * size)
+        for i in range(0, len(weights), BUILD_STEP):
+            end = min(i + BUILD_STEP, len(weights))
+            tree[size + i:size + end] = array("i", range(i, end))
+            yield
+        for p in range(size - 1, 0, -1):
+            left, right = tree[2 * p], tree[2 * p + 1]
+            # ties go to the left, i.e. the smaller key
+            if right >= 0 and (left < 0 or weights[right] > weights[left]):
+                tree[p] = right
+            else:
+                tree[p] = left
+            if p % BUILD_STEP == 0:
+                yield
+        return tree
+
+    def _result(self, i, **extra):
+        return dict(key=self.keys[i], value=self.values[i], **extra)
+
+    def _find(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    def exact(self, key):
+        i = self._find(key)
+        return None if i is None else self.values[i]
+
+    def exact_many(self, keys):
+        # the values of all of keys (None for a miss) in one pass: the keys are looked up in sorted order, so every
+        # bisect starts where the previous one ended instead of at the start of the index
+        values = [None] * len(keys)
+        lo = 0
+        for j in sorted(range(len(keys)), key=keys.__getitem__):
+            key = keys[j]
+            lo = bisect_left(self.keys, key, lo)
+            if lo < len(self.keys) and self.keys[lo] == key:
+                values[j] = self.values[lo]
+        return values
+
+    @staticmethod
+    def _range(keys, prefix):
+        lo = bisect_left(keys, prefix)
+        # every key with the prefix sorts before prefix followed by the highest code point
+        hi = bisect_left(keys, prefix + _HIGHEST, lo)
+        return lo, hi
+
+    def prefix(self, prefix, limit=DEFAULT_LIMIT):
+        lo, hi = self._range(self.keys, prefix)
+        if not self.weighted:
+            ids = range(lo, min(hi, lo + limit))
+        elif hi - lo <= SCAN_RANGE:
+            ids = heapq.nsmallest(limit, range(lo, hi), key=lambda i: (-self.weights[i], i))
+        else:
+            ids = self._top_k(lo, hi, limit)
+        return [self._result(i) for i in ids]
+
+    def _top_k(self, lo, hi, limit):
+        # best first walk of the segment tree: start with the nodes that exactly cover [lo, hi), always expand the one
+        # with the best key below it; a leaf coming off the heap is the next result
+        tree, weights, size = self._tree, self.weights, self._size
+        heap = []
+
+        def push(node):
+            i = tree[node]
+            if i >= 0:
+                heapq.heappush(heap, (-weights[i], i, node))
+
+        left, right = lo + size, hi + size
+        while left < right:
+            if left & 1:
+                push(left)
+                left += 1
+            if right & 1:
+                right -= 1
+                push(right)
+            left >>= 1
+            right >>= 1
+        ids = []
+        while heap and len(ids) < limit:
+            _, i, node = heapq.heappop(heap)
+            if node >= size:
+                ids.append(i)
+            else:
+                push(2 * node)
+                push(2 * node + 1)
+        return ids
+
+    def fuzzy(self, query, max_distance=1, limit=DEFAULT_LIMIT):
+        # keys within max_distance edits of query, closest first, then by weight
+        # short queries get fewer edits, otherwise nearly everything would match: 1-3 characters exact only, 4-6 at
+        # most 1, longer ones max_distance
+        max_distance = min(max_distance, MAX_DISTANCE, (len(query) - 1) // 3)
+        if max_distance <= 0:
+            matches = {} if (i := self._find(query)) is None else {i: 0}
+        elif max_distance == 1:
+            matches = self._one_edit(query)
+        else:
+            matches = self._two_edits(query)
+        best = heapq.nsmallest(limit, matches.items(), key=lambda match: (match[1], -self.weights[match[0]], match[0]))
+        return [self._result(i, distance=distance) for i, distance in best]
+
+    def _one_edit(self, query):
+        # id -> distance
+        half = len(query) // 2
+        lo, hi = self._range(self.keys, query[:half])
+        reversed_lo, reversed_hi = self._range(self._reversed, query[half:][::-1])
+        variants = len(query) * 2 * len(self._alphabet)
+        matches = {}
+        if variants < (hi - lo) + (reversed_hi - reversed_lo):
+            for variant in one_edit_away(query, self._alphabet):
+                i = self._find(variant)
+                if i is not None:
+                    matches[i] = 0 if variant == query else 1
+            return matches
+        for i in itertools.chain(range(lo, hi), self._reversed_ids[reversed_lo:reversed_hi]):
+            distance = within_one_edit(query, self.keys[i])
+            if distance is not None:
+                matches[i] = distance
+        return matches
+
+    def _two_edits(self, query):
+        grams = trigrams(query)
+        lists = sorted((self._grams.get(gram, ()) for gram in grams), key=len)
+        needed = len(grams) - 3 * 2
+        # a key needs `needed` of the lists; leaving out the m longest ones it still needs needed - m of the rest, so
+        # skip the long lists (most of the counting work) as long as that still leaves a useful filter
+        skip = max(0, min(needed - 3, len(lists)))
+        lists = lists[:len(lists) - skip]
+        needed -= skip
+        counts = Counter()
+        for ids in lists:
+            counts.update(ids)
+        matches = {}
+        for i, count in counts.items():
+            if count >= needed:
+                distance = edit_distance(query, self.keys[i], 2)
+                if distance is not None:
+                    matches[i] = distance
+        return matches
+
+
+class SearchEngine:
+    def __init__(self, corpus=None):
+        self.index = SearchIndex(corpus or {})
+        self.path = None
+        self._mtime = None
+        # the reload in progress (a _reload() generator), or None
+        self._reloader = None
+        self._gc_was_enabled = False
+        # goes up every time a new index is swapped in, so anything derived from the old one (cached responses) can
+        # tell it is out of date
+        self.generation = 0
+
+    def load(self, path):
+        # blocking; for startup
+        mtime = os.stat(path).st_mtime_ns
+        self.index = SearchIndex.from_file(path)
+        self.path, self._mtime = path, mtime
+        self.generation += 1
+        print(f"loaded {len(self.index)} search keys from {path}")
+
+    @property
+    def reloading(self):
+        return self._reloader is not None
+
+    def check_for_update(self):
+        # cheap (one stat); called now and then from the server loop. Starts a reload when the corpus file changed,
+        # which step() then works on
+        if self.path is None or self.reloading:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            # being replaced right now; try again next time
+            return
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._reloader = self._reload()
+            # the build makes millions of objects and no reference cycles; every collection of the garbage collector in
+            # the meantime would look at them for tens of ms (and it would run often, all those objects are what
+            # triggers it), so it is paused until the reload is done
+            self._gc_was_enabled = gc.isenabled()
+            gc.disable()
+
+    def step(self, budget=RELOAD_SLICE):
+        # works on the reload for about budget seconds; the server loop calls this between batches of events for as
+        # long as reloading is true
+        if self._reloader is None:
+            return
+        deadline = time.perf_counter() + budget
+        try:
+            while time.perf_counter() < deadline:
+                next(self._reloader)
+        except StopIteration:
+            self._end_reload()
+        except Exception:
+            # keep serving the old index; the next change to the file gets another try
+            self._end_reload()
+            print(f"error: reloading {self.path}:\n{traceback.format_exc()}")
+
+    def _reload(self):
+        index = yield from SearchIndex.build(self.path)
+        # swapping the reference is atomic, a search in progress finishes on the index it started with
+        old, self.index = self.index, index
+        self.generation += 1
+        print(f"reloaded {len(index)} search keys from {self.path}")
+        # the old index is freed a slice at a time as well, unless something else still has it (a search running on a
+        # thread, see libexecutor): old here is then not the only reference (getrefcount counts its argument too), and
+        # whatever has it frees it in one go when it is done with it. Nothing gets it after the swap.
+        if sys.getrefcount(old) == 2:
+            yield from old._dismantle()
+
+    def _end_reload(self):
+        self._reloader = None
+        if self._gc_was_enabled:
+            gc.enable()
+
+    @staticmethod
+    def _options(request):
+        # (limit, max-distance) of a request; raises ValueError for bad ones
+        try:
+            limit = min(int(request.get("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+            max_distance = int(request.get("max-distance", 1))
+        except (TypeError, ValueError):
+            raise ValueError("limit and max-distance must be integers.") from None
+        return limit, max_distance
+
+    def search(self, request):
+        # request: value (the query) and optionally mode ("exact", "prefix" or "fuzzy"), limit and max-distance
+        index = self.index
+        query = request.get("value")
+        mode = request.get("mode", "exact")
+        try:
+            limit, max_distance = self._options(request)
+        except ValueError as e:
+            return {"result": f"Error: {e}"}
+        if mode == "exact":
+            answer = index.exact(query) if isinstance(query, str) else None
+            return {"result": answer if answer is not None else f'No match for "{query}".'}
+        if not isinstance(query, str):
+            return {"result": "Error: the search value must be a string."}
+        if mode == "prefix":
+            return {"result": index.prefix(query, limit)}
+        if mode == "fuzzy":
+            return {"result": index.fuzzy(query, max_distance, limit)}
+        return {"result": f'Error: invalid search mode "{mode}".'}
+
+    def search_many(self, request):
+        # request: value (a list of queries) and the same options as search(), which apply to all of them
+        # the result has one item per query, in order: {"value": query, "result": ...} or {"value": query, "error": ...}
+        # all of the queries are answered from the same index, even if a reload finishes halfway through
+        index = self.index
+        values = request.get("value")
+        mode = request.get("mode", "exact")
+        if not isinstance(values, list):
+            return {"result": "Error: the search_many value must be a list."}
+        if len(values) > MAX_BATCH:
+            return {"result": f"Error: at most {MAX_BATCH} values per search_many request."}
+        if mode not in ("exact", "prefix", "fuzzy"):
+            return {"result": f'Error: invalid search mode "{mode}".'}
+        try:
+            limit, max_distance = self._options(request)
+        except ValueError as e:
+            return {"result": f"Error: {e}"}
+        if mode == "exact":
+            answers = iter(index.exact_many([value for value in values if isinstance(value, str)]))
+        items = []
+        for value in values:
+            if not isinstance(value, str):
+                items.append({"value": value, "error": "the search value must be a string."})
+            elif mode == "exact":
+                answer = next(answers)
+                if answer is None:
+                    items.append({"value": value, "error": f'No match for "{value}".'})
+                else:
+                    items.append({"value": value, "result": answer})
+            elif mode == "prefix":
+                items.append({"value": value, "result": index.prefix(value, limit)})
+            else:
+                items.append({"value": value, "result": index.fuzzy(value, max_distance, limit)})
+        return {"result": items}
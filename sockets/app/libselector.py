@@ -0,0 +1,212 @@
+import math
+import select
+import selectors
+from collections import Counter
+from collections.abc import Mapping
+
+# event backends for the selector loop
+# the servers take whatever selectors.DefaultSelector is (epoll on linux, level triggered). make_selector() picks one:
+#   "default"   selectors.DefaultSelector
+#   "epoll"     epoll, level triggered: an fd is reported on every select for as long as it is readable/writable
+#   "epoll-et"  epoll, edge triggered for the objects that can take it (see below): an fd is reported once when it
+#               becomes readable/writable, and not again until new data arrives or buffer space frees up
+#   "poll"      poll(); the kernel looks at every registered fd on every call, which adds up with many idle connections
+#
+# the selectors here are drop in replacements for the ones in selectors (same register/modify/unregister/select/get_map)
+# and also count the system calls they make in `calls`: "wait" (epoll_wait/poll) and "ctl" (epoll_ctl, or changing
+# what poll() watches). Like the stdlib ones they don't make a call when modify() doesn't change the events.
+#
+# edge triggered only works for code that reads until there is nothing left (and writes until the socket is full),
+# or it waits for an event that never comes. So the "epoll-et" selector only registers an object edge triggered when
+# its data says it can take it (data.edge_triggered is true; libserver.Message sets that when its selector has
+# edge_triggered set); the listening socket, the executor's pipe and the like stay level triggered. Those objects are
+# registered for both events whatever they ask for: they hear about every change once and keep track of what they
+# want themselves, so they never need modify()
+
+BACKENDS = ("default", "epoll", "epoll-et", "poll")
+
+
+def make_selector(backend="default"):
+    if backend == "default":
+        return selectors.DefaultSelector()
+    if backend == "epoll":
+        return EpollSelector()
+    if backend == "epoll-et":
+        return EpollSelector(edge_triggered=True)
+    if backend == "poll":
+        return PollSelector()
+    raise ValueError(f"Unknown selector backend {backend!r}, expected one of {BACKENDS}.")
+
+
+class _KeyMap(Mapping):
+    # get_map(): fileobj -> SelectorKey, over the selector's fd -> SelectorKey dict
+    def __init__(self, selector):
+        self._selector = selector
+
+    def __len__(self):
+        return len(self._selector._keys)
+
+    def __getitem__(self, fileobj):
+        fd = self._selector._lookup(fileobj)
+        if fd is None:
+            raise KeyError(f"{fileobj!r} is not registered")
+        return self._selector._keys[fd]
+
+    def __iter__(self):
+        return (key.fileobj for key in self._selector._keys.values())
+
+
+class _PollingSelector(selectors.BaseSelector):
+    # what poll and epoll have in common: both have register/modify/unregister/poll on an fd
+    _READ = 0
+    _WRITE = 0
+    edge_triggered = False
+
+    def __init__(self, poller):
+        self._poller = poller
+        # fd -> SelectorKey
+        self._keys = {}
+        self._map = _KeyMap(self)
+        self.calls = Counter(wait=0, ctl=0)
+
+    def _lookup(self, fileobj):
+        # the fd of a registered fileobj, or None; a socket that has been closed no longer has one, so we go looking
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        if fd >= 0 and fd in self._keys:
+            return fd
+        for key in self._keys.values():
+            if key.fileobj is fileobj:
+                return key.fd
+        return None
+
+    def _poller_events(self, events, data):
+        poller_events = 0
+        if events & selectors.EVENT_READ:
+            poller_events |= self._READ
+        if events & selectors.EVENT_WRITE:
+            poller_events |= self._WRITE
+        return poller_events
+
+    def register(self, fileobj, events, data=None):
+        if not events or events & ~(selectors.EVENT_READ | selectors.EVENT_WRITE):
+            raise ValueError(f"Invalid events: {events!r}")
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        if fd in self._keys:
+            raise KeyError(f"{fileobj!r} (FD {fd}) is already registered")
+        key = selectors.SelectorKey(fileobj, fd, events, data)
+        self._poller.register(fd, self._poller_events(events, data))
+        self.calls["ctl"] += 1
+        self._keys[fd] = key
+        return key
+
+    def unregister(self, fileobj):
+        fd = self._lookup(fileobj)
+        if fd is None:
+            raise KeyError(f"{fileobj!r} is not registered")
+        key = self._keys.pop(fd)
+        try:
+            self._poller.unregister(fd)
+            self.calls["ctl"] += 1
+        except OSError:
+            # the fd was closed before it was unregistered, the kernel has already forgotten it
+            pass
+        return key
+
+    def modify(self, fileobj, events, data=None):
+        fd = self._lookup(fileobj)
+        if fd is None:
+            raise KeyError(f"{fileobj!r} is not registered")
+        key = self._keys[fd]
+        if events != key.events:
+            if not events or events & ~(selectors.EVENT_READ | selectors.EVENT_WRITE):
+                raise ValueError(f"Invalid events: {events!r}")
+            self._poller.modify(fd, self._poller_events(events, data))
+            self.calls["ctl"] += 1
+        if events != key.events or data is not key.data:
+            key = self._keys[fd] = key._replace(events=events, data=data)
+        return key
+
+    def _poll(self, timeout):
+        raise NotImplementedError
+
+    def select(self, timeout=None):
+        try:
+            fd_events = self._poll(timeout)
+        except InterruptedError:
+            return []
+        self.calls["wait"] += 1
+        ready = []
+        keys = self._keys
+        for fd, event in fd_events:
+            key = keys.get(fd)
+            if key is None:
+                continue
+            # errors and hang ups wake up both the reader and the writer, they find out when they try
+            events = 0
+            if event & ~self._READ:
+                events |= selectors.EVENT_WRITE
+            if event & ~self._WRITE:
+                events |= selectors.EVENT_READ
+            ready.append((key, events & key.events))
+        return ready
+
+    def get_map(self):
+        return self._map
+
+    def close(self):
+        self._keys.clear()
+
+
+class EpollSelector(_PollingSelector):
+    _READ = select.EPOLLIN
+    _WRITE = select.EPOLLOUT
+
+    def __init__(self, edge_triggered=False):
+        super().__init__(select.epoll())
+        self.edge_triggered = edge_triggered
+
+    def _edge_triggered(self, data):
+        return self.edge_triggered and getattr(data, "edge_triggered", False)
+
+    def _poller_events(self, events, data):
+        poller_events = super()._poller_events(events, data)
+        if self._edge_triggered(data):
+            poller_events |= select.EPOLLET
+        return poller_events
+
+    def register(self, fileobj, events, data=None):
+        if self._edge_triggered(data):
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        return super().register(fileobj, events, data)
+
+    def _poll(self, timeout):
+        # epoll takes seconds, -1 for no timeout; the kernel rounds up to a millisecond
+        if timeout is None:
+            timeout = -1
+        elif timeout > 0:
+            timeout = math.ceil(timeout * 1e3) * 1e-3
+        else:
+            timeout = 0
+        # ask for at least one event per registered fd, like the stdlib does
+        return self._poller.poll(timeout, max(len(self._keys), 1))
+
+    def fileno(self):
+        return self._poller.fileno()
+
+    def close(self):
+        self._poller.close()
+        super().close()
+
+
+class PollSelector(_PollingSelector):
+    _READ = select.POLLIN
+    _WRITE = select.POLLOUT
+
+    def __init__(self):
+        super().__init__(select.poll())
+
+    def _poll(self, timeout):
+        # poll takes milliseconds, None for no timeout; round up so we wait at least as long as asked
+        if timeout is not None:
+            timeout = math.ceil(timeout * 1e3) if timeout > 0 else 0
+        return self._poller.poll(timeout)
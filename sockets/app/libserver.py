@@ -1,9 +1,24 @@
-import sys
+import os
+import time
 import selectors
 import json
-import io
 import struct
 
+from libbuffer import FileBody, Spool, RecvBuffer, SendBuffer
+from libcodec import (
+    ARRAY_CONTENT_TYPE,
+    COMPRESS_THRESHOLD,
+    ContentTooLarge,
+    choose_compression,
+    compressions,
+    decode_content,
+    encode_content,
+    has_codec,
+)
+from libheader import BINARY_HEADER_FLAG, check_content_length, create_message_parts, unpack_binary_header
+from libsearch import SearchEngine
+from libtrace import hooks
+
 
 '''
 note the handling of sockets and the information between them like this is very similar to web requests/responses
@@ -27,17 +42,144 @@ request_search = {
 }
 
 
+# the index behind search (see libsearch); starts out with request_search, a host can load a corpus file into it with
+# search_engine.load(path)
+search_engine = SearchEngine(request_search)
+
+
+def search(request):
+    # exact lookups by default; "mode": "prefix" or "fuzzy" return a ranked list of {"key", "value"} results
+    return search_engine.search(request)
+
+
+def search_many(request):
+    # a list of queries in one request, answered in one go; one {"value", "result"} or {"value", "error"} item each
+    return search_engine.search_many(request)
+
+
+# action -> handler(request) returning the response content; add to this to give the server more actions
+handlers = {"search": search, "search_many": search_many}
+
+
+def handle_request(request):
+    # runs the handler for the request's action; module level (not a Message method) so it can also be run on a
+    # thread or process pool (see libexecutor)
+    action = request.get("action")
+    handler = handlers.get(action)
+    if handler is None:
+        return {"result": f'Error: invalid action "{action}".'}
+    return handler(request)
+
+
+def handle_array(array):
+    # binary/array requests (libcodec.TypedArray) have no action, they all come here; the response is an array as well
+    # (anything libcodec can send as one). This one sends the array back; a host replaces it with what it needs done
+    return array
+
+
 class Message:
-    def __init__(self, selector, sock, addr):
+    def __init__(
+        self,
+        selector,
+        sock,
+        addr,
+        keep_alive=False,
+        idle_timeout=None,
+        max_requests=None,
+        compress_threshold=COMPRESS_THRESHOLD,
+        stats=None,
+        executor=None,
+        flow=None,
+        spool_threshold=None,
+        spool_dir=None,
+        spool_as_file=False,
+        cache=None,
+        metrics=None,
+        timers=None,
+        header_timeout=None,
+        request_timeout=None,
+    ):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self._recv_buffer = RecvBuffer()
+        # the parts of the messages waiting to be sent (see libbuffer)
+        self._send_buffer = SendBuffer()
         self._jsonheader_len = None
+        # true when the proto header says a binary header follows instead of a json one
+        self._binary_header = False
         self.jsonheader = None
         self.request = None
         self.response_created = False
+        # keep-alive: instead of closing once the response is sent, the message resets and waits for the next request
+        # on the same socket; idle_timeout (seconds) and max_requests (per connection) are None for no limit
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.requests_served = 0
+        self.last_active = time.monotonic()
+        # pipelining: once a client sends a "request-id" header on a keep-alive connection we keep reading while
+        # responses are being written, and every response carries the request-id of the request it answers
+        self.pipelined = False
+        # compression for responses (see libcodec); picked from the client's "accept-encoding" header, and we tell the
+        # client what we accept in return the first time it asks
+        self.compression = None
+        self.compress_threshold = compress_threshold
+        self._send_accept_encoding = False
+        # the compressions we have told the client about; compressed requests in anything else are refused
+        self._accepted_compressions = ()
+        # optional collections.Counter shared by all connections of the host; we count the requests we answer in it
+        self.stats = stats
+        # optional libexecutor.HandlerExecutor; requests for the actions it offloads are handled on its pool and the
+        # response is queued by complete_job() once they are done, everything else is still handled inline
+        self.executor = executor
+        self._pending_jobs = 0
+        # optional libflow.FlowControl shared by all connections of the host; a pipelined connection stops reading
+        # requests while too many of its responses are waiting to be sent (backpressure)
+        self.flow = flow
+        self.paused = False
+        # request bodies of spool_threshold bytes or more are written to a temporary file in spool_dir as they arrive
+        # instead of being collected in memory (libbuffer.Spool); None never spools
+        # the handler gets a read only mmap of the body, or with spool_as_file the file object, for content-types that
+        # have no codec and aren't compressed (the codecs need something bytes-like)
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.spool_as_file = spool_as_file
+        self._spool = None
+        # optional libcache.ResponseCache shared by all connections of the host; responses of the actions it caches
+        # are kept framed and repeated requests are answered with those bytes instead of running the handler again
+        self.cache = cache
+        # optional libmetrics.Metrics of the host: requests per action, handler latencies and the reserved "stats"
+        # action that returns them (the byte and connection counts go in stats)
+        self.metrics = metrics
+        # optional libtimer.TimerWheel shared by all connections of the host; with it the connection closes itself when
+        # one of its deadlines passes (see _update_deadline), without it there are no deadlines
+        #   idle: idle_timeout seconds without a byte read or sent, while no request is half received
+        #   header: header_timeout seconds from the first byte of a request until its whole header is in
+        #   request: request_timeout seconds from the header until the whole content is in
+        # None for any of them is no deadline
+        self.timers = timers
+        self.header_timeout = header_timeout
+        self.request_timeout = request_timeout
+        self._timer = None
+        self._deadline = None
+        # the events we want; the host registers every connection for reading, and we only tell the selector when
+        # they change (see _set_selector_events_mask)
+        self._events = selectors.EVENT_READ
+        # with an edge triggered selector (libselector "epoll-et") we are registered for both events once and keep
+        # track of the rest ourselves, see _process_edge_events; the selector looks at this to decide whether to
+        # register us edge triggered
+        self.edge_triggered = getattr(selector, "edge_triggered", False)
+        # edge triggered: whether the socket may have data for us / room for more, as far as we know
+        self._readable = False
+        self._writable = False
+        if self.stats is not None:
+            self.stats["active-connections"] += 1
+        # what used to be printed is reported to the tracing hooks instead (see libtrace); each call site is one
+        # attribute check while nobody is subscribed
+        if hooks.connection_opened is not None:
+            hooks.connection_opened(self)
+        self._update_deadline()
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -49,90 +191,243 @@ class Message:
             events = selectors.EVENT_READ | selectors.EVENT_WRITE
         else:
             raise ValueError(f"Invalid events mask mode {repr(mode)}.")
-        self.selector.modify(self.sock, events, data=self)
+        # a pipelined connection asks for the same events over and over (every queued response wants "rw"); edge
+        # triggered the selector reports both anyway and _process_edge_events() only looks at the ones we want
+        if events != self._events:
+            if not self.edge_triggered:
+                self.selector.modify(self.sock, events, data=self)
+            self._events = events
 
     def _read(self):
+        # returns how many bytes were received, None if there was nothing to receive
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            # recv_into writes straight into the preallocated buffer instead of creating a new bytes object
+            nbytes = self._recv_buffer.recv_into(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
-            pass
-        else:
-            if data:
-                self._recv_buffer += data
-            else:
-                raise RuntimeError("Peer closed.")
+            return None
+        if not nbytes:
+            if self.keep_alive and self._between_requests():
+                # with keep-alive the client is free to hang up once it has its responses
+                self.close()
+                return 0
+            raise RuntimeError("Peer closed.")
+        self.last_active = time.monotonic()
+        if self.stats is not None:
+            self.stats["bytes-in"] += nbytes
+        return nbytes
 
     def _write(self):
+        # returns how many bytes were sent: None if the socket had no room, 0 if there was nothing to send
+        sent = 0
         if self._send_buffer:
-            print("sending", repr(self._send_buffer), "to", self.addr)
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                memory = self._send_buffer.memory
+                sent = self._send_buffer.send(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
-                pass
+                sent = None
             else:
-                self._send_buffer = self._send_buffer[sent:]
+                self.last_active = time.monotonic()
+                if hooks.bytes_sent is not None:
+                    hooks.bytes_sent(self, sent)
+                if self.stats is not None:
+                    self.stats["bytes-out"] += sent
+                if self.flow is not None:
+                    # only what is in memory counts, not files being sent with sendfile
+                    self.flow.sent(memory - self._send_buffer.memory)
+                    if self.paused and self.flow.can_resume(self._send_buffer.memory):
+                        self._resume()
+                        if self.sock is None:
+                            return sent
                 # Close when the buffer is drained. The response has been sent.
+                # with keep-alive we go back to waiting for the next request unless the request cap has been hit
                 if sent and not self._send_buffer:
-                    self.close()
+                    if self._request_cap_reached() and not self._pending_jobs:
+                        self.close()
+                    elif self.pipelined:
+                        # still reading; just stop asking for write events until another response is queued
+                        self._set_selector_events_mask("r")
+                    else:
+                        self._reset()
+        return sent
+
+    def _pause(self):
+        # stop reading requests until the client has read some of its responses; only pipelined connections get here,
+        # the others don't read while they have a response to send anyway
+        self.paused = True
+        self.flow.paused(self._send_buffer.memory)
+        self._set_selector_events_mask("w")
+
+    def _resume(self):
+        self.paused = False
+        self.flow.resumed()
+        if not self._request_cap_reached():
+            self._set_selector_events_mask("rw" if self._send_buffer else "r")
+            # requests that were already received before we paused
+            self._process_recv_buffer()
+            self._update_deadline()
+
+    def _request_cap_reached(self):
+        # without keep-alive a connection only ever serves one request
+        if not self.keep_alive:
+            return self.requests_served >= 1
+        return self.max_requests is not None and self.requests_served >= self.max_requests
+
+    def _between_requests(self):
+        # true when nothing of the next request has arrived yet
+        return self._jsonheader_len is None and not len(self._recv_buffer)
+
+    def _next_request(self):
+        # clear the per request state so the next request can be read on the same socket
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self.request = None
+        self.response_created = False
+
+    def _reset(self):
+        self._next_request()
+        self._set_selector_events_mask("r")
+        # the client may have already sent (part of) the next request
+        if len(self._recv_buffer):
+            self._process_recv_buffer()
+        self._update_deadline()
+
+    def _deadline_kind(self):
+        if self.paused or self._request_cap_reached():
+            # we stopped reading, whatever is left in the buffer waits on us; the client still has to read its responses
+            return "idle"
+        if self.jsonheader is None:
+            if self._jsonheader_len is not None or len(self._recv_buffer):
+                return "header"
+        elif self.request is None:
+            return "request"
+        # nothing of a request yet, or the request is in and it is up to us
+        return "idle"
+
+    def _update_deadline(self):
+        # called whenever a request may have moved on; the timer only changes when the kind of deadline does (or a new
+        # request starts), the idle timer isn't moved on every recv/send but checks last_active when it fires
+        if self.timers is None or self.sock is None:
+            return
+        kind = self._deadline_kind()
+        deadline = (kind, None if kind == "idle" else self.requests_served)
+        if deadline == self._deadline:
+            return
+        self._deadline = deadline
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        timeout = {"idle": self.idle_timeout, "header": self.header_timeout, "request": self.request_timeout}[kind]
+        if timeout is not None:
+            self._timer = self.timers.schedule(timeout, self._deadline_passed)
+
+    def _deadline_passed(self):
+        self._timer = None
+        if self.sock is None:
+            return
+        kind = self._deadline[0]
+        if kind == "idle":
+            # still busy, or there was traffic since the timer was set: check again when it could have run out
+            remaining = self.last_active + self.idle_timeout - time.monotonic()
+            if self._pending_jobs or remaining > 0:
+                delay = remaining if remaining > 0 else self.idle_timeout
+                self._timer = self.timers.schedule(delay, self._deadline_passed)
+                return
+        if self.stats is not None:
+            self.stats[f"{kind}-timeouts"] += 1
+        if hooks.deadline_passed is not None:
+            hooks.deadline_passed(self, kind)
+        self.close()
 
     def _json_encode(self, obj, encoding):
         return json.dumps(obj, ensure_ascii=False).encode(encoding)
 
     def _json_decode(self, json_bytes, encoding):
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
+        # str() decodes the bytes (or memoryview) directly; wrapping them in a TextIOWrapper/BytesIO cost more than the
+        # json decoding itself for small headers
+        return json.loads(str(json_bytes, encoding))
 
-    def _create_message(
-        self, *, content_bytes, content_type, content_encoding
-    ):
-        jsonheader = {
-            "byteorder": sys.byteorder,
-            "content-type": content_type,
-            "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
+    def _create_message(self, **kwargs):
+        # the framing lives in libheader so the asyncio version in libasync builds the same bytes
+        # returns the parts of the message (proto header, header, content) for the send buffer
+        return create_message_parts(**kwargs)
+
+    def _encode_response(self, content, content_type, encoding):
+        # runs the content through the codec for its content-type and compresses it if the client accepts that
+        content_bytes, content_encoding = encode_content(
+            content,
+            content_type,
+            encoding,
+            compression=self.compression,
+            threshold=self.compress_threshold,
+        )
+        return {
+            "content_bytes": content_bytes,
+            "content_type": content_type,
+            "content_encoding": content_encoding,
         }
-        jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
-        message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
 
     def _create_response_json_content(self):
         # just a method to create a json content response
-        action = self.request.get("action")
-        if action == "search":
-            query = self.request.get("value")
-            answer = request_search.get(query) or f'No match for "{query}".'
-            content = {"result": answer}
-        else:
-            content = {"result": f'Error: invalid action "{action}".'}
-        content_encoding = "utf-8"
-        response = {
-            "content_bytes": self._json_encode(content, content_encoding),
-            "content_type": "text/json",
-            "content_encoding": content_encoding,
-        }
-        return response
+        # (or any content-type with a codec; the response goes back in the same content-type as the request)
+        if self.request.get("action") == "stats":
+            # reserved; answered here rather than by a handler since the numbers belong to this worker's loop
+            if self.metrics is None:
+                return self._structured_response(self.jsonheader, {"result": "Error: metrics are turned off."})
+            return self._structured_response(self.jsonheader, {"result": self.metrics.snapshot(), "pid": os.getpid()})
+        return self._structured_response(self.jsonheader, handle_request(self.request))
+
+    def _action_label(self, request):
+        # the action a request counts under in the metrics; made up actions all count as "other"
+        action = request.get("action") if isinstance(request, dict) else None
+        return action if action in handlers or action == "stats" else "other"
+
+    def _structured_response(self, header, content):
+        if isinstance(content, FileBody):
+            # a handler can answer with (part of) a file instead; it is streamed from disk with sendfile as is, no
+            # codec or compression
+            return {
+                "content_bytes": content,
+                "content_type": content.content_type,
+                "content_encoding": "binary",
+            }
+        # same content-type and text encoding as the request, without any compression suffix
+        encoding = header["content-encoding"].partition("+")[0]
+        return self._encode_response(content, header["content-type"], encoding)
+
+    def _create_response_array_content(self):
+        return self._encode_response(handle_array(self.request), ARRAY_CONTENT_TYPE, "binary")
 
     def _create_response_binary_content(self):
-        response = {
-            "content_bytes": b"First 10 bytes of request: "
-            + self.request[:10],
-            "content_type": "binary/custom-server-binary-type",
-            "content_encoding": "binary",
-        }
-        return response
+        if self.jsonheader["content-type"] == "binary/echo":
+            # the content comes back as it is; for measuring how fast bulk content moves (bench_shm.py)
+            if hasattr(self.request, "fileno"):
+                # spooled to a file object, send it from there
+                return self._structured_response(self.jsonheader, FileBody(self.request, content_type="binary/echo"))
+            return self._encode_response(self.request, "binary/echo", "binary")
+        return self._encode_response(
+            b"First 10 bytes of request: " + self._request_head(10),
+            "binary/custom-server-binary-type",
+            "binary",
+        )
+
+    def _request_head(self, nbytes):
+        if hasattr(self.request, "read"):
+            # spooled request (mmap or file object)
+            head = self.request.read(nbytes)
+            self.request.seek(0)
+            return head
+        return self.request[:nbytes]
 
     def process_events(self, mask):
         # this is essentially the part in the multi connect version that preforms the checks if the socket is ready for
         # read/write
+        if self.edge_triggered:
+            self._process_edge_events(mask)
+            return
         if mask & selectors.EVENT_READ:
             self.read()
         if mask & selectors.EVENT_WRITE:
@@ -144,29 +439,92 @@ class Message:
         # This method contains state checks to ensure ensure each part of the message arrives as expected
         # it does this by making sure there are enough bytes that have been read into the buffer; this is all due to
         # the fact that we may not get the full message and socket.recv() may need to be called again
-        self._read()
+        # returns what _read() did
+        nbytes = self._read()
+        # _read() may have closed the socket (keep-alive client hung up)
+        if self.sock is not None:
+            self._process_recv_buffer()
+            self._update_deadline()
+        return nbytes
+
+    def _process_edge_events(self, mask):
+        # edge triggered: the selector tells us once when the socket becomes readable or writable and not again until
+        # that changes (new data arrives, room frees up), whether we wanted to read or write at the time or not. So we
+        # note it, and read until the socket is empty and write until it is full whenever we want to; no epoll_ctl
+        # when what we want changes, which level triggered costs two per request (for "rw" and back to "r")
+        if mask & selectors.EVENT_READ:
+            self._readable = True
+        if mask & selectors.EVENT_WRITE:
+            self._writable = True
+        while self.sock is not None:
+            busy = False
+            if self._writable and self._events & selectors.EVENT_WRITE:
+                sent = self.write()
+                if sent is None:
+                    # full; we hear from the selector when there is room again
+                    self._writable = False
+                busy = bool(sent)
+            if self.sock is not None and self._readable and self._events & selectors.EVENT_READ:
+                nbytes = self.read()
+                # empty: a short read says so without another recv() that fails with EAGAIN (see epoll(7))
+                if nbytes is None or self._recv_buffer.short_read:
+                    self._readable = False
+                busy = True
+            if not busy:
+                return
+
+    def _process_recv_buffer(self):
+        # a pipelining client doesn't wait for responses, so one recv can hold several requests; we keep going until
+        # there isn't a whole request left in the buffer
+        while True:
+            if self._jsonheader_len is None:
+                self.process_protoheader()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
+            if self._jsonheader_len is not None:
+                if self.jsonheader is None:
+                    self.process_jsonheader()
 
-        if self._jsonheader_len is not None:
-            if self.jsonheader is None:
-                self.process_jsonheader()
+            if self.jsonheader:
+                if self.request is None:
+                    self.process_request()
 
-        if self.jsonheader:
-            if self.request is None:
-                self.process_request()
+            if self.request is None or not self.pipelined:
+                break
+            # pipelined requests get their response queued straight away instead of waiting for write()
+            self.create_response()
+            self._next_request()
+            if self._request_cap_reached() or self.paused:
+                break
 
     def write(self):
         # first check for a request and if one does not exist then create create_respponse is called
-        if self.request:
+        if self.request is not None:
             if not self.response_created:
                 self.create_response()
         # this is where you would see the socket.send() in past versions
-        self._write()
+        # returns what _write() did
+        return self._write()
 
     def close(self):
-        print("closing connection to", self.addr)
+        if hooks.connection_closed is not None:
+            hooks.connection_closed(self)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._spool is not None:
+            # the body never arrived completely
+            self._spool.close()
+            self._spool = None
+        if self.flow is not None:
+            # whatever was not sent no longer counts towards the budget
+            self.flow.sent(self._send_buffer.memory)
+            if self.paused:
+                self.paused = False
+                self.flow.resumed()
+        # closes any files we were in the middle of sending
+        self._send_buffer.close()
+        if self.stats is not None:
+            self.stats["active-connections"] -= 1
         try:
             self.selector.unregister(self.sock)
         except Exception as e:
@@ -186,6 +544,16 @@ class Message:
             # Delete reference to socket object for garbage collection
             self.sock = None
 
+    def _should_spool(self, content_length):
+        return self.spool_threshold is not None and content_length >= max(self.spool_threshold, 1)
+
+    def _spooled_body(self, content_type, content_encoding):
+        # the codecs and the decompressors need the body as something bytes-like, so only raw bodies can be a file
+        as_file = self.spool_as_file and not has_codec(content_type) and "+" not in content_encoding
+        data = self._spool.body(as_file)
+        self._spool = None
+        return data
+
     def process_protoheader(self):
         # so this one would check and process the fixed length header
         # when the server has read at least 2 bytes the fixed length header can be processed
@@ -193,11 +561,11 @@ class Message:
         hdrlen = 2
         if len(self._recv_buffer) >= hdrlen:
             # the processing involves getting the length of the json header
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
-            )[0]
-            # after processing, remove this from the buffer
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            # consume() hands back a view and moves the buffer past it, so it is removed from the buffer as well
+            value = struct.unpack(">H", self._recv_buffer.consume(hdrlen))[0]
+            # the top bit marks a binary header (libheader), the rest is still the header length
+            self._binary_header = bool(value & BINARY_HEADER_FLAG)
+            self._jsonheader_len = value & ~BINARY_HEADER_FLAG
 
     def process_jsonheader(self):
         # this one would check and process for the json header
@@ -208,11 +576,14 @@ class Message:
             # _json_decode() is run to deserialize the json header into a dictionary
             # de/serialization is the process by which an object is converted into a byte stream (serial) or
             # reconstructure from a byte stream (deserial)
-            self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
-            )
-            # remove the jsonheader from the buffer
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            # the jsonheader is consumed (removed) from the buffer at the same time
+            # a binary header is unpacked into the same dict so nothing below needs to care which one it was
+            if self._binary_header:
+                self.jsonheader = unpack_binary_header(self._recv_buffer.consume(hdrlen))
+            else:
+                self.jsonheader = self._json_decode(
+                    self._recv_buffer.consume(hdrlen), "utf-8"
+                )
             # checks for certain headers ni the jsonheader
             for reqhdr in (
                 "byteorder",
@@ -222,6 +593,23 @@ class Message:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f'Missing required header "{reqhdr}".')
+            # before anything is allocated for the content
+            check_content_length(self.jsonheader["content-length"])
+            # request-id is optional; a client that sends it wants to pipeline, which needs keep-alive
+            if "request-id" in self.jsonheader and self.keep_alive:
+                self.pipelined = True
+            # the client lists the compressions it can read; this sticks for the rest of the connection
+            if "accept-encoding" in self.jsonheader:
+                self.compression = choose_compression(self.jsonheader["accept-encoding"])
+                self._send_accept_encoding = True
+            # now that we know how big the content is, make room for all of it so it is received in one piece
+            # (or, for a body that is too big for that, start a spool file it is written to as it comes in)
+            if self._should_spool(self.jsonheader["content-length"]):
+                self._spool = Spool(self.jsonheader["content-length"], self.spool_dir)
+            else:
+                self._recv_buffer.reserve(self.jsonheader["content-length"])
+            if hooks.header_parsed is not None:
+                hooks.header_parsed(self, self.jsonheader)
 
     def process_request(self):
         # lastly this would check and process the content
@@ -230,39 +618,147 @@ class Message:
         # if so we move on and grab the data
         # how do we know if there are enough bytes? we check the content-length in the json header
         content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
+        content_type = self.jsonheader["content-type"]
+        if self._spool is not None:
+            # spooled body: move what has arrived to the file and wait for the rest
+            if not self._spool.feed(self._recv_buffer):
+                return
+            data = self._spooled_body(content_type, self.jsonheader["content-encoding"])
+        elif not len(self._recv_buffer) >= content_len:
             return
-        # get the data here
-        data = self._recv_buffer[:content_len]
-        # remove it from the buffer
-        self._recv_buffer = self._recv_buffer[content_len:]
-        # check to see if the content type is text/json
-        # may be able to add in other types of content-types to handle data differnelty
-        if self.jsonheader["content-type"] == "text/json":
-            encoding = self.jsonheader["content-encoding"]
-            self.request = self._json_decode(data, encoding)
-            print("received request", repr(self.request), "from", self.addr)
         else:
-            # Binary or unknown content-type
-            self.request = data
-            print(
-                f'received {self.jsonheader["content-type"]} request from',
-                self.addr,
+            # get the data here; this is a memoryview into the receive buffer so the payload is not copied
+            data = self._recv_buffer.consume(content_len)
+        # decompress it and run it through the codec for the content-type (see libcodec)
+        # content-types without a codec are left as raw bytes
+        try:
+            self.request = decode_content(
+                data,
+                content_type,
+                self.jsonheader["content-encoding"],
+                self.jsonheader["byteorder"],
+                accepted=self._accepted_compressions,
             )
+        except ContentTooLarge as e:
+            # a compression bomb; the body is read, so the client gets an error instead (see create_response())
+            self.request = e
+        if hooks.request_decoded is not None:
+            hooks.request_decoded(self, self.jsonheader, self.request)
         # Set selector to listen for write events, we're done reading.
         # note interested in reading at this point so we set the event mask to 'w' (write)
-        self._set_selector_events_mask("w")
+        # (pipelined connections keep reading; create_response() sets the mask for those)
+        if not self.pipelined:
+            self._set_selector_events_mask("w")
 
     def create_response(self):
         # once we are done reading and the _set_selector_events_mask has been set with 'w' we can create a response
-        # in this case if we have a content-type of text/json we will create a json response
-        if self.jsonheader["content-type"] == "text/json":
+        # in this case if we have a content-type with a codec (like text/json) we will create a json response
+        # set response_created so write() doesn't create it again, and count it as served
+        self.response_created = True
+        self.requests_served += 1
+        if self.stats is not None:
+            self.stats["requests"] += 1
+        if isinstance(self.request, ContentTooLarge):
+            # answered in json whatever the content-type, there is no request to answer in kind
+            response = self._encode_response({"result": f"Error: {self.request}"}, "text/json", "utf-8")
+            self.queue_response(self.jsonheader, response)
+        elif self.jsonheader["content-type"] == ARRAY_CONTENT_TYPE:
+            if self.metrics is not None:
+                self.metrics.request("array")
+            start = time.perf_counter()
+            response = self._create_response_array_content()
+            if self.metrics is not None:
+                self.metrics.handler_time("array", time.perf_counter() - start)
+            self.queue_response(self.jsonheader, response)
+        elif has_codec(self.jsonheader["content-type"]):
+            if self.metrics is not None:
+                self.metrics.request(self._action_label(self.request))
+            cache_key = self._cache_key(self.jsonheader, self.request)
+            if cache_key is not None:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    self.queue_response(self.jsonheader, cached.response, cached=cached)
+                    return
+            if self.executor is not None and self.executor.offloads(self.request.get("action")):
+                # slow handler: run it on the pool so the other connections on this selector aren't held up;
+                # complete_job() queues the response once it is done
+                self._pending_jobs += 1
+                self.executor.submit(self, self.jsonheader, self.request)
+                if not self.pipelined:
+                    # nothing to write until then
+                    self._set_selector_events_mask("r")
+                return
             # you can sed it up to handle other content-types by just adding the logic to check and a method to create
+            start = time.perf_counter()
             response = self._create_response_json_content()
+            if self.metrics is not None:
+                self.metrics.handler_time(self._action_label(self.request), time.perf_counter() - start)
+            self.queue_response(self.jsonheader, response, cache_key=cache_key)
         else:
             # Binary or unknown content-type
+            if self.metrics is not None:
+                self.metrics.request("binary")
             response = self._create_response_binary_content()
-        message = self._create_message(**response)
-        # set response_created and add the message to the send buffer
-        self.response_created = True
-        self._send_buffer += message
\ No newline at end of file
+            self.queue_response(self.jsonheader, response)
+
+    def complete_job(self, header, content, request=None, generation=None):
+        # called on the selector loop by the executor with the result of an offloaded handler
+        # generation: search_engine.generation when the job was submitted
+        self._pending_jobs -= 1
+        if self.sock is None:
+            # the connection went away while the handler was running
+            return
+        cache_key = None
+        if generation == search_engine.generation:
+            # otherwise the index was reloaded (and the cache invalidated) while the handler ran on the old one
+            cache_key = self._cache_key(header, request)
+        self.queue_response(header, self._structured_response(header, content), cache_key=cache_key)
+        if not self.pipelined:
+            # create_response() set the mask to "r" while we waited; now there is something to write
+            self._set_selector_events_mask("w")
+        if self.edge_triggered:
+            # the socket was writable all along, so no event is coming for this; send it now
+            self._process_edge_events(0)
+
+    def _cache_key(self, header, request):
+        if self.cache is None:
+            return None
+        return self.cache.key(header, request, self.compression, header.get("header-format") == "binary")
+
+    def queue_response(self, header, response, cache_key=None, cached=None):
+        # echo the request-id back so a pipelining client can match the response to its request
+        # and answer with a binary header if the client said it can read one
+        # the first response after the client sent "accept-encoding" tells it which compressions we accept
+        # cache_key: store the response in the cache under this key; cached: the cache entry response came from
+        extra_headers = None
+        if self._send_accept_encoding:
+            extra_headers = {"accept-encoding": compressions()}
+            self._send_accept_encoding = False
+            self._accepted_compressions = extra_headers["accept-encoding"]
+        if cache_key is not None:
+            cached = self.cache.put(cache_key, response)
+        if cached is not None and header.get("request-id") is None and not extra_headers:
+            # the cached bytes are framed without a request-id, exactly what this response is
+            message = (cached.message,)
+        else:
+            message = self._create_message(
+                **response,
+                request_id=header.get("request-id"),
+                binary_header=header.get("header-format") == "binary",
+                extra_headers=extra_headers,
+            )
+        # add the message to the send buffer; the parts are queued as they are, nothing is copied
+        memory = self._send_buffer.memory
+        self._send_buffer.extend(message)
+        if hooks.response_queued is not None:
+            hooks.response_queued(self, header, sum(len(part) for part in message))
+        if self.flow is not None:
+            self.flow.queued(self._send_buffer.memory - memory)
+        if self.pipelined:
+            if self.paused:
+                return
+            if self.flow is not None and self.flow.should_pause(self._send_buffer.memory):
+                self._pause()
+                return
+            # keep reading more requests while this one is written, unless that was the last one we will serve
+            self._set_selector_events_mask("w" if self._request_cap_reached() else "rw")
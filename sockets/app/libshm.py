@@ -0,0 +1,341 @@
+import json
+import errno
+import select
+import platform
+import socket
+import selectors
+from multiprocessing import resource_tracker, shared_memory
+
+from libbuffer import RecvBuffer
+from libcodec import decode_content, encode_content
+from libheader import PROTO_HEADER, create_message_parts, decode_header, split_proto_header
+from libserver import Message
+
+# shared memory transport for a client and a server on the same machine
+# over a socket (even a unix domain one) every byte is copied twice by the kernel, once into the socket buffer and once
+# out of it, a few hundred KB per system call. Here the bytes go through two rings in shared memory instead, one for
+# the requests and one for the responses: the writer copies a message into its ring and the reader copies it out, no
+# system calls however big the message is. The messages are framed exactly like on a socket (proto header, header,
+# content), so libserver.Message parses them unchanged.
+#
+# the client connects to a unix domain socket as usual (SHM_PATH in socket_app_host); the server makes the two rings
+# and sends their names back as one json line, and from then on the socket only carries doorbells: one byte sent after
+# writing into a ring so the reader's selector wakes up, and one sent after reading from a ring that was full so a
+# writer waiting for room can go on. A doorbell doesn't say which of those it is, the reader of one just looks at both
+# rings. The server side is ShmMessage on a ShmChannel, which looks enough like a non-blocking socket for Message and
+# libbuffer; ShmClient is a blocking client.
+#
+# the rings have no locks: only the writer moves head and only the reader moves tail, and each copies the data before
+# it moves its counter. That relies on the other process seeing the stores in the order they were made, which x86-64
+# guarantees; on cpus with a weaker memory model (arm) it would need memory barriers, which python has no way to make.
+# So the channels refuse to start anywhere else (check_platform(), which socket_app_host also calls before it listens
+# on SHM_PATH); unix domain sockets are the next best thing there.
+
+RING_SIZE = 16 * 1024 * 1024  # bytes each ring holds; the server picks it and tells the client
+# platform.machine() of the cpus whose memory ordering the rings rely on (linux/mac say x86_64, windows AMD64)
+SUPPORTED_MACHINES = ("x86_64", "amd64")
+HELLO_MAX = 4096  # the most doorbell bytes read at once (and the longest hello line)
+
+# a ring's segment starts with the head and tail counters, each on its own cache line so the writer and the reader
+# don't keep taking the line from each other; they are indexes into the segment's first bytes seen as unsigned 64 bit
+HEAD = 0
+TAIL = 8
+HEADER_SIZE = 128
+
+
+def check_platform():
+    # raises RuntimeError where the rings would need memory barriers (see above)
+    machine = platform.machine()
+    if machine.lower() not in SUPPORTED_MACHINES:
+        raise RuntimeError(f"The shared memory transport needs an x86-64 cpu, not {machine or 'an unknown one'}.")
+
+
+class Ring:
+    # one direction of a channel: a single producer, single consumer byte ring in a shared memory segment
+    # head and tail count the bytes ever written and read, so head - tail bytes are waiting, starting at tail % size
+    def __init__(self, shm, size, owner):
+        self.shm = shm
+        self.size = size
+        # the segment's creator unlinks it when the channel closes
+        self.owner = owner
+        self._counters = shm.buf[:HEADER_SIZE].cast("Q")
+        self._data = shm.buf[HEADER_SIZE:HEADER_SIZE + size]
+
+    @classmethod
+    def create(cls, size):
+        # a new segment is all zeros, i.e. an empty ring
+        return cls(shared_memory.SharedMemory(create=True, size=HEADER_SIZE + size), size, owner=True)
+
+    @classmethod
+    def attach(cls, name, size):
+        # the resource tracker unlinks every segment a process used when it exits, taking it for a leak; this one
+        # belongs to the other side, which unlinks it when the connection closes
+        try:
+            shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # before python 3.13 there is no opting out, only unregistering again
+            shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(shm._name, "shared_memory")
+        if shm.size < HEADER_SIZE + size:
+            shm.close()
+            raise ValueError(f"Shared memory {name!r} is too small for a {size} byte ring.")
+        return cls(shm, size, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __len__(self):
+        # bytes waiting to be read
+        return self._counters[HEAD] - self._counters[TAIL]
+
+    def write(self, buffers):
+        # copies as much of buffers (bytes-like objects, in order) as there is room for; returns how many bytes that was
+        head = self._counters[HEAD]
+        room = self.size - (head - self._counters[TAIL])
+        written = 0
+        for buf in buffers:
+            if written == room:
+                break
+            view = memoryview(buf).cast("B")
+            nbytes = min(len(view), room - written)
+            self._copy_in(head + written, view[:nbytes])
+            written += nbytes
+        # only now can the reader see it
+        self._counters[HEAD] = head + written
+        return written
+
+    def read_into(self, buffer):
+        # copies as much as is waiting (up to len(buffer)) into buffer; returns how many bytes that was and how many
+        # were waiting before, both from the one look at head (the writer may move it again at any time)
+        tail = self._counters[TAIL]
+        waiting = self._counters[HEAD] - tail
+        nbytes = min(len(buffer), waiting)
+        if nbytes:
+            start = tail % self.size
+            first = min(nbytes, self.size - start)
+            buffer[:first] = self._data[start:start + first]
+            buffer[first:nbytes] = self._data[:nbytes - first]
+            # and only now may the writer reuse the space
+            self._counters[TAIL] = tail + nbytes
+        return nbytes, waiting
+
+    def _copy_in(self, position, view):
+        start = position % self.size
+        first = min(len(view), self.size - start)
+        self._data[start:start + first] = view[:first]
+        self._data[:len(view) - first] = view[first:]
+
+    def close(self):
+        # the views have to go before the segment can be unmapped
+        self._counters.release()
+        self._data.release()
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ShmChannel:
+    # a connection: a ring each way and the unix socket for the doorbells
+    # the socket-like part: recv_into/send/sendmsg raise BlockingIOError when the ring is empty/full and recv_into
+    # returns 0 once the peer has hung up; fileno() is the doorbell socket's, for the selector
+    # the server's doorbell socket is non-blocking and a client's blocks, so that wait() is a single recv; the doorbells
+    # are sent and drained with MSG_DONTWAIT, which doesn't block either way
+    def __init__(self, sock, rx, tx):
+        self.sock = sock
+        self._rx = rx
+        self._tx = tx
+        self.peer_closed = False
+        self._poller = None
+
+    @classmethod
+    def accept(cls, conn, size=RING_SIZE):
+        # the server side of a connection accepted on the doorbell socket: makes the rings and tells the client about
+        # them; conn is non-blocking, but a fresh socket always has room for the hello
+        check_platform()
+        rx = Ring.create(size)
+        try:
+            tx = Ring.create(size)
+        except BaseException:
+            rx.close()
+            raise
+        hello = {"requests": rx.name, "responses": tx.name, "size": size}
+        try:
+            conn.sendall((json.dumps(hello) + "\n").encode("utf-8"))
+        except BaseException:
+            rx.close()
+            tx.close()
+            raise
+        return cls(conn, rx, tx)
+
+    @classmethod
+    def connect(cls, path, timeout=None):
+        # the client side; blocks until the server has sent the names of the rings
+        check_platform()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            line = b""
+            while not line.endswith(b"\n"):
+                if len(line) > HELLO_MAX:
+                    raise ValueError("Shared memory hello too long.")
+                data = sock.recv(HELLO_MAX)
+                if not data:
+                    raise ConnectionError("Peer closed.")
+                line += data
+            hello = json.loads(line)
+            sock.settimeout(None)
+            rx = Ring.attach(hello["responses"], hello["size"])
+            try:
+                tx = Ring.attach(hello["requests"], hello["size"])
+            except BaseException:
+                rx.close()
+                raise
+        except BaseException:
+            sock.close()
+            raise
+        return cls(sock, rx, tx)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv_into(self, buffer):
+        nbytes, waiting = self._rx.read_into(buffer)
+        if not nbytes:
+            if self.peer_closed:
+                return 0
+            raise BlockingIOError(errno.EAGAIN, "Nothing in the ring.")
+        if waiting == self._rx.size:
+            # the writer may be waiting for room. Whether the ring was full has to come from the same look at head as
+            # the read: looked at before, a writer filling it up in between would never hear that there is room again
+            # (looked at after, neither would one that filled it up and then found no room for the rest)
+            self._ring()
+        return nbytes
+
+    def send(self, data):
+        return self.sendmsg([data])
+
+    def sendmsg(self, buffers):
+        nbytes = self._tx.write(buffers)
+        if not nbytes:
+            raise BlockingIOError(errno.EAGAIN, "No room in the ring.")
+        self._ring()
+        return nbytes
+
+    def _ring(self):
+        try:
+            self.sock.send(b"\0", socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            # the peer has a socket buffer full of doorbells it hasn't read yet; it will look at the rings anyway
+            pass
+
+    def drain(self, flags=socket.MSG_DONTWAIT):
+        # reads the doorbells that have come in; returns False once the peer has hung up
+        while True:
+            try:
+                data = self.sock.recv(HELLO_MAX, flags)
+            except BlockingIOError:
+                return True
+            except ConnectionResetError:
+                # a unix socket closed with doorbells still unread in it resets instead of sending an eof
+                data = b""
+            if not data:
+                self.peer_closed = True
+                return False
+            if len(data) < HELLO_MAX:
+                return True
+            flags = socket.MSG_DONTWAIT
+
+    def wait(self, timeout=None):
+        # blocks until a doorbell comes in (clients; the server has its selector); raises TimeoutError
+        if timeout is not None:
+            if self._poller is None:
+                self._poller = select.poll()
+                self._poller.register(self.sock, select.POLLIN)
+            if not self._poller.poll(timeout * 1e3):
+                raise TimeoutError("No doorbell from the peer.")
+        return self.drain(flags=0)
+
+    def close(self):
+        self.sock.close()
+        self._rx.close()
+        self._tx.close()
+
+
+class ShmMessage(Message):
+    # libserver.Message on a ShmChannel (its sock); keep-alive, pipelining, deadlines and so on all work as they do on
+    # a socket
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the selector only hears the doorbells, never whether a ring has data or room, which is the situation the edge
+        # triggered loop (Message._process_edge_events) is made for: it keeps track of that itself and never modify()s
+        # the registration. The response ring starts out empty
+        self.edge_triggered = True
+        self._writable = True
+
+    def process_events(self, mask):
+        # every event is a doorbell: the client wrote requests, or read responses and made room
+        if not self.sock.drain():
+            # the client is gone, nobody is left to read the responses
+            self.close()
+            return
+        self._process_edge_events(selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+
+class ShmClient:
+    # a blocking client, one request at a time; path is the server's SHM_PATH
+    def __init__(self, path, timeout=None):
+        self.timeout = timeout
+        self.channel = ShmChannel.connect(path, timeout)
+        self._recv_buffer = RecvBuffer()
+
+    def request(self, content, content_type="text/json", encoding="utf-8"):
+        # returns (header, content) of the response; binary content is a view into the receive buffer, not a copy
+        content_bytes, content_encoding = encode_content(content, content_type, encoding)
+        self._send(
+            create_message_parts(
+                content_bytes=content_bytes, content_type=content_type, content_encoding=content_encoding
+            )
+        )
+        return self._receive()
+
+    def _send(self, parts):
+        parts = [memoryview(part) for part in parts if len(part)]
+        while parts:
+            try:
+                sent = self.channel.sendmsg(parts)
+            except BlockingIOError:
+                if not self.channel.wait(self.timeout):
+                    raise ConnectionError("Peer closed.")
+                continue
+            while sent:
+                if sent >= len(parts[0]):
+                    sent -= len(parts.pop(0))
+                else:
+                    parts[0] = parts[0][sent:]
+                    sent = 0
+
+    def _recv_exactly(self, nbytes):
+        while len(self._recv_buffer) < nbytes:
+            try:
+                received = self._recv_buffer.recv_into(self.channel)
+            except BlockingIOError:
+                self.channel.wait(self.timeout)
+                continue
+            if not received:
+                raise ConnectionError("Peer closed.")
+        return self._recv_buffer.consume(nbytes)
+
+    def _receive(self):
+        hdrlen, binary_header = split_proto_header(PROTO_HEADER.unpack(self._recv_exactly(PROTO_HEADER.size))[0])
+        header = decode_header(self._recv_exactly(hdrlen), binary_header)
+        self._recv_buffer.reserve(header["content-length"])
+        data = self._recv_exactly(header["content-length"])
+        return header, decode_content(data, header["content-type"], header["content-encoding"], header["byteorder"])
+
+    def close(self):
+        self.channel.close()
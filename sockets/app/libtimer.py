@@ -0,0 +1,92 @@
+import math
+import time
+
+# hashed timer wheel for the selector loop
+# the host used to close idle connections by looking at every connection once a second, which with 100k connections is
+# 100k checks a second whether anything timed out or not. The wheel keeps the timers in a ring of slots, one slot per
+# tick: a timer due at tick t goes in slot t % slots, so scheduling and cancelling are a set add/remove, and every tick
+# only the timers of one slot are looked at. Timers further out than one turn of the wheel share a slot with nearer ones
+# and are skipped until their turn comes around.
+#
+# the loop calls advance() after every select and uses next_timeout() for the select timeout; callbacks run on the loop
+# from advance(). Timers fire on the first tick at or after their deadline, so up to `tick` seconds late.
+
+TICK = 0.5  # seconds
+SLOTS = 512
+
+
+class Timer:
+    __slots__ = ("due", "callback", "_wheel", "_slot")
+
+    def __init__(self, wheel, due, callback):
+        self.due = due  # the tick it fires on
+        self.callback = callback
+        self._wheel = wheel
+        self._slot = None
+
+    @property
+    def active(self):
+        return self._slot is not None
+
+    def cancel(self):
+        # safe to call more than once, and for a timer that has already fired
+        if self._slot is not None:
+            self._slot.discard(self)
+            self._slot = None
+            self._wheel._count -= 1
+
+
+class TimerWheel:
+    def __init__(self, tick=TICK, slots=SLOTS, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self._slots = [set() for _ in range(slots)]
+        # the last tick advance() has run
+        self._current = int(clock() / tick)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, callback):
+        # callback() is called once, delay seconds from now (or up to a tick later); returns the Timer to cancel it
+        due = max(math.ceil((self.clock() + delay) / self.tick), self._current + 1)
+        timer = Timer(self, due, callback)
+        timer._slot = self._slots[due % len(self._slots)]
+        timer._slot.add(timer)
+        self._count += 1
+        return timer
+
+    def next_timeout(self):
+        # seconds until the next tick, or None with no timers (for sel.select)
+        if not self._count:
+            return None
+        return max((self._current + 1) * self.tick - self.clock(), 0)
+
+    def advance(self):
+        # runs the callbacks of the timers that are due; returns how many there were
+        now = int(self.clock() / self.tick)
+        expired = []
+        if now - self._current >= len(self._slots):
+            # the loop was stuck for a whole turn of the wheel (or more); every slot has to be looked at anyway
+            for slot in self._slots:
+                self._collect(slot, now, expired)
+        else:
+            while self._current < now:
+                self._current += 1
+                self._collect(self._slots[self._current % len(self._slots)], self._current, expired)
+        self._current = now
+        # run them once the wheel is in order again, the callbacks may well schedule new timers
+        for timer in expired:
+            timer.callback()
+        return len(expired)
+
+    def _collect(self, slot, now, expired):
+        if not slot:
+            return
+        due = [timer for timer in slot if timer.due <= now]
+        for timer in due:
+            slot.remove(timer)
+            timer._slot = None
+        self._count -= len(due)
+        expired.extend(due)
@@ -0,0 +1,177 @@
+import json
+import time
+import random
+
+# tracing hooks for libserver.Message and libclient.Message
+# Message used to print() on every accept, request, write and close. Under load the printing (the repr of every
+# request, a write to stdout each time) cost more than serving the requests, so the prints are now events on `hooks`
+# and whoever is interested subscribes to them:
+#
+#   connection_opened(message)                       accepted by a server, or a client's Message was made
+#   header_parsed(message, header)                   the json/binary header of a request has been read
+#   request_decoded(message, header, request)        the content has been received and decoded
+#   response_queued(message, header, nbytes)         a response (nbytes on the wire) went into the send buffer
+#   bytes_sent(message, nbytes)                      one send()/sendmsg()/sendfile() call
+#   deadline_passed(message, kind)                   its idle, header or request deadline ran out (libtimer); closing
+#   response_decoded(message, header, response)     a client received and decoded a response
+#   connection_closed(message)
+#
+# a client reports connection_opened, bytes_sent, response_decoded and connection_closed; the others are the server's
+#
+# a subscriber is any object with methods named after (some of) the events. Every event is an attribute of hooks that
+# is None while nobody subscribes to it, so the call sites are `if hooks.x is not None: hooks.x(...)`, one attribute
+# lookup when tracing is off; no arguments are built and nothing is formatted.
+#
+# the subscribers here: LogSubscriber prints the events of a sample of the connections (what the prints used to show)
+# and TimingSubscriber writes a json line per request with where its time went.
+
+EVENTS = (
+    "connection_opened",
+    "header_parsed",
+    "request_decoded",
+    "response_queued",
+    "bytes_sent",
+    "deadline_passed",
+    "response_decoded",
+    "connection_closed",
+)
+
+
+class Hooks:
+    def __init__(self):
+        self._subscribers = []
+        self._update()
+
+    def subscribe(self, subscriber):
+        self._subscribers.append(subscriber)
+        self._update()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.remove(subscriber)
+        self._update()
+
+    def _update(self):
+        # one attribute per event: None, the only subscriber's method, or a function calling all of them
+        for event in EVENTS:
+            methods = [getattr(s, event) for s in self._subscribers if hasattr(s, event)]
+            if not methods:
+                setattr(self, event, None)
+            elif len(methods) == 1:
+                setattr(self, event, methods[0])
+            else:
+                setattr(self, event, _fan_out(methods))
+
+
+def _fan_out(methods):
+    def call(*args):
+        for method in methods:
+            method(*args)
+
+    return call
+
+
+# the hooks every Message reports to
+hooks = Hooks()
+
+
+class LogSubscriber:
+    # prints every event of a sample of the connections; sample is the fraction of connections (1 for all of them)
+    # sampling by connection rather than by event keeps the story of a connection together
+    def __init__(self, sample=1.0, log=print):
+        self.sample = sample
+        self.log = log
+        self._sampled = set()
+
+    def connection_opened(self, message):
+        if random.random() < self.sample:
+            self._sampled.add(id(message))
+            self.log("connection opened with", message.addr)
+
+    def header_parsed(self, message, header):
+        if id(message) in self._sampled:
+            self.log("received header", header, "from", message.addr)
+
+    def request_decoded(self, message, header, request):
+        if id(message) in self._sampled:
+            self._log_content("request", header, request, message.addr)
+
+    def response_decoded(self, message, header, response):
+        if id(message) in self._sampled:
+            self._log_content("response", header, response, message.addr)
+
+    def response_queued(self, message, header, nbytes):
+        if id(message) in self._sampled:
+            self.log("queued", nbytes, "byte response for request", header.get("request-id"), "to", message.addr)
+
+    def bytes_sent(self, message, nbytes):
+        if id(message) in self._sampled:
+            self.log("sent", nbytes, "bytes to", message.addr)
+
+    def deadline_passed(self, message, kind):
+        if id(message) in self._sampled:
+            self.log(kind, "deadline passed for", message.addr)
+
+    def connection_closed(self, message):
+        if id(message) in self._sampled:
+            self._sampled.discard(id(message))
+            self.log("closing connection to", message.addr)
+
+    def _log_content(self, kind, header, content, addr):
+        if isinstance(content, (bytes, bytearray, memoryview)) or hasattr(content, "read"):
+            # raw content can be megabytes (or a spool file); the size says enough
+            self.log(f'received {header["content-type"]} {kind} of {header["content-length"]} bytes from', addr)
+        else:
+            self.log(f"received {kind}", repr(content), "from", addr)
+
+
+class TimingSubscriber:
+    # writes one json line per request to path:
+    #   time: when the header was parsed (unix time), addr, request-id, action, request-bytes, response-bytes
+    #   receive-us: header parsed -> content received and decoded
+    #   handle-us: decoded -> response queued (the handler, or the wait for the executor, plus encoding)
+    # lines are buffered; close() (or flush()) writes out the rest
+    def __init__(self, path, buffering=65536):
+        self.file = open(path, "a", encoding="utf-8", buffering=buffering)
+        # (id(message), request-id) -> [header time, decoded time, action, request bytes]
+        self._pending = {}
+
+    def header_parsed(self, message, header):
+        self._pending[(id(message), header.get("request-id"))] = [
+            time.perf_counter(), None, None, header["content-length"]
+        ]
+
+    def request_decoded(self, message, header, request):
+        timing = self._pending.get((id(message), header.get("request-id")))
+        if timing is not None:
+            timing[1] = time.perf_counter()
+            timing[2] = request.get("action") if isinstance(request, dict) else None
+
+    def response_queued(self, message, header, nbytes):
+        timing = self._pending.pop((id(message), header.get("request-id")), None)
+        if timing is None or timing[1] is None:
+            return
+        now = time.perf_counter()
+        started, decoded, action, request_bytes = timing
+        record = {
+            "time": time.time() - (now - started),
+            "addr": str(message.addr),
+            "request-id": header.get("request-id"),
+            "action": action,
+            "request-bytes": request_bytes,
+            "response-bytes": nbytes,
+            "receive-us": round((decoded - started) * 1e6, 1),
+            "handle-us": round((now - decoded) * 1e6, 1),
+        }
+        self.file.write(json.dumps(record) + "\n")
+
+    def connection_closed(self, message):
+        # requests that never got an answer
+        for key in [key for key in self._pending if key[0] == id(message)]:
+            del self._pending[key]
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
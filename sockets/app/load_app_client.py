@@ -0,0 +1,396 @@
+import sys
+import json
+import math
+import time
+import argparse
+import selectors
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import libclient
+from libclient import Message
+from libcodec import compressions
+
+# load generator for socket_app_host.py, built on libclient.Message
+# two ways to drive the server for a fixed duration:
+#   - concurrency (closed loop): every connection keeps --depth requests in flight and sends the next one as soon as
+#     an answer comes back; shows the throughput the server manages at that concurrency
+#   - rate (open loop): requests are sent on a fixed schedule (--rate per second over --connections connections)
+#     whether or not the earlier ones have been answered. Latency is measured from when a request was due, not from
+#     when it was actually written, so a server falling behind shows up in the percentiles instead of quietly lowering
+#     the request rate (coordinated omission)
+#
+# connections are pipelined keep-alive connections (the host needs KEEP_ALIVE on); each one sends at most
+# --requests-per-connection requests (the host's MAX_REQUESTS, it closes the connection after that many) and is then
+# replaced by a new one, so connection setup is part of the numbers just like it is for real clients.
+#
+# reports throughput, latency percentiles, errors and bytes sent/received; --json writes the same numbers as json for
+# comparing runs. One python process tops out at some ten thousand requests per second; use --processes to spread the
+# load over more cores (each process takes its share of the connections and rate, the results are merged).
+#
+# usage: python load_app_client.py --concurrency 32 --duration 10
+#        python load_app_client.py --rate 5000 --connections 64 --json results.json
+
+HOST = "127.0.0.1"
+PORT = 65000
+DURATION = 10  # seconds
+CONNECTIONS = 16
+DEPTH = 1  # requests in flight per connection in concurrency mode
+REQUESTS_PER_CONNECTION = 100  # socket_app_host.MAX_REQUESTS
+DRAIN_TIMEOUT = 5  # seconds to wait for the answers still outstanding when the duration is up
+RECONNECT_DELAY = 0.1  # seconds without new connections after one failed, so a server that is down isn't hammered
+PERCENTILES = (50, 90, 99, 99.9)
+VALUES = ["morpheus", "ring", "\U0001f436"]
+
+
+class LoadMessage(Message):
+    def __init__(self, selector, sock, addr, request, load, limit, **kwargs):
+        super().__init__(selector, sock, addr, request, keep_alive=True, pipeline=True, **kwargs)
+        self.load = load
+        # requests handed to this connection so far, and how many it may get
+        self.sent = 1
+        self.limit = limit
+        # a pipelined Message closes itself as soon as every request has been answered; we want to keep the
+        # connection for the next one, so close() only really closes once the connection is retired
+        self.retired = False
+
+    def outstanding(self):
+        # requests not answered yet; the first one sits in self.request until it is queued
+        return len(self.in_flight) + len(self.pending_requests) + (not self._request_queued)
+
+    def has_room(self):
+        return self.sock is not None and not self.retired and self.sent < self.limit
+
+    def add_request(self, request):
+        self.sent += 1
+        super().add_request(request)
+
+    def queue_request(self):
+        before = len(self._send_buffer)
+        super().queue_request()
+        self.load.stats["bytes-sent"] += len(self._send_buffer) - before
+
+    def _process_response_json_content(self):
+        result = self.response.get("result") if isinstance(self.response, dict) else None
+        self._answered(isinstance(result, str) and result.startswith("Error"))
+
+    def _process_response_array_content(self):
+        self._answered(False)
+
+    def _process_response_binary_content(self):
+        self._answered(False)
+
+    def _answered(self, failed):
+        # called by process_response() before it matches the response to its request
+        request = self.in_flight.get(self.jsonheader.get("request-id"))
+        nbytes = 2 + self._jsonheader_len + self.jsonheader["content-length"]
+        if self.sent >= self.limit and self.outstanding() <= 1:
+            # the last answer this connection is going to get
+            self.retired = True
+        self.load.answered(request, nbytes, failed)
+
+    def close(self):
+        if self.retired and self.sock is not None:
+            super().close()
+
+
+class LoadRun:
+    def __init__(
+        self,
+        addr,
+        duration=DURATION,
+        connections=CONNECTIONS,
+        depth=DEPTH,
+        rate=None,
+        requests_per_connection=REQUESTS_PER_CONNECTION,
+        action="search",
+        mode="exact",
+        values=VALUES,
+        request_type="text/json",
+        header_format="binary",
+        accept_encoding=None,
+    ):
+        # rate: requests per second (open loop); None for concurrency mode, connections * depth requests in flight
+        self.addr = addr
+        self.duration = duration
+        self.max_connections = connections
+        self.depth = depth
+        self.rate = rate
+        self.limit = requests_per_connection
+        self.action = action
+        self.mode = mode
+        self.values = values
+        self.request_type = request_type
+        self.header_format = header_format
+        self.accept_encoding = accept_encoding
+        self.sel = selectors.DefaultSelector()
+        self.connections = []
+        # requests that found every connection full (all at their request limit and waiting to be replaced)
+        self.backlog = deque()
+        # no new connections before this (perf_counter) time
+        self.connect_after = 0
+        self.latencies = array("d")
+        self.stats = Counter()
+        self.start = self.end = None
+        self.last_answer = None
+
+    def create_request(self, due):
+        value = self.values[self.stats["requests"] % len(self.values)]
+        self.stats["requests"] += 1
+        content = dict(action=self.action, value=value)
+        if self.mode != "exact":
+            content["mode"] = self.mode
+        return dict(
+            type=self.request_type,
+            encoding="utf-8" if self.request_type == "text/json" else "binary",
+            content=content,
+            # libclient.Message only looks at type/encoding/content; this is for us
+            due=due,
+        )
+
+    def dispatch(self, request):
+        # to a new connection while we are below the connection count, else the one with the fewest outstanding
+        self.connections = [message for message in self.connections if message.sock is not None]
+        if self.can_connect():
+            self.connect(request)
+            return
+        message = min((m for m in self.connections if m.has_room()), key=LoadMessage.outstanding, default=None)
+        if message is None:
+            self.backlog.append(request)
+        else:
+            message.add_request(request)
+
+    def can_connect(self):
+        return len(self.connections) < self.max_connections and time.perf_counter() >= self.connect_after
+
+    def connect(self, request):
+        # pipelined small requests would otherwise wait on nagle + delayed acks and measure those instead
+        sock = libclient.start_connect(*self.addr, nodelay=True)
+        message = LoadMessage(
+            self.sel,
+            sock,
+            self.addr,
+            request,
+            self,
+            self.limit,
+            header_format=self.header_format,
+            accept_encoding=self.accept_encoding,
+        )
+        self.sel.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=message)
+        self.connections.append(message)
+        self.stats["connections"] += 1
+
+    def answered(self, request, nbytes, failed):
+        now = time.perf_counter()
+        self.last_answer = now
+        self.stats["responses"] += 1
+        self.stats["bytes-received"] += nbytes
+        if failed:
+            self.stats["errors-response"] += 1
+        if request is not None:
+            self.latencies.append(now - request["due"])
+        if self.rate is None and now < self.end:
+            # closed loop: keep the number in flight up
+            self.dispatch(self.create_request(now))
+
+    def poll(self, timeout):
+        for key, mask in self.sel.select(timeout=timeout):
+            message = key.data
+            try:
+                message.process_events(mask)
+            except Exception:
+                lost = message.outstanding()
+                message.retired = True
+                message.close()
+                if lost:
+                    self.stats["errors-connection"] += 1
+                    self.stats["errors-lost"] += lost
+                    self.connect_after = time.perf_counter() + RECONNECT_DELAY
+                    if self.rate is None and time.perf_counter() < self.end:
+                        # replacements for the lost requests, sent once there is a connection for them
+                        for _ in range(lost):
+                            self.backlog.append(self.create_request(time.perf_counter()))
+                else:
+                    # closed by the server while idle (idle timeout)
+                    self.stats["disconnects"] += 1
+        self.connections = [message for message in self.connections if message.sock is not None]
+        while self.backlog and (self.can_connect() or any(m.has_room() for m in self.connections)):
+            self.dispatch(self.backlog.popleft())
+
+    def outstanding(self):
+        return len(self.backlog) + sum(message.outstanding() for message in self.connections if message.sock)
+
+    def run(self):
+        self.start = time.perf_counter()
+        self.end = self.start + self.duration
+        if self.rate is None:
+            for _ in range(self.max_connections * self.depth):
+                self.dispatch(self.create_request(self.start))
+        interval = 1 / self.rate if self.rate else None
+        next_due = self.start
+        try:
+            while True:
+                now = time.perf_counter()
+                if interval is not None:
+                    while next_due <= now and next_due < self.end:
+                        self.dispatch(self.create_request(next_due))
+                        next_due += interval
+                if now >= self.end:
+                    break
+                wake = min(next_due, self.end) if interval is not None else self.end
+                if self.backlog:
+                    wake = min(wake, max(self.connect_after, now + 0.001))
+                self.poll(max(wake - now, 0))
+            deadline = self.end + DRAIN_TIMEOUT
+            while self.outstanding() and time.perf_counter() < deadline:
+                self.poll(min(deadline - time.perf_counter(), 0.1))
+            self.stats["errors-timeout"] += self.outstanding()
+        finally:
+            for message in self.connections:
+                message.retired = True
+                message.close()
+            self.sel.close()
+        return self.stats, self.latencies
+
+
+def percentile(ordered, p):
+    # nearest rank
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def run_load(options):
+    # one process worth of load; module level so a process pool can run it
+    load = LoadRun(**options)
+    stats, latencies = load.run()
+    elapsed = max(load.end, load.last_answer or load.end) - load.start
+    return dict(stats), latencies.tobytes(), elapsed
+
+
+def summarize(config, runs):
+    stats = Counter()
+    latencies = array("d")
+    for run_stats, run_latencies, _ in runs:
+        stats.update(run_stats)
+        latencies.frombytes(run_latencies)
+    elapsed = max(elapsed for _, _, elapsed in runs)
+    ordered = sorted(latencies)
+    ms = 1000
+    latency = {"mean": sum(ordered) / len(ordered) * ms if ordered else None}
+    for p in PERCENTILES:
+        value = percentile(ordered, p)
+        latency[f"p{p:g}"] = value * ms if value is not None else None
+    latency["max"] = ordered[-1] * ms if ordered else None
+    errors = {name[len("errors-"):]: count for name, count in sorted(stats.items()) if name.startswith("errors-")}
+    return {
+        "config": config,
+        "elapsed": elapsed,
+        "requests": stats["requests"],
+        "responses": stats["responses"],
+        "throughput": stats["responses"] / elapsed if elapsed else 0.0,
+        "latency-ms": latency,
+        "errors": errors,
+        "bytes-sent": stats["bytes-sent"],
+        "bytes-received": stats["bytes-received"],
+        "connections": stats["connections"],
+        "disconnects": stats["disconnects"],
+    }
+
+
+def report(result):
+    config = result["config"]
+    mode = f"rate {config['rate']}/s" if config["rate"] else f"concurrency {config['connections'] * config['depth']}"
+    print(f"{config['host']}:{config['port']} {mode}, {config['connections']} connections, {result['elapsed']:.1f} s")
+    print(
+        f"requests: {result['requests']:,}  responses: {result['responses']:,}  "
+        f"connections: {result['connections']:,}"
+    )
+    print(f"throughput: {result['throughput']:,.0f} responses/s")
+    print("latency ms: " + "  ".join(
+        f"{name} {value:.3f}" if value is not None else f"{name} -" for name, value in result["latency-ms"].items()
+    ))
+    print("errors: " + ("  ".join(f"{name} {count}" for name, count in result["errors"].items() if count) or "none"))
+    elapsed = result["elapsed"] or 1
+    print(
+        f"bytes: sent {result['bytes-sent']:,} ({result['bytes-sent'] / elapsed / 1e6:.2f} MB/s)  "
+        f"received {result['bytes-received']:,} ({result['bytes-received'] / elapsed / 1e6:.2f} MB/s)"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="load generator for socket_app_host.py")
+    parser.add_argument("--host", default=HOST, help='or "unix:/path" for the unix domain socket of a local server')
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--duration", type=float, default=DURATION, help="seconds")
+    parser.add_argument("--connections", type=int, default=CONNECTIONS)
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--concurrency", type=int, help="requests in flight (closed loop); sets connections")
+    load.add_argument("--rate", type=float, help="requests per second (open loop)")
+    parser.add_argument("--depth", type=int, default=DEPTH, help="requests in flight per connection (closed loop)")
+    parser.add_argument("--requests-per-connection", type=int, default=REQUESTS_PER_CONNECTION)
+    parser.add_argument("--action", default="search")
+    parser.add_argument("--mode", default="exact", help="search mode: exact, prefix or fuzzy")
+    parser.add_argument("--values", default=",".join(VALUES), help="comma separated search values, used in turn")
+    parser.add_argument("--request-type", default="text/json", choices=["text/json", "binary/record"])
+    parser.add_argument("--header-format", default="binary", choices=["json", "binary"])
+    parser.add_argument("--compress", action="store_true", help="offer the server compression")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--json", metavar="PATH", help="write the results as json to PATH (- for stdout)")
+    args = parser.parse_args(argv)
+
+    connections = args.connections
+    if args.concurrency is not None:
+        connections = max(1, math.ceil(args.concurrency / args.depth))
+    config = {
+        "host": args.host,
+        "port": args.port,
+        "duration": args.duration,
+        "connections": connections,
+        "depth": args.depth,
+        "rate": args.rate,
+        "requests-per-connection": args.requests_per_connection,
+        "action": args.action,
+        "mode": args.mode,
+        "request-type": args.request_type,
+        "header-format": args.header_format,
+        "compress": args.compress,
+        "processes": args.processes,
+    }
+    processes = max(1, min(args.processes, connections))
+    shares = []
+    for i in range(processes):
+        shares.append(dict(
+            addr=(args.host, args.port),
+            duration=args.duration,
+            # split the connections (and the rate) as evenly as they go
+            connections=connections // processes + (i < connections % processes),
+            depth=args.depth,
+            rate=args.rate / processes if args.rate else None,
+            requests_per_connection=args.requests_per_connection,
+            action=args.action,
+            mode=args.mode,
+            values=args.values.split(","),
+            request_type=args.request_type,
+            header_format=args.header_format,
+            accept_encoding=compressions() if args.compress else None,
+        ))
+    if processes == 1:
+        runs = [run_load(shares[0])]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            runs = list(pool.map(run_load, shares))
+    result = summarize(config, runs)
+    if args.json == "-":
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        return
+    report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from libpool import Client
+from libcodec import compressions
+
+
+# synchronous client built on the connection pool in libpool
+# a handful of threads share MAX_CONNECTIONS persistent connections, so the lookups below pay for at most that many
+# tcp handshakes instead of one per request
+HOST = '192.168.86.29'
+PORT = 65000  # port to listen on
+MAX_CONNECTIONS = 4
+THREADS = 8
+LOOKUPS = 1000
+
+queries = ['morpheus', 'ring', '\U0001f436', 'neo']
+
+with Client(HOST, PORT, max_connections=MAX_CONNECTIONS, accept_encoding=compressions()) as client:
+    print(client.call('search', 'morpheus').get('result'))
+
+    # call_many pipelines a batch over one connection and returns the results in order
+    for query, content in zip(queries, client.call_many([('search', query) for query in queries])):
+        print(f"{query}: {content.get('result')}")
+
+    # search_many looks up a whole list with one request per 1000 values
+    for item in client.search_many(queries):
+        print(f"{item['value']}: {item.get('result', item.get('error'))}")
+
+    # call() is thread safe; every thread borrows a connection from the pool for each call
+    start = time.perf_counter()
+    with ThreadPoolExecutor(THREADS) as threads:
+        results = list(threads.map(lambda i: client.call('search', queries[i % len(queries)]), range(LOOKUPS)))
+    elapsed = time.perf_counter() - start
+    print(f"{LOOKUPS} lookups from {THREADS} threads in {elapsed:.3f}s ({LOOKUPS / elapsed:.0f}/s)")
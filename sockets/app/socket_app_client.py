@@ -1,19 +1,21 @@
 
 import sys
-import socket
+import array
 import selectors
 import traceback
 
-from libclient import Message
+from libclient import Message, socket_address, start_connect
+from libcodec import ARRAY_CONTENT_TYPE, compressions
+from libtrace import LogSubscriber, hooks
 
 sel = selectors.DefaultSelector()
 
 
 def create_request(action, value):
-    if action == "search":
+    if action in ("search", "search_many"):
         return dict(
-            type="text/json",
-            encoding="utf-8",
+            type=REQUEST_TYPE,
+            encoding="utf-8" if REQUEST_TYPE == "text/json" else "binary",
             content=dict(action=action, value=value),
         )
     else:
@@ -24,14 +26,40 @@ def create_request(action, value):
         )
 
 
-def start_connection(host, port, request):
-    addr = (host, port)
+def create_batch_requests(values, batch_size=None):
+    # search_many requests for any number of values; the server takes at most BATCH_SIZE per request, so big batches
+    # are split up (and pipelined like any other requests)
+    batch_size = batch_size or BATCH_SIZE
+    return [create_request("search_many", values[i:i + batch_size]) for i in range(0, len(values), batch_size)]
+
+
+def create_array_request(values, typecode="d"):
+    # a vector of numbers (sensor readings and such) sent as raw items instead of a json list (binary/array, see
+    # libcodec); the server sends it back
+    return dict(type=ARRAY_CONTENT_TYPE, encoding="binary", content=array.array(typecode, values))
+
+
+def start_connection(host, port, requests):
+    # all of the requests are sent over a single keep-alive connection; with PIPELINE they are all sent straight away
+    # and the responses are matched back up by request-id, otherwise they are sent one after the other
+    # host can also be "unix:/path/to/socket" for a server on this machine (see libclient.socket_address)
+    addr = socket_address(host, port)[1]
     print("starting connection to", addr)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setblocking(False)
-    sock.connect_ex(addr)
+    sock = start_connect(host, port)
     events = selectors.EVENT_READ | selectors.EVENT_WRITE
-    message = Message(sel, sock, addr, request)
+    message = Message(
+        sel,
+        sock,
+        addr,
+        requests[0],
+        keep_alive=len(requests) > 1,
+        pipeline=PIPELINE,
+        header_format=HEADER_FORMAT,
+        accept_encoding=ACCEPT_ENCODING,
+        spool_threshold=SPOOL_THRESHOLD,
+    )
+    for request in requests[1:]:
+        message.add_request(request)
     sel.register(sock, events, data=message)
 
 
@@ -41,11 +69,22 @@ def start_connection(host, port, request):
 
 HOST = '192.168.86.29'
 PORT = 65000  # port to listen on
+PIPELINE = True
+HEADER_FORMAT = "binary"  # offer the compact binary header; the server falls back to json if it doesn't support it
+ACCEPT_ENCODING = compressions()  # compressions we can read for large responses; None to never compress
+REQUEST_TYPE = "text/json"  # or "binary/record" for the compact binary record codec
+SPOOL_THRESHOLD = 16 * 1024 * 1024  # responses this big go to a temporary file instead of memory; None to never spool
+BATCH_SIZE = 1000  # values per search_many request (the server's libsearch.MAX_BATCH)
 
 host, port = HOST,PORT
-action, value = 'search','morpheus'
-request = create_request(action, value)
-start_connection(host, port, request)
+# what the connection does (sends, responses, closing); the results themselves are printed by Message
+hooks.subscribe(LogSubscriber())
+queries = [('search', 'morpheus'), ('search', 'ring'), ('search', '\U0001f436')]
+requests = [create_request(action, value) for action, value in queries]
+# one round trip for several keys instead of one each
+requests += create_batch_requests(['morpheus', 'ring', 'neo'])
+requests.append(create_array_request([0.5 * i for i in range(1000)]))
+start_connection(host, port, requests)
 
 try:
     while True:
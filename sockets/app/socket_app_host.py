@@ -1,63 +1,557 @@
+import os
+import json
+import stat
+import errno
+import struct
+import time
+import signal
 import socket
 import selectors
 import traceback
+from collections import Counter
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from libserver import Message
+from libserver import Message, handlers, search, search_engine
+from libexecutor import HandlerExecutor
+from libflow import FlowControl
+from libbuffer import FileBody
+from libcache import ResponseCache
+from libmetrics import Metrics, MetricsEndpoint, drop_gauges, merge, write_prometheus
+from libtrace import LogSubscriber, TimingSubscriber, hooks
+from libtimer import TimerWheel
+from libselector import make_selector
+from libshm import ShmChannel, ShmMessage, check_platform
 
 
 # much of the handling of the content logic lies within the message class
-sel = selectors.DefaultSelector()
 HOST = '192.168.86.29'
-PORT = 65000  # port to listen on
-
-
-def accept_wrapper(sock):
-    # nearly identical to the multiconnection version except the message is the Message object from libserver
-    conn, addr = sock.accept()  # Should be ready to read
-    print("accepted connection from", addr)
-    conn.setblocking(False)
-    # associated the message object with the socket using sel.register
-    # we can get this back when we run the loop down below because we associated it with sel
-    message = Message(sel, conn, addr)
-    sel.register(conn, selectors.EVENT_READ, data=message)
-
-
-# very similar to the multi connect version where we are setting up the server to not allow blocking
-host, port = HOST, PORT
-lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-# Avoid bind() exception: OSError: [Errno 48] Address already in use
-# this is an option added to ensure that the helps avoid the error address already in use error.
-# If the server actively closed a connection it will remain in the TIME_WAIT state for about 2 mins
-# this is to safeguard against delayed packets in the network being delivered to the wrong address
-lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-lsock.bind((host, port))
-lsock.listen()
-print("listening on", (host, port))
-lsock.setblocking(False)
-sel.register(lsock, selectors.EVENT_READ, data=None)
-
-try:
-    # the event loop is designed to catch any errors and keep going if errors are found
-    while True:
-        # because sel.select is a main driver, and we know that we associated the message with sel in the accept wrapper
-        # we can get a reference back to the message
-        # it is also responsible for blocking, waiting, and waking up for read and write events
-        events = sel.select(timeout=None)
-        for key, mask in events:
-            if key.data is None:
-                accept_wrapper(key.fileobj)
-            else:
-                message = key.data
-                try:
-                    # sel.select indirectly is responsible for calling this method
-                    message.process_events(mask)
-                except Exception:
-                    print(
-                        "main: error: exception for",
-                        f"{message.addr}:\n{traceback.format_exc()}",
-                    )
-                    message.close()
-except KeyboardInterrupt:
-    print("caught keyboard interrupt, exiting")
-finally:
-    sel.close()
+PORT = 65000  # port to listen on; None to only listen on UNIX_PATH and/or SHM_PATH
+# a unix domain socket to listen on as well, for clients on this machine (they connect to "unix:<path>", see libclient);
+# no tcp/ip stack in between, the messages are the same. None for tcp only
+UNIX_PATH = None
+# the shared memory transport (see libshm) for clients on this machine: they connect to a unix domain socket at
+# SHM_PATH, which then only carries doorbells, and the messages go through two rings of SHM_RING_SIZE bytes in shared
+# memory (one pair per connection, in /dev/shm). None turns it off. x86-64 only (see libshm), the server won't start
+# with it set anywhere else
+SHM_PATH = None
+SHM_RING_SIZE = 16 * 1024 * 1024
+# keep-alive lets a client send several requests over one connection instead of paying a new tcp handshake each time
+KEEP_ALIVE = True
+IDLE_TIMEOUT = 30  # seconds a keep-alive connection may sit idle before it is closed; None to never close it
+# a client that starts a request has HEADER_TIMEOUT seconds to send all of its header and then REQUEST_TIMEOUT seconds
+# for the content, so half sent requests can't hold a connection open forever; None for no limit
+HEADER_TIMEOUT = 10
+REQUEST_TIMEOUT = 60
+# the deadlines are timers on a timer wheel (see libtimer) that ticks every TIMER_TICK seconds, so they run out up to
+# that much late
+TIMER_TICK = 0.5
+# the event backend of the selector loop (see libselector): "default", "epoll", "epoll-et" (edge triggered) or "poll"
+SELECTOR = "default"
+# admission: every time the listening socket is ready we accept up to ACCEPT_BATCH connections (instead of one), so a
+# connection storm empties the backlog in a few loop iterations. LISTEN_BACKLOG is how many connections the kernel holds
+# for us meanwhile (capped by net.core.somaxconn)
+# a worker takes at most MAX_CONNECTIONS connections at once (None for no limit); past that OVERLOAD is
+#   "defer": stop accepting until connections close; new ones wait in the backlog, where their wait shows up in the
+#            accept-seconds histogram
+#   "reject": accept and reset them straight away, so the client can retry (another worker or host) without waiting
+ACCEPT_BATCH = 64
+LISTEN_BACKLOG = 1024
+MAX_CONNECTIONS = 10000
+OVERLOAD = "defer"
+MAX_REQUESTS = 100  # requests served per connection before it is closed; None for no cap
+# one selector loop only ever uses one core, so by default we fork a worker process per core; every worker binds its
+# own listening socket with SO_REUSEPORT and the kernel spreads the incoming connections over them
+# set to 1 to run the server in this process (this is also what happens where fork/SO_REUSEPORT aren't available)
+WORKERS = os.cpu_count() or 1
+STATS_INTERVAL = 5  # seconds between the stats each worker reports to the supervisor
+RESTART_DELAY = 1  # seconds to wait before restarting a worker that crashed right after starting
+# slow handlers run on a pool instead of on the selector loop (see libexecutor): "thread", "process" or None to run
+# every handler inline
+EXECUTOR = "thread"
+EXECUTOR_WORKERS = 4
+OFFLOAD_ACTIONS = {"slow_search": 2}  # action -> how many of its handlers may run at once (None for no limit)
+# backpressure (see libflow): a pipelined connection stops reading requests once HIGH_WATER bytes of responses are
+# waiting to be sent to it and starts again at LOW_WATER; BUDGET caps the send buffers of all connections of a worker
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+BUDGET = 64 * 1024 * 1024  # None for no cap
+# the "file" action sends files from this directory (streamed with sendfile, see libbuffer.FileBody); None turns it off
+FILE_ROOT = None
+# request bodies this big are written to a temporary file in SPOOL_DIR (None for the system temp dir) as they arrive
+# instead of being held in memory; the handler gets an mmap of it. None to never spool
+SPOOL_THRESHOLD = 16 * 1024 * 1024
+SPOOL_DIR = None
+# a file of key<TAB>value[<TAB>weight] lines (or a json object) for the search action; None keeps the built in examples
+# the file is checked for changes every RELOAD_INTERVAL seconds and reloaded a slice at a time between the events
+# (see libsearch)
+CORPUS_PATH = None
+RELOAD_INTERVAL = 5
+# responses of these actions are cached (see libcache), per worker; None turns the cache off
+# only list actions whose response depends on nothing but the request; search is dropped from the cache when the
+# corpus is reloaded
+CACHE_ACTIONS = {"search", "slow_search"}
+CACHE_ENTRIES = 10000
+CACHE_BYTES = 64 * 1024 * 1024
+CACHE_TTL = 60  # seconds; None to keep responses until they are pushed out or invalidated
+# metrics (see libmetrics): the "stats" action always answers with the numbers of the worker it reaches; for all the
+# workers together, in prometheus text format, set METRICS_FILE (rewritten every STATS_INTERVAL seconds) and/or
+# METRICS_PORT (plain http on METRICS_HOST for prometheus to scrape). None turns them off
+METRICS_FILE = None
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None
+# tracing (see libtrace): the server used to print every connection and request, which costs more than serving them
+# under load. LOG_SAMPLE is the fraction of connections whose events are printed (1 prints them all like before);
+# TIMING_FILE gets a json line per request with how long it took to receive and to handle (one file per worker, the
+# pid is added to the name when there are several). None turns them off
+LOG_SAMPLE = None
+TIMING_FILE = None
+
+
+def slow_search(request):
+    # stands in for an expensive handler; module level so a process pool can pickle it
+    time.sleep(1)
+    return search(request)
+
+
+def get_file(request):
+    # value: a file name under FILE_ROOT, or {"name": ..., "offset": ..., "length": ...} for part of it
+    # the response is the raw file content (content-type binary/file), or a json error result
+    if FILE_ROOT is None:
+        return {"result": "Error: file serving is turned off."}
+    value = request.get("value")
+    if not isinstance(value, dict):
+        value = {"name": value}
+    name = str(value.get("name"))
+    root = os.path.realpath(FILE_ROOT)
+    path = os.path.realpath(os.path.join(root, name))
+    # no ../ or absolute paths out of FILE_ROOT
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+        return {"result": f'Error: no file "{name}".'}
+    try:
+        return FileBody(path, value.get("offset", 0), value.get("length"))
+    except (OSError, ValueError, TypeError) as e:
+        return {"result": f"Error: {repr(e)}"}
+
+
+handlers["slow_search"] = slow_search
+handlers["file"] = get_file
+
+
+def accept_wrapper(sel, sock, stats, executor, flow, cache, metrics, timers):
+    # nearly identical to the multiconnection version except the message is the Message object from libserver, and we
+    # keep accepting until the backlog is empty (or ACCEPT_BATCH connections, to give the others a turn)
+    # returns False when MAX_CONNECTIONS has been reached and OVERLOAD is "defer": the caller stops accepting
+    shm = SHM_PATH is not None and sock.family == socket.AF_UNIX and sock.getsockname() == SHM_PATH
+    for _ in range(ACCEPT_BATCH):
+        full = MAX_CONNECTIONS is not None and stats["active-connections"] >= MAX_CONNECTIONS
+        if full and OVERLOAD != "reject":
+            return False
+        try:
+            conn, addr = sock.accept()  # Should be ready to read
+        except (BlockingIOError, InterruptedError):
+            # the backlog is empty
+            return True
+        except ConnectionAbortedError:
+            # the client gave up while it was waiting in the backlog
+            continue
+        except OSError as e:
+            if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                # out of file descriptors (or memory); the connection stays in the backlog and we try again when
+                # select says so, which gives closing connections a chance to free some up
+                print("error: accept() failed:", repr(e))
+                stats["accept-errors"] += 1
+                return True
+            raise
+        if full:
+            # reset rather than close, so the socket doesn't sit in TIME_WAIT and the client knows right away
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            conn.close()
+            stats["rejected-connections"] += 1
+            continue
+        conn.setblocking(False)
+        stats["connections"] += 1
+        if sock.family == socket.AF_UNIX:
+            # the client end of a unix domain socket has no address, the path it connected to says more
+            addr = f"{'shm' if shm else 'unix'}:{sock.getsockname()}"
+        waited = accept_wait(conn)
+        if waited is not None:
+            metrics.accept_time(waited)
+        if shm:
+            # the messages go through shared memory from here on, the socket is only for the doorbells
+            try:
+                conn = ShmChannel.accept(conn, SHM_RING_SIZE)
+            except OSError as e:
+                # no room left in /dev/shm, most likely
+                print("error: shared memory for", addr, "failed:", repr(e))
+                stats["accept-errors"] += 1
+                conn.close()
+                continue
+        # associated the message object with the socket using sel.register
+        # we can get this back when we run the loop down below because we associated it with sel
+        message = (ShmMessage if shm else Message)(
+            sel,
+            conn,
+            addr,
+            keep_alive=KEEP_ALIVE,
+            idle_timeout=IDLE_TIMEOUT,
+            max_requests=MAX_REQUESTS,
+            stats=stats,
+            executor=executor,
+            flow=flow,
+            spool_threshold=SPOOL_THRESHOLD,
+            spool_dir=SPOOL_DIR,
+            cache=cache,
+            metrics=metrics,
+            timers=timers,
+            header_timeout=HEADER_TIMEOUT,
+            request_timeout=REQUEST_TIMEOUT,
+        )
+        sel.register(conn, selectors.EVENT_READ, data=message)
+    return True
+
+
+def accept_wait(conn):
+    # seconds the connection waited in the backlog before we accepted it, or None where we can't tell
+    # on linux TCP_INFO has the milliseconds since the connection last sent data; nothing but the SYN-ACK has been sent
+    # on a connection we just accepted, so that is (within a round trip) how long ago its handshake finished
+    if not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except OSError:
+        return None
+    # struct tcp_info: 8 one byte fields, then u32s of which tcpi_last_data_sent is the tenth
+    return struct.unpack_from("I", info, 44)[0] / 1000
+
+
+def create_listening_socket(host, port, reuse_port=False):
+    # very similar to the multi connect version where we are setting up the server to not allow blocking
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Avoid bind() exception: OSError: [Errno 48] Address already in use
+    # this is an option added to ensure that the helps avoid the error address already in use error.
+    # If the server actively closed a connection it will remain in the TIME_WAIT state for about 2 mins
+    # this is to safeguard against delayed packets in the network being delivered to the wrong address
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # lets every worker bind the same host/port; the kernel load balances new connections between them
+        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    lsock.bind((host, port))
+    lsock.listen(LISTEN_BACKLOG)
+    print("listening on", (host, port))
+    lsock.setblocking(False)
+    return lsock
+
+
+def create_unix_listening_socket(path):
+    # the same for a unix domain socket; the "address" is a file, which a server that didn't exit cleanly leaves
+    # behind and bind() then fails on. If nothing answers on it any more it is removed first (but not the socket of a
+    # server that is still running; bind() fails with address already in use for that one, like for tcp)
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        except OSError:
+            pass
+        finally:
+            probe.close()
+    lsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    lsock.bind(path)
+    lsock.listen(LISTEN_BACKLOG)
+    print("listening on", f"unix:{path}")
+    lsock.setblocking(False)
+    return lsock
+
+
+def close_unix_listening_socket(lsock, path):
+    lsock.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def serve(lsocks, stats_fd=None):
+    # the selector loop; runs in this process or in each worker, accepting connections on all the listening sockets
+    # with stats_fd the running totals (a libmetrics snapshot) are written to it as a json line every STATS_INTERVAL
+    # seconds and the supervisor exports them; without it we export our own
+    sel = make_selector(SELECTOR)
+    for lsock in lsocks:
+        sel.register(lsock, selectors.EVENT_READ, data=None)
+    # false while MAX_CONNECTIONS are open and OVERLOAD is "defer"
+    accepting = True
+    stats = Counter(connections=0, requests=0)
+    metrics = Metrics(stats)
+    endpoint = None
+    if stats_fd is None and METRICS_PORT is not None:
+        endpoint = MetricsEndpoint(sel, METRICS_HOST, METRICS_PORT, metrics.snapshot)
+    # the backpressure counters (paused connections etc.) go in stats as well
+    flow = FlowControl(HIGH_WATER, LOW_WATER, BUDGET, stats=stats)
+    cache = None
+    if CACHE_ACTIONS:
+        cache = ResponseCache(CACHE_ACTIONS, CACHE_ENTRIES, CACHE_BYTES, CACHE_TTL, stats=stats)
+    search_generation = search_engine.generation
+    executor = None
+    if EXECUTOR is not None:
+        pool_class = ProcessPoolExecutor if EXECUTOR == "process" else ThreadPoolExecutor
+        executor = HandlerExecutor(sel, pool_class(max_workers=EXECUTOR_WORKERS), OFFLOAD_ACTIONS, metrics)
+    metrics_file = METRICS_FILE if stats_fd is None else None
+    next_report = time.monotonic() + STATS_INTERVAL
+    next_reload_check = time.monotonic() + RELOAD_INTERVAL
+    subscribers = []
+    if LOG_SAMPLE:
+        subscribers.append(hooks.subscribe(LogSubscriber(LOG_SAMPLE)))
+    if TIMING_FILE is not None:
+        timing_file = TIMING_FILE if stats_fd is None else f"{TIMING_FILE}.{os.getpid()}"
+        subscribers.append(hooks.subscribe(TimingSubscriber(timing_file)))
+    # the connection deadlines; every Message schedules its own on it
+    timers = TimerWheel(TIMER_TICK)
+    timeout = None
+    if stats_fd is not None or CORPUS_PATH is not None or metrics_file is not None:
+        timeout = 1
+
+    try:
+        # the event loop is designed to catch any errors and keep going if errors are found
+        while True:
+            # because sel.select is a main driver, and we know that we associated the message with sel in the accept
+            # wrapper we can get a reference back to the message
+            # it is also responsible for blocking, waiting, and waking up for read and write events
+            # wake up for the next tick of the timer wheel (when there are timers), and at least once a second when
+            # there are reports or reload checks to do
+            select_timeout = timers.next_timeout()
+            if select_timeout is None or (timeout is not None and timeout < select_timeout):
+                select_timeout = timeout
+            if search_engine.reloading:
+                # don't wait for events, the reload gets a slice every time around
+                select_timeout = 0
+            events = sel.select(timeout=select_timeout)
+            # the time spent on this batch of events is time every other connection waited
+            busy_start = time.perf_counter()
+            for key, mask in events:
+                if key.data is None:
+                    # (with several listening sockets the others may still be in this batch of events after we stopped)
+                    if not accepting:
+                        continue
+                    if not accept_wrapper(sel, key.fileobj, stats, executor, flow, cache, metrics, timers):
+                        # full up; leave the rest in the backlog until some connections have closed
+                        for lsock in lsocks:
+                            sel.unregister(lsock)
+                        accepting = False
+                        stats["accept-paused"] += 1
+                elif key.data is executor:
+                    # offloaded handlers have finished
+                    executor.process_events(mask)
+                elif key.data is endpoint:
+                    # a scrape of the metrics endpoint; its connection is handled below like a message
+                    try:
+                        endpoint.process_events(mask)
+                    except Exception:
+                        print("main: error: metrics endpoint:", traceback.format_exc())
+                        endpoint.close()
+                else:
+                    message = key.data
+                    try:
+                        # sel.select indirectly is responsible for calling this method
+                        message.process_events(mask)
+                    except Exception:
+                        print(
+                            "main: error: exception for",
+                            f"{message.addr}:\n{traceback.format_exc()}",
+                        )
+                        message.close()
+            # close the connections whose deadlines have passed
+            timers.advance()
+            if not accepting and stats["active-connections"] < MAX_CONNECTIONS:
+                for lsock in lsocks:
+                    sel.register(lsock, selectors.EVENT_READ, data=None)
+                accepting = True
+            search_engine.step()
+            if cache is not None and search_engine.generation != search_generation:
+                # a new search index was swapped in, the cached search responses came from the old one
+                search_generation = search_engine.generation
+                cache.invalidate("search")
+                cache.invalidate("slow_search")
+            if CORPUS_PATH is not None and time.monotonic() >= next_reload_check:
+                search_engine.check_for_update()
+                next_reload_check += RELOAD_INTERVAL
+            if time.monotonic() >= next_report:
+                if stats_fd is not None:
+                    os.write(stats_fd, (json.dumps(metrics.snapshot()) + "\n").encode("utf-8"))
+                if metrics_file is not None:
+                    write_prometheus(metrics_file, metrics.snapshot())
+                next_report += STATS_INTERVAL
+            metrics.loop_time(time.perf_counter() - busy_start)
+    except KeyboardInterrupt:
+        print("caught keyboard interrupt, exiting")
+    finally:
+        # the shared memory connections' rings would be left behind in /dev/shm
+        for key in list(sel.get_map().values()):
+            if isinstance(key.data, ShmMessage):
+                key.data.close()
+        if executor is not None:
+            executor.close()
+        if endpoint is not None:
+            endpoint.close()
+        for subscriber in subscribers:
+            hooks.unsubscribe(subscriber)
+            if hasattr(subscriber, "close"):
+                subscriber.close()
+        sel.close()
+
+
+def start_worker(host, port, inherited_fds, unix_lsocks=()):
+    # fork a worker with a pipe back to the supervisor for its stats; returns (pid, read end of the pipe)
+    # unix_lsocks: the supervisor's unix domain listening sockets (UNIX_PATH, SHM_PATH), which all the workers accept
+    # from
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # worker: drop the supervisor's file descriptors, then run the usual selector loop
+        # the supervisor stops workers with SIGTERM; like ctrl-c it ends serve() through its cleanup (executor,
+        # subscribers, the shared memory rings), which dying of the signal would skip
+        signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+        os.close(read_fd)
+        for fd in inherited_fds:
+            os.close(fd)
+        status = 0
+        try:
+            lsocks = [] if port is None else [create_listening_socket(host, port, reuse_port=True)]
+            lsocks.extend(unix_lsocks)
+            serve(lsocks, stats_fd=write_fd)
+        except KeyboardInterrupt:
+            # stopped before serve() got going
+            pass
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            # never fall back into the supervisor's code
+            os._exit(status)
+    os.close(write_fd)
+    return pid, read_fd
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def supervise(host, port, num_workers):
+    # starts num_workers workers, restarts any that exit, and prints the stats of all of them added together
+    if SHM_PATH is not None:
+        check_platform()
+    sel = selectors.DefaultSelector()
+    workers = {}  # pid -> the worker's stats pipe and its latest metrics snapshot
+    retired = merge([])  # totals from workers that have exited
+    stopping = False
+
+    def totals():
+        return merge([retired] + [worker.snapshot for worker in workers.values()])
+
+    endpoint = None
+    if METRICS_PORT is not None:
+        endpoint = MetricsEndpoint(sel, METRICS_HOST, METRICS_PORT, totals)
+    # there is no SO_REUSEPORT for unix domain sockets; the workers share these and their backlogs instead
+    # path -> listening socket
+    unix_lsocks = {}
+    for path in (UNIX_PATH, SHM_PATH):
+        if path is not None:
+            unix_lsocks[path] = create_unix_listening_socket(path)
+
+    def spawn():
+        inherited_fds = [sel.fileno()] + [w.fd for w in workers.values()]
+        if endpoint is not None:
+            inherited_fds.append(endpoint.sock.fileno())
+        pid, fd = start_worker(host, port, inherited_fds, list(unix_lsocks.values()))
+        os.set_blocking(fd, False)
+        workers[pid] = SimpleNamespace(fd=fd, started=time.monotonic(), buffer=b"", snapshot=merge([]))
+        sel.register(fd, selectors.EVENT_READ, data=pid)
+        print("started worker", pid)
+
+    def reap():
+        # collect exited workers and restart them
+        nonlocal retired
+        while workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            worker = workers.pop(pid, None)
+            if worker is None:
+                continue
+            sel.unregister(worker.fd)
+            os.close(worker.fd)
+            retired = merge([retired, drop_gauges(worker.snapshot)])
+            # negative exit codes are the signal that killed it
+            print(f"worker {pid} exited with code {os.waitstatus_to_exitcode(status)}")
+            if not stopping:
+                if time.monotonic() - worker.started < RESTART_DELAY:
+                    time.sleep(RESTART_DELAY)
+                spawn()
+
+    # turn SIGTERM into the same clean shutdown as ctrl-c so the workers are not left behind
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    try:
+        for _ in range(num_workers):
+            spawn()
+        next_report = time.monotonic() + STATS_INTERVAL
+        while True:
+            for key, mask in sel.select(timeout=1):
+                if key.data not in workers:
+                    # the metrics endpoint or one of its connections
+                    try:
+                        key.data.process_events(mask)
+                    except Exception:
+                        print("main: error: metrics endpoint:", traceback.format_exc())
+                        key.data.close()
+                    continue
+                worker = workers[key.data]
+                worker.buffer += os.read(key.fd, 65536)
+                # each report is one json line with the worker's running totals, we only need the latest
+                *lines, worker.buffer = worker.buffer.split(b"\n")
+                if lines:
+                    worker.snapshot = json.loads(lines[-1])
+            reap()
+            if time.monotonic() >= next_report:
+                snapshot = totals()
+                counters = Counter(connections=0, requests=0)
+                counters.update(snapshot["counters"])
+                print(f"workers: {len(workers)},", ", ".join(f"{k}: {v}" for k, v in sorted(counters.items())))
+                if METRICS_FILE is not None:
+                    write_prometheus(METRICS_FILE, snapshot)
+                next_report += STATS_INTERVAL
+    except KeyboardInterrupt:
+        print("caught keyboard interrupt, stopping workers")
+    finally:
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(workers):
+            os.waitpid(pid, 0)
+        if endpoint is not None:
+            endpoint.close()
+        for path, lsock in unix_lsocks.items():
+            close_unix_listening_socket(lsock, path)
+        sel.close()
+
+
+if __name__ == "__main__":
+    # loaded before the workers are forked so they all start out with it
+    if CORPUS_PATH is not None:
+        search_engine.load(CORPUS_PATH)
+    if WORKERS > 1 and hasattr(socket, "SO_REUSEPORT") and hasattr(os, "fork"):
+        supervise(HOST, PORT, WORKERS)
+    else:
+        if SHM_PATH is not None:
+            check_platform()
+        lsocks = [] if PORT is None else [create_listening_socket(HOST, PORT)]
+        unix_lsocks = {path: create_unix_listening_socket(path) for path in (UNIX_PATH, SHM_PATH) if path is not None}
+        try:
+            serve(lsocks + list(unix_lsocks.values()))
+        finally:
+            for path, lsock in unix_lsocks.items():
+                close_unix_listening_socket(lsock, path)
+
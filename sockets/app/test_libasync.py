@@ -0,0 +1,68 @@
+import asyncio
+import unittest
+
+from libasync import Client, Server
+from libcodec import MAX_DECOMPRESSED_LENGTH, compressions
+
+# the asyncio server answers the same actions as the selector one
+# usage: python -m unittest test_libasync (from this directory, like the rest of sockets/app)
+
+
+class AsyncServerTest(unittest.TestCase):
+    async def _request(self, action, value, **options):
+        server = Server()
+        listener = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0)
+        host, port = listener.sockets[0].getsockname()[:2]
+        try:
+            async with Client(host, port) as client:
+                return await client.send(dict(action=action, value=value, **options))
+        finally:
+            listener.close()
+            await listener.wait_closed()
+
+    async def _compressed_request(self, content):
+        # the first request negotiates compression, the second one is sent compressed
+        server = Server()
+        listener = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0)
+        host, port = listener.sockets[0].getsockname()[:2]
+        try:
+            async with Client(host, port, accept_encoding=compressions()) as client:
+                await client.request("search", "morpheus")
+                return await client.send(content, "binary/custom-client-binary-type", "binary")
+        finally:
+            listener.close()
+            await listener.wait_closed()
+
+    def test_search(self):
+        response = asyncio.run(self._request("search", "morpheus"))
+        self.assertEqual(response, {"result": "Follow the white rabbit. 🐰"})
+
+    def test_search_many(self):
+        response = asyncio.run(self._request("search_many", ["morpheus", "nobody", 7]))
+        self.assertEqual(
+            response["result"],
+            [
+                {"value": "morpheus", "result": "Follow the white rabbit. 🐰"},
+                {"value": "nobody", "error": 'No match for "nobody".'},
+                {"value": 7, "error": "the search value must be a string."},
+            ],
+        )
+
+    def test_search_many_prefix(self):
+        response = asyncio.run(self._request("search_many", ["mor", "ri"], mode="prefix", limit=1))
+        self.assertEqual([item["value"] for item in response["result"]], ["mor", "ri"])
+        self.assertEqual(response["result"][0]["result"][0]["key"], "morpheus")
+
+    def test_invalid_action(self):
+        response = asyncio.run(self._request("nothing", "morpheus"))
+        self.assertEqual(response, {"result": 'Error: invalid action "nothing".'})
+
+    def test_decompressed_too_large(self):
+        response = asyncio.run(self._compressed_request(bytes(MAX_DECOMPRESSED_LENGTH + 1)))
+        self.assertEqual(
+            response, {"result": f"Error: Content decompresses to more than {MAX_DECOMPRESSED_LENGTH} bytes."}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,5 @@
+import os
+import time
 import socket
 import selectors
 from types import SimpleNamespace
@@ -12,7 +14,9 @@ def accept_wrapper(sock: socket.socket):
     conn, addr = sock.accept()
     print('accepted connection from', addr)
     conn.setblocking(False) # put the socket into non blocking mode
-    data = SimpleNamespace(addr=addr, inb=b'', outb=b'') # this will hold the data we want to include along with the socket
+    stats['connections'] += 1
+    stats['active-connections'] += 1
+    data = SimpleNamespace(addr=addr, inb=b'', outb=b'', paused=False) # this will hold the data we want to include along with the socket
 
     # this might be adding the event read/write that we will get to in the service connection but I am not entirely
     # sure
@@ -31,20 +35,72 @@ def service_connection(key, mask):
         # if the data is ready for reading then this will be found true
         # very similar to the basic version of this script
         recv_data = sock.recv(1024)  # Should be ready to read
+        stats['bytes-in'] += len(recv_data)
         if recv_data:
             data.outb += recv_data # for this example we are just adding the recv_data to data.outb
+            stats['buffered'] += len(recv_data)
+            # backpressure: a client that sends without reading what we echo back would make outb grow forever, so
+            # stop reading from it once too much is waiting (or all connections together are over the budget)
+            if len(data.outb) >= HIGH_WATER or stats['buffered'] > BUDGET:
+                pause(sock, data)
         else:
             print('closing connection to', data.addr)
+            stats['buffered'] -= len(data.outb)
+            stats['active-connections'] -= 1
+            if data.paused:
+                stats['paused'] -= 1
             sel.unregister(sock)
             sock.close()
+            return
     if mask & selectors.EVENT_WRITE:
         # if the data is ready for writing then this will be found true
         if data.outb:
             print('echoing', repr(data.outb), 'to', data.addr)
             sent = sock.send(data.outb)  # Should be ready to write; sending data out to the socket
             data.outb = data.outb[sent:]
-
-
+            stats['buffered'] -= sent
+            stats['bytes-out'] += sent
+            # start reading again once it has caught up; an empty outb can always take more
+            if data.paused and (not data.outb or (len(data.outb) <= LOW_WATER and stats['buffered'] <= BUDGET)):
+                resume(sock, data)
+
+
+def pause(sock, data):
+    # only ask for write events until the client has read some of the echo
+    data.paused = True
+    stats['paused'] += 1
+    stats['pauses'] += 1
+    print('pausing', data.addr, stats)
+    sel.modify(sock, selectors.EVENT_WRITE, data=data)
+
+
+def resume(sock, data):
+    data.paused = False
+    stats['paused'] -= 1
+    print('resuming', data.addr, stats)
+    sel.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=data)
+
+
+def report():
+    # the running numbers, printed and (with METRICS_FILE) written in prometheus text format; the app host
+    # (sockets/app/libmetrics.py) has the full version of this with histograms and a stats action
+    print('stats:', ', '.join(f'{name}: {value}' for name, value in stats.items()),
+          f'(slowest loop iteration {loop_max[0] * 1000:.2f} ms)')
+    loop_max[0] = 0.0
+    if METRICS_FILE is None:
+        return
+    lines = []
+    for name, value in stats.items():
+        metric = 'echo_' + name.replace('-', '_')
+        kind = 'gauge' if name in ('buffered', 'paused', 'active-connections') else 'counter'
+        if kind == 'counter':
+            metric += '_total'
+        lines.append(f'# TYPE {metric} {kind}')
+        lines.append(f'{metric} {value}')
+    # written next to the real file and renamed over it so a reader never sees half of it
+    with open(METRICS_FILE + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(METRICS_FILE + '.tmp', METRICS_FILE)
 
 
 # set up the selectors
@@ -60,6 +116,21 @@ sel = selectors.DefaultSelector()
 #       client (socket_client.py)
 HOST = '192.168.86.29'
 PORT = 65000  # port to listen on
+# backpressure: stop reading from a connection once HIGH_WATER bytes are waiting to be echoed back to it, start again at
+# LOW_WATER; BUDGET is the same kind of cap for all connections together
+HIGH_WATER = 64 * 1024
+LOW_WATER = 16 * 1024
+BUDGET = 16 * 1024 * 1024
+# buffered: bytes waiting to be echoed over all connections; paused: connections not being read from right now;
+# pauses: how many times a connection got paused
+stats = {'buffered': 0, 'paused': 0, 'pauses': 0}
+# metrics: connections accepted in total and open right now, bytes read and echoed, and the time the loop spent
+# working (not waiting in select); printed every STATS_INTERVAL seconds and written to METRICS_FILE (prometheus text
+# format, None to not write it)
+stats.update({'connections': 0, 'active-connections': 0, 'bytes-in': 0, 'bytes-out': 0, 'loop-seconds': 0.0})
+loop_max = [0.0]  # slowest loop iteration since the last report
+STATS_INTERVAL = 5
+METRICS_FILE = None
 
 print('host info')
 print(socket.gethostbyname(HOST))
@@ -77,8 +148,11 @@ lsock.setblocking(False)
 # data is used to store any arbitrary data you want to store along the socket which is returned when select() returns
 sel.register(lsock, selectors.EVENT_READ, data=None)
 
+next_report = time.monotonic() + STATS_INTERVAL
 while True:
-    events = sel.select(timeout=None)  # the timeout param will block until there are sockets read for I/O
+    # the timeout param will block until there are sockets read for I/O; we wake up for the stats report at least
+    events = sel.select(timeout=max(next_report - time.monotonic(), 0))
+    busy_start = time.perf_counter()
     # a list is returned when for each socket.key in SelectorKey named tuple that contains a fileobj attribute
     # the key.fileobj is the socket object and the mask is an event mask of operations that are ready
     for key, mask in events:
@@ -88,3 +162,9 @@ while True:
             accept_wrapper(key.fileobj)
         else:
             service_connection(key, mask)
+    busy = time.perf_counter() - busy_start
+    stats['loop-seconds'] += busy
+    loop_max[0] = max(loop_max[0], busy)
+    if time.monotonic() >= next_report:
+        report()
+        next_report += STATS_INTERVAL